@@ -1,14 +1,21 @@
 # -*- coding: utf-8 -*-`
 
-import logging
 import endpoints
+from google.appengine.ext import ndb
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
-from models import User, Game, Score, Record
+import archive
+import counters
+import gamecache
+import leaderboard
+import profiling
+import stats
+from board import CARD_LABELS, DECK_SIZE
+from models import User, Room, Game, Score, Record, RoomRecord
 from models import GameForm, GameForms, NewGameForm, MakeMoveForm, ScoreForm,\
-    ScoreForms, NumberOfResultsForm, RecordForm, RecordForms,StringMessage
-from utils import get_by_urlsafe
+    ScoreForms, NumberOfResultsForm, RecordForm, RecordForms,StringMessage,\
+    RankForm, MakeMovesForm, MoveResultForm, MoveResultForms, StatsForm
+from utils import get_key_by_urlsafe, to_forms_async, to_form_async,\
+    fetch_page_async, get_page_size, get_list_page
 
 
 """Endpoint request methods."""
@@ -25,110 +32,341 @@ GET_GAME_REQUEST = endpoints.ResourceContainer(
 USER_NAME_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),)
 
+ROOM_REQUEST = endpoints.ResourceContainer(
+    room=messages.StringField(1),)
+
+CREATE_ROOM_REQUEST = endpoints.ResourceContainer(
+    room=messages.StringField(1),
+    description=messages.StringField(2),)
+
+USER_RANK_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    room=messages.StringField(2),)
+
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    cursor=messages.StringField(3),)
+
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2),)
+
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    page=messages.IntegerField(2),
+    page_size=messages.IntegerField(3),)
+
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
 
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
+
 NUMBER_OF_RESULTS_REQUEST = endpoints.ResourceContainer(
     NumberOfResultsForm,)
 
-MEMCACHE_AVERAGE_MOVES = 'AVERAGE_MOVES'
+profiling.install_hooks()
+
+HISTORY_PAGE_SIZE = 100
+MAX_MOVES_PER_REQUEST = 200
+MAX_HISTORY_PAGE_SIZE = 500
+
+
+def _form_fields(entries):
+    """Strips the leaderboard ids from leaderboard entries"""
+    for entry in entries:
+        fields = dict(entry)
+        del fields['id']
+        yield fields
+
+
+def _user_key(user_name):
+    """Returns the key a User with a name would have, raising
+       NotFoundException for names no User can have"""
+    if not user_name or not User.normalize_name(user_name):
+        raise endpoints.NotFoundException('A User with that name does not exist!')
+    return User.key_for(user_name)
+
+
+@ndb.tasklet
+def _get_user_async(user_name):
+    """Returns a Future for the User with a name, raising NotFoundException
+       if there is none"""
+    user = yield User.get_by_name_async(user_name)
+    if not user:
+        raise endpoints.NotFoundException('A User with that name does not exist!')
+    raise ndb.Return(user)
+
+
+@ndb.tasklet
+def _get_room_key_async(room_name):
+    """Returns a Future for the key of the Room with a name, None if no name
+       is given, raising NotFoundException if there is no such Room"""
+    if not room_name:
+        raise ndb.Return(None)
+    room = None
+    if Room.normalize_name(room_name):
+        room = yield Room.key_for(room_name).get_async()
+    if not room:
+        raise endpoints.NotFoundException('A Room with that name does not exist!')
+    raise ndb.Return(room.key)
+
+
+# Move messages are built once rather than formatted on every move.
+GAME_OVER_MESSAGE = 'This game is already over!'
+INVALID_CHOICES_MESSAGE = 'You have entered invalid choices, choices can '\
+    'only be numbers in range of 0 - 51!'
+FIRST_RANGE_MESSAGE = 'First choice is not in range of 0-51!'
+SECOND_RANGE_MESSAGE = 'Second choice is not in range of 0-51!'
+SAME_CHOICE_MESSAGE = 'First choice and second choice cannot be the same!'
+FIRST_MATCHED_MESSAGE = 'First choice has already been selected!'
+SECOND_MATCHED_MESSAGE = 'Second choice has already been selected!'
+# The notation of every card at every position, e.g. '3:_AH'.
+CHOICE_LABELS = tuple(tuple('{}:{}'.format(position, label)
+                            for label in CARD_LABELS)
+                      for position in range(DECK_SIZE))
+RESULT_LABELS = {True: ' | Match', False: ' | No_Match'}
+
+
+def _check_choices(first_choice, second_choice):
+    """Returns the message rejecting a malformed, out of range or repeated
+       pair of choices, or None if the pair could be played. Needs no
+       game."""
+    if not isinstance(first_choice, (int, long)) or \
+            not isinstance(second_choice, (int, long)):
+        return INVALID_CHOICES_MESSAGE
+    if not 0 <= first_choice < DECK_SIZE:
+        return FIRST_RANGE_MESSAGE
+    if not 0 <= second_choice < DECK_SIZE:
+        return SECOND_RANGE_MESSAGE
+    if first_choice == second_choice:
+        return SAME_CHOICE_MESSAGE
+    return None
+
+
+def _check_move(game, first_choice, second_choice):
+    """Returns the message rejecting a pair of choices on a game, or None if
+       the move can be played. Only the game's matched positions are read,
+       the board is not loaded."""
+    if game.game_over:
+        return GAME_OVER_MESSAGE
+    error = _check_choices(first_choice, second_choice)
+    if error:
+        return error
+    matched = game.matched_mask()
+    if matched >> first_choice & 1:
+        return FIRST_MATCHED_MESSAGE
+    if matched >> second_choice & 1:
+        return SECOND_MATCHED_MESSAGE
+    return None
+
+
+def _play_move(game, first_choice, second_choice):
+    """Checks players card choices against a game and applies the move to it.
+       Returns the message for the player and whether the game changed, the
+       message is None once every pair has been matched and the game should
+       be won."""
+    # Checks if all card pairs have been matched before continuing.
+    if not game.game_over and game.successful_attempts >= 26:
+        return None, False
+
+    error = _check_move(game, first_choice, second_choice)
+    if error:
+        return error, False
+
+    # Checks for matches in card rank and suit color.
+    board = game.load_board()
+    matched = board.flip(first_choice, second_choice)
+    if matched:
+        game.successful_attempts += 1
+    else:
+        game.failed_attempts += 1
+
+    # Update game statistics and append the move to the move log.
+    game.append_move(first_choice, second_choice, board, matched)
+    game.total_attempts += 1
+    game.store_board(board)
+
+    return (CHOICE_LABELS[first_choice][board.deck[first_choice]] + ' ~ ' +
+            CHOICE_LABELS[second_choice][board.deck[second_choice]] +
+            RESULT_LABELS[matched]), True
+
+
+def _with_changed(outcome):
+    """Passes a move's message and whether it changed the game back from
+       gamecache.update"""
+    return outcome, outcome[1]
+
+
+def _play_moves(game, moves):
+    """Applies a list of moves to a game in order, stopping at the first
+       invalid move or once every pair has been matched. Returns the
+       MoveResultForm of each move played and whether the game changed."""
+    results = []
+    changed = False
+    for move in moves:
+        message, moved = _play_move(game, move.first_choice,
+                                    move.second_choice)
+        if message is None:
+            break
+        results.append(MoveResultForm(first_choice=move.first_choice,
+                                      second_choice=move.second_choice,
+                                      message=message,
+                                      valid=moved))
+        changed = changed or moved
+        if not moved or game.successful_attempts >= 26:
+            break
+    return results, changed
 
 
 @endpoints.api(name='concentration', version='v1')
 class ConcentrationApi(remote.Service):
-    """Game API"""
+    """Game API. Each endpoint method is a thin synchronous wrapper around a
+       tasklet so that independent datastore and memcache calls overlap."""
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=StringMessage,
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @profiling.instrumented
     def create_user(self, request):
         """Create a User"""
-        # Checks if user provided user name exists in database
-        if User.query(User.name == request.user_name).get():
-            raise endpoints.ConflictException(\
-                    'A User with that name already exists!')
+        return self._create_user_async(request).get_result()
 
-        # Creates new player record and user 
-        # based on user inputed name and email
-        user = User(name=request.user_name, 
-                    email=request.email)
-        user.put()
+    @ndb.tasklet
+    def _create_user_async(self, request):
+        if not request.user_name or not User.normalize_name(request.user_name):
+            raise endpoints.BadRequestException('A user name is required!')
 
-        record = Record(user=user.key,
-                        wins=0,
-                        loses=0)
-        record.put()
+        # Checks if user provided user name exists in database then creates
+        # new player record and user based on user inputed name and email.
+        # A new name misses both lookups, so they are made together.
+        user, legacy = yield (
+            User.key_for(request.user_name).get_async(),
+            User.query(User.name == request.user_name).get_async())
+        if not user and not legacy:
+            user = yield User.create_async(request.user_name, request.email)
+            if user:
+                raise ndb.Return(StringMessage(
+                    message='User {} created!'.format(request.user_name)))
+        raise endpoints.ConflictException(\
+                'A User with that name already exists!')
 
-        return StringMessage(message='User {} created!'.format(request.user_name))
+    @endpoints.method(request_message=CREATE_ROOM_REQUEST,
+                      response_message=StringMessage,
+                      path='room',
+                      name='create_room',
+                      http_method='POST')
+    @profiling.instrumented
+    def create_room(self, request):
+        """Create a Room"""
+        return self._create_room_async(request).get_result()
+
+    @ndb.tasklet
+    def _create_room_async(self, request):
+        if not request.room or not Room.normalize_name(request.room):
+            raise endpoints.BadRequestException('A room name is required!')
+        room = yield Room.create_async(request.room, request.description)
+        if not room:
+            raise endpoints.ConflictException(
+                'A Room with that name already exists!')
+        raise ndb.Return(StringMessage(
+            message='Room {} created!'.format(room.name)))
 
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @profiling.instrumented
     def new_game(self, request):
         """Creates new game"""
+        return self._new_game_async(request).get_result()
+
+    @ndb.tasklet
+    def _new_game_async(self, request):
         # Retrieve user information from database based on inputed information
-        user = User.query(User.name == request.user_name).get()
-        
-        # If logged in user does not match inputed user exception is raised.
-        if not user:
-            raise endpoints.NotFoundException('A User with that name does not exist!')
-        
+        user, room = yield (_get_user_async(request.user_name),
+                            _get_room_key_async(request.room))
+
         # Instantiation of new game entry.
-        game = Game.new_game(user.key)
+        game = yield Game.new_game_async(user.key, user.name, room)
+        yield gamecache.store_async(game)
+
+        raise ndb.Return(game.to_form('Good luck playing Concentration!'))
 
-        # Task queue to update the average attempts.
-        taskqueue.add(url='/tasks/cache_average_attempts')
-        
-        return game.to_form('Good luck playing Concentration!')
-    
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/cancel/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='PUT')
+    @profiling.instrumented
     def cancel_game(self, request):
         """Cancels active game"""
+        return self._cancel_game_async(request).get_result()
+
+    @ndb.tasklet
+    def _cancel_game_async(self, request):
         # Retrieve game instance.
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        
+        game = yield gamecache.get_async(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game))
+
         # Checks if game exists to determines whether to
-        # cancel game or raise exception.
+        # cancel game or raise exception. A game that ended since it was
+        # cached is dropped from the cache.
+        ended = False
         if game and game.game_over == False:
-            game.end_game(won=False)
-            return game.to_form('Game was successfully cancelled!')
+            ended = yield gamecache.end_game_async(game, won=False)
+        if ended:
+            form = yield to_form_async(game,
+                                       'Game was successfully cancelled!')
+            raise ndb.Return(form)
         else:
             raise endpoints.NotFoundException('Game to be cancelled was not found!')
-        
-    @endpoints.method(request_message=USER_NAME_REQUEST,
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='games/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @profiling.instrumented
     def get_user_games(self, request):
-        """Return user active games"""
-        # Retrieve active games based on user name and false game over status.
-        user = User.query(User.name==request.user_name).get()
-        games = Game.query(Game.user==user.key, 
-                           Game.game_over==False)
-        if games:
-            return GameForms(items=[game.to_form('') for game in games])
-        else:
-            raise endpoints.NotFoundException('No games were found!')
-        
+        """Return a page of user active games"""
+        return self._get_user_games_async(request).get_result()
+
+    @ndb.tasklet
+    def _get_user_games_async(self, request):
+        # Retrieve active games from the user's set of active game keys.
+        user = yield _get_user_async(request.user_name)
+        active_game_keys = yield user.active_game_keys_async()
+        keys, next_cursor = get_list_page(active_game_keys,
+                                          get_page_size(request.page_size),
+                                          request.cursor)
+        games = yield gamecache.get_multi_async(keys)
+        forms = yield to_forms_async([game for game in games
+                                      if game and not game.game_over], '')
+        raise ndb.Return(GameForms(items=forms, next_cursor=next_cursor))
+
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @profiling.instrumented
     def get_game(self, request):
         """Return the current game state"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        return self._get_game_async(request).get_result()
+
+    @ndb.tasklet
+    def _get_game_async(self, request):
+        game = yield gamecache.get_async(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game))
         if game:
-            return game.to_form('Time to make a move!')
+            form = yield to_form_async(game, 'Time to make a move!')
+            raise ndb.Return(form)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
@@ -137,207 +375,306 @@ class ConcentrationApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @profiling.instrumented
     def make_move(self, request):
         """Checks players card choices then returns 
            a game state with a message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        
-        # Checks if game is over.
-        if game.game_over:
-            return game.to_form('This game is already over!')
-                
-        # Checks if all card pairs have been matched before continuing.
-        elif game.successful_attempts < 26:
-            # Declare variables to store player card choices.
-            choice_one_int = 0
-            choice_two_int = 0
-        
-            # Checks for valid player inputs that are castable 
-            # to type int(integer) before continuing.
-            try:
-                choice_one_int = int(request.first_choice)
-                choice_two_int = int(request.second_choice)
-            except:
-                return game.to_form('You have entered invalid choices, choices can only be numbers in range of 0 - 51!')
-            
-            # Checks player input for choices in range of 0 - 51.
-            if (choice_one_int < 0) or (choice_one_int > 51):
-                return game.to_form('First choice is not in range of 0-51!')
-            elif (choice_two_int < 0) or (choice_two_int > 51):
-                return game.to_form('Second choice is not in range of 0-51!')
-            
-            # Checks for identical choices.
-            if choice_one_int == choice_two_int:
-                return game.to_form('First choice and second choice cannot be the same!')
-
-            # Card rank, suite colors, and game history setup variables.
-            attempts = game.total_attempts
-            success = game.successful_attempts
-            fail = game.failed_attempts
-            history = []
-            history = game.move_history.split(' ')
-            cards = []
-            cards = game.available_cards.split(',')
-            CARD_COLORS = {'H':'R', 'D':'R', 'C':'B', 'S':'B'}
-            card_one = cards[choice_one_int]
-            card_two = cards[choice_two_int]
-            pairing_result = ''
-            
-            # Checks if a user selected card has been matched.
-            if card_one == '---':
-                return game.to_form('First choice has already been selected!')
-            elif card_two == '---':
-                return game.to_form('Second choice has already been selected!')
-            
-            # Variables storing card_one and card_two rank, suite, and color.
-            card_one_rank = card_one[0:2]
-            card_one_suite = card_one[2]
-            card_one_color = CARD_COLORS[card_one_suite]
-            card_two_rank = card_two[0:2]
-            card_two_suite = card_two[2]
-            card_two_color = CARD_COLORS[card_two_suite]      
-            
-            # Checks for matches in card rank and suit color.
-            if card_one_rank == card_two_rank:
-                if card_one_color == card_two_color:
-                    success += 1
-                    pairing_result = 'Match'
-                    cards[choice_one_int] = '---'
-                    cards[choice_two_int] = '---'
-                else:
-                    fail += 1
-                    pairing_result = 'No_Match'
-            else:
-                fail += 1
-                pairing_result = 'No_Match'
-            
-            # Update game statistics.
-            attempts += 1
-            history += '[' + str(game.total_attempts) + ']'
-            history += str(choice_one_int) + ':'
-            history += str(card_one) + '~'
-            history += str(choice_two_int) + ':'
-            history += str(card_two) + '|'
-            history += str(pairing_result) + ' '
-            
-            joined_history = ''.join(history)
-            joined_cards = ','.join(cards)
-            game.available_cards = joined_cards
-            game.total_attempts = attempts
-            game.successful_attempts = success
-            game.failed_attempts = fail
-            game.move_history = joined_history
-            game.put()
+        return self._make_move_async(request).get_result()
 
-            form_output = str(choice_one_int) + ':' + card_one + ' ~ '
-            form_output += str(choice_two_int) + ':' + card_two
-            form_output += ' | ' + pairing_result
+    @ndb.tasklet
+    def _make_move_async(self, request):
+        key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
 
-            return game.to_form(form_output)
+        # Choices no board accepts are rejected from a cached read of the
+        # game, without the update. Finished games still say so, and games
+        # with every pair matched go on to the update that ends them.
+        error = _check_choices(request.first_choice, request.second_choice)
+        if error:
+            game = yield gamecache.get_async(key)
+            if not game:
+                raise endpoints.NotFoundException('Game not found!')
+            if game.game_over:
+                form = yield to_form_async(game, GAME_OVER_MESSAGE)
+                raise ndb.Return(form)
+            if game.successful_attempts < 26:
+                profiling.increment('make_move', 'illegal_moves')
+                form = yield to_form_async(game, error)
+                raise ndb.Return(form)
+
+        game, outcome = yield gamecache.update_async(
+            key, lambda game: _with_changed(_play_move(
+                game, request.first_choice, request.second_choice)))
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        message, moved = outcome
+        if message is not None and not moved:
+            profiling.increment('make_move', 'illegal_moves')
 
         # Update game statistics when player wins game.    
-        else:
-            game.game_over = True
-            game.end_game(won=True)
-            game.put()
-            return game.to_form('You win!')
+        if message is None:
+            ended = yield gamecache.end_game_async(game, won=True)
+            message = 'You win!' if ended else GAME_OVER_MESSAGE
+
+        form = yield to_form_async(game, message)
+        raise ndb.Return(form)
             
     
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MoveResultForms,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @profiling.instrumented
+    def make_moves(self, request):
+        """Plays a list of card choice pairs in order and returns each
+           move's outcome with the final game state"""
+        return self._make_moves_async(request).get_result()
+
+    @ndb.tasklet
+    def _make_moves_async(self, request):
+        if len(request.moves) > MAX_MOVES_PER_REQUEST:
+            raise endpoints.BadRequestException(
+                'No more than {} moves can be made at once!'.format(
+                    MAX_MOVES_PER_REQUEST))
+
+        # Every move is evaluated in memory and the game is stored once.
+        key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        game, results = yield gamecache.update_async(
+            key, lambda game: _play_moves(game, request.moves))
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        illegal = sum(1 for result in results if not result.valid)
+        if illegal:
+            profiling.increment('make_moves', 'illegal_moves', illegal)
+
+        # Ends the game as soon as every pair has been matched.
+        message = results[-1].message if results else ''
+        if not game.game_over and game.successful_attempts >= 26:
+            ended = yield gamecache.end_game_async(game, won=True)
+            if ended:
+                message = 'You win!'
+                results.append(MoveResultForm(message=message, valid=True))
+            else:
+                message = GAME_OVER_MESSAGE
+        form = yield to_form_async(game, message)
+        raise ndb.Return(MoveResultForms(game=form, results=results))
+
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=GameForm,
                       path='game/history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @profiling.instrumented
     def get_game_history(self, request):
-        """Return a specified games move history"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Return a page of a specified games move history"""
+        return self._get_game_history_async(request).get_result()
+
+    @ndb.tasklet
+    def _get_game_history_async(self, request):
+        game = yield gamecache.get_async(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game))
 
+        # Only the requested page of the move log is decoded.
+        page = max(request.page or 0, 0)
+        page_size = get_page_size(request.page_size, HISTORY_PAGE_SIZE,
+                                  MAX_HISTORY_PAGE_SIZE)
         if game:
-            return game.to_form(game.move_history)
+            # Archived games keep their moves in their archive.
+            game = yield archive.rehydrate_async(game)
+            history = yield game.history_page_async(page, page_size)
+            form = yield to_form_async(game, history)
+            raise ndb.Return(form)
         else:
             raise endpoints.NotFoundException('Game not Found!')
-        
-    @endpoints.method(response_message=ScoreForms,
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @profiling.instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of all scores"""
+        return self._get_scores_async(request).get_result()
 
-    @endpoints.method(request_message=USER_NAME_REQUEST,
+    @ndb.tasklet
+    def _get_scores_async(self, request):
+        scores, next_cursor = yield fetch_page_async(
+            Score.query(), get_page_size(request.page_size), request.cursor)
+        forms = yield to_forms_async(scores)
+        raise ndb.Return(ScoreForms(items=forms, next_cursor=next_cursor))
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @profiling.instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        
+        """Returns a page of an individual User's scores"""
+        return self._get_user_scores_async(request).get_result()
+
+    @ndb.tasklet
+    def _get_user_scores_async(self, request):
         # Checks if the user specified exists then retrieves their scores.
-        if not user:
-            raise endpoints.NotFoundException('A User with that name does not exist!')
-        scores = Score.query(Score.user==user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        # Users are keyed by name, so the scores query starts alongside the
+        # user lookup and is only made again for a user that has not been
+        # migrated to its name key.
+        key = _user_key(request.user_name)
+        page_size = get_page_size(request.page_size)
+        user, (scores, next_cursor) = yield (
+            _get_user_async(request.user_name),
+            fetch_page_async(Score.query(Score.user == key), page_size,
+                             request.cursor))
+        if user.key != key:
+            scores, next_cursor = yield fetch_page_async(
+                Score.query(Score.user == user.key), page_size,
+                request.cursor)
+        forms = yield to_forms_async(scores)
+        raise ndb.Return(ScoreForms(items=forms, next_cursor=next_cursor))
 
     @endpoints.method(request_message=NUMBER_OF_RESULTS_REQUEST,
                       response_message=ScoreForms,
                       path='scores/high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @profiling.instrumented
     def get_high_scores(self, request):
-        """Return a specified number of high scores"""
-        # Checks the value of number_of_results to determine if it is a number
-        # to return a specific number of highscores if it is not then function
-        # will only return 10 highscores
-        if isinstance(request.number_of_results, int):
-            _number_of_results = request.number_of_results
-            scores = Score.query(Score.won==True).order(Score.total_attempts).fetch(limit=_number_of_results)
-            return ScoreForms(items=[score.to_form() for score in scores])
-        else:
-            scores = Score.query(Score.won==True).order(Score.total_attempts).fetch(limit=10)
-            return ScoreForms(items=[score.to_form() for score in scores])
+        """Return a specified number of high scores, of a room's games if a
+           room is given"""
+        return self._get_high_scores_async(request).get_result()
+
+    @ndb.tasklet
+    def _get_high_scores_async(self, request):
+        # number_of_results is the page size, if it is not given only
+        # 10 highscores are returned per page. High scores are served from
+        # the top scores leaderboard.
+        room = yield _get_room_key_async(request.room)
+        entries, next_cursor = yield leaderboard.get_page_async(
+            Room.scoped(leaderboard.HIGH_SCORES, room),
+            get_page_size(request.number_of_results, default=10),
+            request.cursor)
+        raise ndb.Return(ScoreForms(items=[ScoreForm(won=True, **entry)
+                                           for entry in _form_fields(entries)],
+                                    next_cursor=next_cursor))
 
     @endpoints.method(request_message=NUMBER_OF_RESULTS_REQUEST,
                       response_message=RecordForms,
                       path='scores/ranks',
                       name='get_user_rankings',
                       http_method='GET')
+    @profiling.instrumented
     def get_user_rankings(self, request):
-        """Get user rankings"""
-        if isinstance(request.number_of_results, int):
-            _number_of_results = request.number_of_results
-            records = Record.query().order(Record.wins).fetch(limit=_number_of_results)
-            return RecordForms(items=[record.to_form() for record in records])
+        """Get a page of user rankings, most wins first, within a room if a
+           room is given"""
+        return self._get_user_rankings_async(request).get_result()
+
+    @ndb.tasklet
+    def _get_user_rankings_async(self, request):
+        room = yield _get_room_key_async(request.room)
+        entries, next_cursor = yield leaderboard.get_page_async(
+            Room.scoped(leaderboard.RANKINGS, room),
+            get_page_size(request.number_of_results), request.cursor)
+        raise ndb.Return(RecordForms(items=[RecordForm(**entry)
+                                            for entry in _form_fields(entries)],
+                                     next_cursor=next_cursor))
+
+    @endpoints.method(request_message=USER_RANK_REQUEST,
+                      response_message=RankForm,
+                      path='scores/ranks/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @profiling.instrumented
+    def get_user_rank(self, request):
+        """Get a users win ranking, within a room if a room is given"""
+        return self._get_user_rank_async(request).get_result()
+
+    @ndb.tasklet
+    def _get_user_rank_async(self, request):
+        # The record and the rankings are read alongside the user lookup,
+        # see get_user_scores.
+        key = _user_key(request.user_name)
+        if request.room:
+            user, room = yield (_get_user_async(request.user_name),
+                                _get_room_key_async(request.room))
+            record, entries = yield (
+                RoomRecord.key_for(user.key, room).get_async(),
+                leaderboard.get_entries_async(
+                    Room.scoped(leaderboard.RANKINGS, room)))
         else:
-            records = Record.query().order(Record.wins)
-            return RecordForms(items=[record.to_form() for record in records])
+            user, record, entries = yield (
+                _get_user_async(request.user_name),
+                Record.get_for_user_async(key),
+                leaderboard.get_entries_async(leaderboard.RANKINGS))
+            if user.key != key:
+                record = yield Record.get_for_user_async(user.key)
+        if not record:
+            raise endpoints.NotFoundException('No record was found for that User!')
+        rank = yield leaderboard.get_rank_async(record, entries)
+        raise ndb.Return(RankForm(user_name=user.name,
+                                  rank=rank,
+                                  wins=record.wins,
+                                  loses=record.loses))
+
+    @endpoints.method(request_message=USER_NAME_REQUEST,
+                      response_message=StatsForm,
+                      path='stats/{user_name}',
+                      name='get_user_stats',
+                      http_method='GET')
+    @profiling.instrumented
+    def get_user_stats(self, request):
+        """Get a users game statistics"""
+        return self._get_user_stats_async(request).get_result()
+
+    @ndb.tasklet
+    def _get_user_stats_async(self, request):
+        # The statistics are read alongside the user lookup, see
+        # get_user_scores.
+        key = _user_key(request.user_name)
+        user, user_stats = yield (_get_user_async(request.user_name),
+                                  stats.get_user_stats_async(key))
+        if user.key != key:
+            user_stats = yield stats.get_user_stats_async(user.key)
+        user_stats = user_stats or stats.UserStats()
+        raise ndb.Return(user_stats.to_form(user.name))
 
+    @endpoints.method(response_message=StatsForm,
+                      path='stats',
+                      name='get_global_stats',
+                      http_method='GET')
+    @profiling.instrumented
+    def get_global_stats(self, request):
+        """Get the statistics of every game"""
+        return self._get_global_stats_async(request).get_result()
 
-    @endpoints.method(response_message=StringMessage,
+    @ndb.tasklet
+    def _get_global_stats_async(self, request):
+        global_stats = yield stats.get_global_stats_async()
+        raise ndb.Return(global_stats.to_form())
+
+    @endpoints.method(request_message=ROOM_REQUEST,
+                      response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts',
                       http_method='GET')
+    @profiling.instrumented
     def get_average_attempts(self, request):
-        """Get the cached average moves"""
-        return StringMessage(message=memcache\
-                             .get(MEMCACHE_AVERAGE_MOVES) or '')
-
-    @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves in games"""
-        games = Game.query(Game.game_over == True).fetch()
-
-        # Calculates the average by counting all inactive games
-        # adding the sum of total_attempts in those inactive games
-        # then dividing the sum_of_attempts by the count of inactive games
-        # finally returning the result
-        if games:
-            count = len(games)
-            sum_of_attempts = sum([game.total_attempts for game in games])
-            average = float(sum_of_attempts)/count
-            memcache.set(MEMCACHE_AVERAGE_MOVES,
-                         'The average amount of moves per game is {:.2f}'.format(average))
-
-
-api = endpoints.api_server([ConcentrationApi])
\ No newline at end of file
+        """Get the average moves of finished games, of a room's games if a
+           room is given"""
+        return self._get_average_attempts_async(request).get_result()
+
+    @ndb.tasklet
+    def _get_average_attempts_async(self, request):
+        # The count and sum of total_attempts of every finished game are
+        # kept in a sharded aggregate that Game.end_game updates.
+        room = yield _get_room_key_async(request.room)
+        count, total = yield counters.get_async(
+            Room.scoped(counters.GAME_ATTEMPTS, room))
+        if not count:
+            raise ndb.Return(StringMessage(message=''))
+        average = float(total)/count
+        raise ndb.Return(StringMessage(message='The average amount of moves '
+                                       'per game is {:.2f}'.format(average)))
+
+
+api = endpoints.api_server([ConcentrationApi])
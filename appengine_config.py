@@ -0,0 +1,10 @@
+"""appengine_config.py - This file adds the third party libraries installed
+into lib/ to the import path. Install them before deploying with:
+
+    pip install -t lib -r requirements.txt"""
+
+import os
+from google.appengine.ext import vendor
+
+if os.path.isdir(os.path.join(os.path.dirname(__file__), 'lib')):
+    vendor.add('lib')
@@ -0,0 +1,166 @@
+"""archive.py - This file contains the cold storage of finished games.
+
+Games that ended more than ARCHIVE_AFTER ago are moved in batches into
+GameArchive entities, each holding many games as length prefixed entity
+protocol buffers compressed together with zlib. The Game is left as a small
+stub that keeps its owner, name and attempt counts, so scores, statistics,
+queries and get_game work from the stub, and points to its archive and its
+position in it. rehydrate reads archived games back in full when their move
+history or board is needed."""
+
+import struct
+import zlib
+from datetime import datetime, timedelta
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+import gamecache
+import models
+
+
+ARCHIVE_AFTER = timedelta(days=7)
+ARCHIVE_BATCH_SIZE = 500
+# Games are added to an archive until their encoded size reaches this, so
+# the compressed archive stays well below the entity size limit.
+MAX_ARCHIVE_BYTES = 800000
+
+_LENGTH = struct.Struct('>I')
+_adapter = ndb.ModelAdapter()
+
+
+class GameArchive(ndb.Model):
+    """A compressed batch of finished games"""
+    games = ndb.BlobProperty(required=True)
+    count = ndb.IntegerProperty(required=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+def pack_games(games):
+    """Returns the zlib compressed encoding of a list of games"""
+    records = []
+    for game in games:
+        encoded = _adapter.entity_to_pb(game).Encode()
+        records.append(_LENGTH.pack(len(encoded)))
+        records.append(encoded)
+    return zlib.compress(''.join(records))
+
+
+def unpack_games(blob):
+    """Returns the list of games encoded by pack_games"""
+    data = zlib.decompress(blob)
+    games = []
+    offset = 0
+    while offset < len(data):
+        length, = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        games.append(_adapter.pb_to_entity(
+            entity_pb.EntityProto(data[offset:offset + length])))
+        offset += length
+    return games
+
+
+def _stub(game, archive_key, index):
+    """Drops everything but the summary of an archived game"""
+    game.archived = True
+    game.archive = archive_key
+    game.archive_index = index
+    game.cards = ''
+    game.available_cards = ''
+    game.move_history = ''
+    game.board = None
+    game.move_log = None
+    game.move_chunks = []
+    game.deck_seed = None
+
+
+def _write_archive(games):
+    """Packs games into one GameArchive and replaces them with stubs"""
+    # The archive is written before the stubs, so a failure part way leaves
+    # the games whole.
+    archive = GameArchive(games=pack_games(games), count=len(games))
+    archive.put()
+    for index, game in enumerate(games):
+        _stub(game, archive.key, index)
+    ndb.put_multi(games)
+    gamecache.evict([game.key for game in games])
+
+
+def archive_games(games):
+    """Archives finished games into as many GameArchive entities as their
+       size needs and replaces them with stubs
+    Returns:
+        The number of games archived."""
+    games = [game for game in games if game.game_over and not game.archived]
+    # The sealed move chunks are folded back into the archived games and
+    # deleted once every archive is written.
+    logs = [future.get_result() for future in
+            [game.packed_log_async() for game in games]]
+    chunks = []
+    for game, log in zip(games, logs):
+        chunks.extend(ndb.Key(models.MoveChunk, chunk_id, parent=game.key)
+                      for chunk_id in game.move_chunks)
+        game.move_log = log or None
+        game.move_chunks = []
+    batch = []
+    size = 0
+    for game in games:
+        encoded_size = len(_adapter.entity_to_pb(game).Encode())
+        if batch and size + encoded_size > MAX_ARCHIVE_BYTES:
+            _write_archive(batch)
+            batch = []
+            size = 0
+        batch.append(game)
+        size += encoded_size
+    if batch:
+        _write_archive(batch)
+    ndb.delete_multi(chunks)
+    return len(games)
+
+
+def archive_batch(cursor=None, legacy=False):
+    """Archives one batch of finished games
+    Args:
+        cursor: The datastore Cursor the batch starts from
+        legacy: Walk every finished game instead of those that ended more
+            than ARCHIVE_AFTER ago, to archive games that ended before end
+            times were recorded
+    Returns:
+        The number of games archived and the Cursor of the next batch, or
+        None when there are no more games to look at."""
+    Game = models.Game
+    if legacy:
+        query = Game.query(Game.game_over == True)
+    else:
+        query = Game.query(Game.archived == False,
+                           Game.ended < datetime.now() - ARCHIVE_AFTER)
+    games, next_cursor, more = query.fetch_page(ARCHIVE_BATCH_SIZE,
+                                                start_cursor=cursor)
+    archived = archive_games(games) if games else 0
+    return archived, (next_cursor if more and next_cursor else None)
+
+
+@ndb.tasklet
+def rehydrate_multi_async(games):
+    """Returns a Future for a list of games with archived games replaced by
+       their full archived copies. Each archive is read once."""
+    keys = list(set(game.archive for game in games
+                    if game and game.archived))
+    if not keys:
+        raise ndb.Return(games)
+    archives = yield ndb.get_multi_async(keys)
+    unpacked = dict((key, unpack_games(archive.games))
+                    for key, archive in zip(keys, archives) if archive)
+    raise ndb.Return([unpacked[game.archive][game.archive_index]
+                      if game and game.archived and game.archive in unpacked
+                      else game for game in games])
+
+
+@ndb.tasklet
+def rehydrate_async(game):
+    """Returns a Future for the full copy of a game"""
+    games = yield rehydrate_multi_async([game])
+    raise ndb.Return(games[0])
+
+
+def rehydrate(game):
+    """Returns the full copy of a game"""
+    return rehydrate_async(game).get_result()
@@ -0,0 +1,139 @@
+"""batchboard.py - This file contains a NumPy engine that plays many games at
+once for analytics and difficulty tuning.
+
+B games are held as a (B, 52) int8 matrix of card codes, using the card
+codes of board.py, and a (B, 52) boolean matrix of matched positions. A
+(B, 2) array of moves is evaluated for every game in one vectorized step
+with the same rule as make_move: two cards are a pair when they share a rank
+and a suit color."""
+
+import numpy as np
+
+import decks
+from board import DECK_SIZE, Board, pair_key
+
+
+# Pair key of every card code, see board.pair_key.
+PAIR_KEYS = np.array([pair_key(code) for code in range(DECK_SIZE)],
+                     dtype=np.int8)
+
+
+class BatchBoard(object):
+    """A batch of dealt games with their matched positions and statistics"""
+    def __init__(self, decks, matched=None):
+        self.decks = np.asarray(decks, dtype=np.int8)
+        self.size = len(self.decks)
+        if matched is None:
+            matched = np.zeros(self.decks.shape, dtype=bool)
+        self.matched = np.asarray(matched, dtype=bool)
+        self.rows = np.arange(self.size)
+        self.total_attempts = np.zeros(self.size, dtype=np.int32)
+        self.successful_attempts = np.zeros(self.size, dtype=np.int32)
+        self.failed_attempts = np.zeros(self.size, dtype=np.int32)
+
+    @classmethod
+    def deal(cls, size, rng=np.random):
+        """Deals size games with shuffled decks"""
+        shuffled = np.argsort(rng.rand(size, DECK_SIZE), axis=1)
+        return cls(shuffled.astype(np.int8))
+
+    @classmethod
+    def from_seeds(cls, seeds):
+        """Deals a game from each seed with decks.deal, the decks the API
+           deals games with the same seeds"""
+        return cls(np.array([list(decks.deal(seed)) for seed in seeds],
+                            dtype=np.int8))
+
+    @classmethod
+    def from_boards(cls, boards):
+        """Builds a batch from a list of board.Board objects"""
+        decks = np.array([list(board.deck) for board in boards],
+                         dtype=np.int8)
+        matched = np.array([[board.is_matched(position)
+                             for position in range(DECK_SIZE)]
+                            for board in boards], dtype=bool)
+        return cls(decks, matched)
+
+    def to_boards(self):
+        """Returns the games as a list of board.Board objects"""
+        weights = 1 << np.arange(DECK_SIZE, dtype=np.uint64)
+        masks = (self.matched.astype(np.uint64) * weights).sum(axis=1)
+        return [Board(bytearray(deck.astype(np.uint8)), int(mask))
+                for deck, mask in zip(self.decks, masks)]
+
+    @property
+    def complete(self):
+        """A (B,) boolean array of the games where every pair is matched"""
+        return self.matched.all(axis=1)
+
+    def apply(self, moves):
+        """Plays one (first, second) move in every game
+        Args:
+            moves: A (B, 2) integer array of card positions
+        Returns:
+            A (B,) boolean array of the moves that were played, moves on
+            complete games, out of range, identical or already matched
+            positions are skipped, and a (B,) boolean array of the moves
+            that matched a pair."""
+        moves = np.asarray(moves)
+        first = moves[:, 0]
+        second = moves[:, 1]
+        valid = ((first >= 0) & (first < DECK_SIZE) &
+                 (second >= 0) & (second < DECK_SIZE) &
+                 (first != second) & ~self.complete)
+        first = np.where(valid, first, 0)
+        second = np.where(valid, second, 1)
+        valid &= ~self.matched[self.rows, first]
+        valid &= ~self.matched[self.rows, second]
+
+        pairs = valid & (PAIR_KEYS[self.decks[self.rows, first]] ==
+                         PAIR_KEYS[self.decks[self.rows, second]])
+        self.matched[self.rows[pairs], first[pairs]] = True
+        self.matched[self.rows[pairs], second[pairs]] = True
+        self.total_attempts += valid
+        self.successful_attempts += pairs
+        self.failed_attempts += valid & ~pairs
+        return valid, pairs
+
+    def random_moves(self, rng=np.random):
+        """Returns a (B, 2) array of two random unmatched positions per game,
+           complete games get an arbitrary move that apply skips"""
+        unmatched = ~self.matched
+        counts = unmatched.sum(axis=1)
+        # Picks the n-th and m-th unmatched positions with n != m, then finds
+        # them by counting unmatched positions along each row.
+        nth = (rng.rand(self.size) * counts).astype(np.int32)
+        mth = (rng.rand(self.size) * np.maximum(counts - 1, 1)).astype(np.int32)
+        mth += mth >= nth
+        seen = np.cumsum(unmatched, axis=1)
+        first = (seen <= nth[:, None]).sum(axis=1)
+        second = (seen <= mth[:, None]).sum(axis=1)
+        return np.minimum(np.column_stack((first, second)), DECK_SIZE - 1)
+
+    def take(self, rows):
+        """Returns a new batch of the games at a list of row indexes"""
+        batch = BatchBoard(self.decks[rows], self.matched[rows])
+        batch.total_attempts = self.total_attempts[rows]
+        batch.successful_attempts = self.successful_attempts[rows]
+        batch.failed_attempts = self.failed_attempts[rows]
+        return batch
+
+
+def simulate_random(size, rng=np.random, max_moves=10000, compact_every=16):
+    """Plays size games with random unmatched moves until every game is
+       complete and returns the total_attempts of each game. Finished games
+       are dropped from the batch every compact_every moves."""
+    batch = BatchBoard.deal(size, rng)
+    attempts = np.zeros(size, dtype=np.int32)
+    games = np.arange(size)
+    for move in range(max_moves):
+        if move % compact_every == 0:
+            complete = batch.complete
+            attempts[games[complete]] = batch.total_attempts[complete]
+            if complete.all():
+                return attempts
+            batch = batch.take(np.flatnonzero(~complete))
+            games = games[~complete]
+        batch.apply(batch.random_moves(rng))
+    attempts[games] = batch.total_attempts
+    return attempts
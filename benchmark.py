@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""benchmark.py - This file contains the offline benchmark of the game logic.
+
+Runs simulated games and reports games/sec, moves/sec, per-move latency
+percentiles and allocations of the move hot path (pair evaluation and the
+move log record), along with the distribution of total_attempts the
+strategy finishes games with.
+
+    python benchmark.py --games 100000 --strategy perfect --json"""
+
+import argparse
+import json
+import random
+import sys
+from timeit import default_timer
+
+import jobs
+import movelog
+import simulator
+from board import DECK_SIZE, Board, shuffled_deck
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def percentile(values, fraction):
+    """Returns the value at a fraction of a sorted list"""
+    if not values:
+        return None
+    index = min(int(fraction * len(values)), len(values) - 1)
+    return values[index]
+
+
+def summarize(values):
+    values = sorted(values)
+    return {'min': values[0] if values else None,
+            'p50': percentile(values, 0.5),
+            'p90': percentile(values, 0.9),
+            'p99': percentile(values, 0.99),
+            'max': values[-1] if values else None,
+            'mean': float(sum(values)) / len(values) if values else None}
+
+
+def bench_games(strategy, games, seed):
+    """Times whole simulated games"""
+    start = default_timer()
+    attempts = simulator.simulate(strategy, games, seed)
+    elapsed = default_timer() - start
+    moves = sum(attempts)
+    return {'games': games,
+            'moves': moves,
+            'seconds': elapsed,
+            'games_per_sec': games / elapsed,
+            'moves_per_sec': moves / elapsed,
+            'total_attempts': summarize(attempts)}
+
+
+def _random_moves(rng, count):
+    moves = []
+    for _ in range(count):
+        first, second = rng.sample(range(DECK_SIZE), 2)
+        moves.append((first, second))
+    return moves
+
+
+def bench_moves(moves, seed):
+    """Times the move hot path one move at a time, the work make_move does
+       between loading and storing a game"""
+    rng = random.Random(seed)
+    board = Board(shuffled_deck(rng))
+    latencies = []
+    for attempt, (first, second) in enumerate(_random_moves(rng, moves)):
+        board.matched = 0
+        start = default_timer()
+        matched = board.flip(first, second)
+        movelog.pack_move(attempt, first, second,
+                          board.deck[first], board.deck[second], matched)
+        board.to_bytes()
+        latencies.append((default_timer() - start) * 1e6)
+    result = summarize(latencies)
+    result['unit'] = 'microseconds'
+    return result
+
+
+def bench_allocations(moves, seed):
+    """Measures the memory allocated by the move hot path"""
+    if tracemalloc is None:
+        return None
+    rng = random.Random(seed)
+    board = Board(shuffled_deck(rng))
+    played = _random_moves(rng, moves)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for attempt, (first, second) in enumerate(played):
+        board.matched = 0
+        matched = board.flip(first, second)
+        movelog.pack_move(attempt, first, second,
+                          board.deck[first], board.deck[second], matched)
+        board.to_bytes()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in
+                    after.compare_to(before, 'filename') if stat.size_diff > 0)
+    return {'retained_bytes': allocated, 'peak_bytes': peak,
+            'moves': moves}
+
+
+def bench_batch(games, seed):
+    """Times random games played together by the NumPy batch engine"""
+    import numpy as np
+    import batchboard
+    start = default_timer()
+    attempts = batchboard.simulate_random(games, np.random.RandomState(seed))
+    elapsed = default_timer() - start
+    moves = int(attempts.sum())
+    return {'games': games,
+            'moves': moves,
+            'seconds': elapsed,
+            'games_per_sec': games / elapsed,
+            'moves_per_sec': moves / elapsed,
+            'total_attempts': summarize(attempts.tolist())}
+
+
+def bench_jobs(events, seconds, window, seed):
+    """Counts the tasks queued when events spread over a number of seconds
+       each trigger a job coalesced per window, against one task per event,
+       on a jobs.LocalExecutor with a simulated clock"""
+    rng = random.Random(seed)
+    clock = [0.0]
+    executor = jobs.LocalExecutor(lambda: clock[0])
+    previous = jobs.set_executor(executor)
+    ran = []
+    try:
+        for when in sorted(rng.uniform(0, seconds) for _ in range(events)):
+            clock[0] = when
+            executor.run_due(lambda url, params: ran.append(url))
+            jobs.coalesce('bench', '/tasks/bench', window=window,
+                          transactional=True)
+        clock[0] = seconds + window
+        executor.run_due(lambda url, params: ran.append(url))
+    finally:
+        jobs.set_executor(previous)
+    return {'events': events,
+            'seconds': seconds,
+            'window': window,
+            'tasks_uncoalesced': events,
+            'tasks_queued': executor.queued,
+            'jobs_run': len(ran),
+            'reduction': float(events) / max(executor.queued, 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--moves', type=int, default=100000,
+                        help='moves timed individually for latencies')
+    parser.add_argument('--strategy', default='perfect',
+                        choices=sorted(simulator.STRATEGIES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch', type=int, default=0,
+                        help='random games to play with the NumPy engine')
+    parser.add_argument('--job-events', type=int, default=0,
+                        help='job triggers to coalesce on a local executor')
+    parser.add_argument('--job-seconds', type=float, default=3600)
+    parser.add_argument('--job-window', type=float, default=5)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    results = {'strategy': args.strategy,
+               'python': sys.version.split()[0],
+               'games': bench_games(args.strategy, args.games, args.seed),
+               'move_latency': bench_moves(args.moves, args.seed),
+               'allocations': bench_allocations(args.moves, args.seed)}
+    if args.batch:
+        results['batch'] = bench_batch(args.batch, args.seed)
+    if args.job_events:
+        results['jobs'] = bench_jobs(args.job_events, args.job_seconds,
+                                     args.job_window, args.seed)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    games = results['games']
+    print('{} strategy, {} games, {} moves in {:.2f}s'.format(
+        args.strategy, games['games'], games['moves'], games['seconds']))
+    print('{:.0f} games/sec, {:.0f} moves/sec'.format(
+        games['games_per_sec'], games['moves_per_sec']))
+    print('total_attempts min {min} p50 {p50} p90 {p90} p99 {p99} '
+          'max {max} mean {mean:.2f}'.format(**games['total_attempts']))
+    print('move latency (us) p50 {p50:.2f} p90 {p90:.2f} p99 {p99:.2f} '
+          'max {max:.2f}'.format(**results['move_latency']))
+    if results['allocations']:
+        print('allocations over {moves} moves: {retained_bytes} bytes '
+              'retained, {peak_bytes} bytes peak'.format(
+                  **results['allocations']))
+    if args.batch:
+        batch = results['batch']
+        print('numpy batch of {} random games: {:.0f} games/sec, '
+              '{:.0f} moves/sec, mean total_attempts {:.2f}'.format(
+                  batch['games'], batch['games_per_sec'],
+                  batch['moves_per_sec'], batch['total_attempts']['mean']))
+    if args.job_events:
+        print('{events} job triggers over {seconds:.0f}s with a {window:.0f}s '
+              'window: {tasks_queued} tasks instead of {tasks_uncoalesced}, '
+              '{reduction:.1f}x fewer'.format(**results['jobs']))
+
+
+if __name__ == '__main__':
+    main()
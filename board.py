@@ -0,0 +1,114 @@
+"""board.py - This file contains the packed card board used by the Game.
+
+A board is stored as 52 one byte card codes followed by a 64 bit bitmask of
+the matched card positions. Card codes number the deck in the order the
+original game built it, suite by suite, so a card code is
+(suite index * 13) + rank index."""
+
+import random
+import struct
+
+
+RANKS = ('_A', '_2', '_3', '_4', '_5', '_6', '_7',
+         '_8', '_9', '10', '_J', '_Q', '_K')
+SUITES = ('H', 'D', 'C', 'S')
+CARD_COLORS = {'H': 'R', 'D': 'R', 'C': 'B', 'S': 'B'}
+
+DECK_SIZE = len(RANKS) * len(SUITES)
+PAIRS = DECK_SIZE // 2
+FULL_MASK = (1 << DECK_SIZE) - 1
+MATCHED_LABEL = '---'
+
+# Card code to card notation e.g. 0 -> '_AH', 51 -> '_KS'.
+CARD_LABELS = tuple(rank + suite for suite in SUITES for rank in RANKS)
+CARD_CODES = dict((label, code) for code, label in enumerate(CARD_LABELS))
+
+# Two cards are a pair when they share a rank and a suite color, so every
+# card code is mapped to a single (rank, color) pair key up front.
+_PAIR_KEYS = tuple(
+    (code % len(RANKS)) * 2 +
+    (CARD_COLORS[SUITES[code // len(RANKS)]] == 'B')
+    for code in range(DECK_SIZE))
+_POSITION_BITS = tuple(1 << position for position in range(DECK_SIZE))
+_MASK = struct.Struct('>Q')
+
+BOARD_SIZE = DECK_SIZE + _MASK.size
+
+
+def unpack_matched(blob):
+    """Returns the matched positions of a board stored by to_bytes or
+       mask_bytes without unpacking its deck"""
+    return _MASK.unpack_from(blob, len(blob) - _MASK.size)[0]
+
+
+def pair_key(code):
+    """Returns a number shared only by the two card codes that are a pair"""
+    return _PAIR_KEYS[code]
+
+
+def shuffled_deck(rng=random):
+    """Returns a bytearray of the 52 card codes in random order"""
+    deck = bytearray(range(DECK_SIZE))
+    rng.shuffle(deck)
+    return deck
+
+
+class Board(object):
+    """A dealt deck and the positions that have already been matched"""
+    __slots__ = ('deck', 'matched')
+
+    def __init__(self, deck, matched=0):
+        self.deck = deck
+        self.matched = matched
+
+    @classmethod
+    def from_bytes(cls, blob):
+        """Unpacks a board stored by to_bytes"""
+        return cls(bytearray(blob[:DECK_SIZE]),
+                   _MASK.unpack_from(blob, DECK_SIZE)[0])
+
+    @classmethod
+    def from_strings(cls, cards, available_cards):
+        """Builds a board from the comma separated card strings that games
+           were stored with before boards were packed."""
+        deck = bytearray(CARD_CODES[label] for label in cards.split(','))
+        matched = 0
+        for position, label in enumerate(available_cards.split(',')):
+            if label == MATCHED_LABEL:
+                matched |= _POSITION_BITS[position]
+        return cls(deck, matched)
+
+    @classmethod
+    def from_mask(cls, deck, blob):
+        """Unpacks a board stored by mask_bytes onto its dealt deck"""
+        return cls(deck, _MASK.unpack(blob)[0])
+
+    def to_bytes(self):
+        """Packs the board into BOARD_SIZE bytes"""
+        return bytes(self.deck) + _MASK.pack(self.matched)
+
+    def mask_bytes(self):
+        """Packs only the matched positions, for boards whose deck can be
+           dealt again"""
+        return _MASK.pack(self.matched)
+
+    def label(self, position):
+        """Returns the card notation of the card at a position"""
+        return CARD_LABELS[self.deck[position]]
+
+    def is_matched(self, position):
+        """Checks if the card at a position has already been matched"""
+        return bool(self.matched & _POSITION_BITS[position])
+
+    def flip(self, first, second):
+        """Evaluates a pair of positions, marking both as matched and
+           returning True if the cards are a pair."""
+        if _PAIR_KEYS[self.deck[first]] == _PAIR_KEYS[self.deck[second]]:
+            self.matched |= _POSITION_BITS[first] | _POSITION_BITS[second]
+            return True
+        return False
+
+    @property
+    def complete(self):
+        """True once every card on the board has been matched"""
+        return self.matched == FULL_MASK
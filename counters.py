@@ -0,0 +1,118 @@
+"""counters.py - This file contains sharded aggregate counters.
+
+A named aggregate keeps a count and a running total spread over NUM_SHARDS
+shard entities so that concurrent updates rarely write the same entity
+group. Reads sum the shards, which are fetched by key, and the shards are
+kept in memcache. An update raises its shard's cached values once it
+commits, and as shard counts only grow, values a later update or a read has
+cached already are kept. A read claims the cache before fetching the shards
+and caches them with a cas, and an update that finds a claim drops it, so
+shards read before an update commits are never cached after it."""
+
+import random
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+NUM_SHARDS = 20
+MEMCACHE_SHARDS = 'AGGREGATE:'
+MEMCACHE_EXPIRY = 600
+CAS_ATTEMPTS = 3
+# Held in place of the shards while a read fetches them.
+MEMCACHE_CLAIM = 'CLAIMED'
+MEMCACHE_CLAIM_EXPIRY = 10
+
+# Aggregate of total_attempts over every finished game.
+GAME_ATTEMPTS = 'game_attempts'
+
+
+class AggregateShard(ndb.Model):
+    """One shard of a named count and total, cached by the aggregate"""
+    _use_memcache = False
+
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    total = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+def _shard_key(name, index):
+    return ndb.Key(AggregateShard, '{}:{}'.format(name, index))
+
+
+def _shard_keys(name):
+    return [_shard_key(name, index) for index in range(NUM_SHARDS)]
+
+
+def _cache_shard(name, index, shard):
+    """Raises the cached values of an aggregate's shard to a committed
+       shard's, unless they are as high already"""
+    client = memcache.Client()
+    cache_key = MEMCACHE_SHARDS + name
+    for _ in range(CAS_ATTEMPTS):
+        shards = client.gets(cache_key)
+        if shards is None:
+            return
+        if shards == MEMCACHE_CLAIM:
+            break
+        if shards[index][0] >= shard.count:
+            return
+        shards[index] = (shard.count, shard.total)
+        if client.cas(cache_key, shards, time=MEMCACHE_EXPIRY):
+            return
+    client.delete(cache_key)
+
+
+@ndb.tasklet
+def prepare_add_async(name, value, count=1):
+    """Adds value to the total and count to the count of an aggregate on a
+       randomly chosen shard and returns the shard. Must be called inside a
+       transaction that puts the returned shard, the cached shard is raised
+       once that transaction commits."""
+    index = random.randint(0, NUM_SHARDS - 1)
+    key = _shard_key(name, index)
+    shard = (yield key.get_async()) or AggregateShard(key=key)
+    shard.count += count
+    shard.total += value
+
+    # The shard is cached with its committed values rather than incremented,
+    # so a retried or reordered commit cannot count twice.
+    ndb.get_context().call_on_commit(
+        lambda: _cache_shard(name, index, shard))
+    raise ndb.Return(shard)
+
+
+@ndb.transactional
+def add(name, value, count=1):
+    """Adds value to the total and count to the count of an aggregate"""
+    prepare_add_async(name, value, count).get_result().put()
+
+
+@ndb.tasklet
+def get_async(name):
+    """Returns a Future for the (count, total) of an aggregate"""
+    context = ndb.get_context()
+    cache_key = MEMCACHE_SHARDS + name
+    shards = yield context.memcache_get(cache_key, for_cas=True)
+    if shards is None:
+        yield context.memcache_add(cache_key, MEMCACHE_CLAIM,
+                                   time=MEMCACHE_CLAIM_EXPIRY)
+        shards = yield context.memcache_get(cache_key, for_cas=True)
+    if isinstance(shards, list):
+        raise ndb.Return(tuple(map(sum, zip(*shards))))
+
+    claimed = shards == MEMCACHE_CLAIM
+    shards = [(shard.count, shard.total) if shard else (0, 0)
+              for shard in (yield ndb.get_multi_async(_shard_keys(name)))]
+    if claimed:
+        yield context.memcache_cas(cache_key, shards, time=MEMCACHE_EXPIRY)
+    raise ndb.Return(tuple(map(sum, zip(*shards))))
+
+
+def get(name):
+    """Returns the (count, total) of an aggregate"""
+    return get_async(name).get_result()
+
+
+def reset(name):
+    """Deletes every shard of an aggregate"""
+    ndb.delete_multi(_shard_keys(name))
+    memcache.delete(MEMCACHE_SHARDS + name)
@@ -0,0 +1,138 @@
+"""decks.py - This file contains the deck dealing service.
+
+Each game is dealt from a 64 bit seed with a stateless PRNG, splitmix64
+driving a Fisher-Yates shuffle of the canonical deck, so a game only needs
+to store its seed and any deal can be dealt again on demand to replay or
+audit a game. A pool of pre-dealt seeds and decks serves bursts of new
+games, and recently dealt decks are kept in a small in-process cache so
+that loading a board does not shuffle again on every move."""
+
+import random
+import threading
+from collections import OrderedDict, deque
+
+from board import DECK_SIZE, pair_key
+
+
+CANONICAL_DECK = bytes(bytearray(range(DECK_SIZE)))
+SEED_BITS = 63
+POOL_SIZE = 256
+DEAL_CACHE_SIZE = 1000
+
+_MASK64 = (1 << 64) - 1
+_seed_source = random.SystemRandom()
+
+
+def splitmix64(state):
+    """Advances a splitmix64 state, returning the new state and its
+       output"""
+    state = (state + 0x9E3779B97F4A7C15) & _MASK64
+    value = state
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return state, value ^ (value >> 31)
+
+
+def deal(seed):
+    """Returns the bytearray of card codes that a seed deals"""
+    deck = bytearray(CANONICAL_DECK)
+    state = seed
+    for index in range(DECK_SIZE - 1, 0, -1):
+        state, value = splitmix64(state)
+        other = (value * (index + 1)) >> 64
+        deck[index], deck[other] = deck[other], deck[index]
+    return deck
+
+
+def new_seed():
+    """Returns a random seed that fits an ndb IntegerProperty"""
+    return _seed_source.getrandbits(SEED_BITS)
+
+
+_deals = OrderedDict()
+_deals_lock = threading.Lock()
+
+
+def _remember_deal(seed, deck):
+    with _deals_lock:
+        _deals[seed] = bytes(deck)
+        while len(_deals) > DEAL_CACHE_SIZE:
+            _deals.popitem(last=False)
+
+
+def cached_deal(seed):
+    """Returns the deck a seed deals, from the in-process cache when it was
+       dealt recently"""
+    with _deals_lock:
+        deck = _deals.pop(seed, None)
+        if deck is not None:
+            _deals[seed] = deck
+            return bytearray(deck)
+    deck = deal(seed)
+    _remember_deal(seed, deck)
+    return deck
+
+
+class DeckPool(object):
+    """A pool of pre-dealt (seed, deck) pairs, refilled size deals at a time
+       once it runs out"""
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.deals = deque()
+        self.lock = threading.Lock()
+
+    def fill(self):
+        deals = [(seed, deal(seed))
+                 for seed in [new_seed() for _ in range(self.size)]]
+        with self.lock:
+            self.deals.extend(deals)
+
+    def take(self):
+        """Returns a fresh seed and the deck it deals"""
+        while True:
+            with self.lock:
+                if self.deals:
+                    seed, deck = self.deals.popleft()
+                    break
+            self.fill()
+        _remember_deal(seed, deck)
+        return seed, deck
+
+
+pool = DeckPool()
+
+
+def verify_moves(deck, moves):
+    """Replays moves on a dealt deck and checks them against the game rules
+    Args:
+        deck: The card codes the game was dealt
+        moves: Unpacked move records, see movelog.iter_all_moves
+    Returns:
+        A list of (move index, problem) tuples, empty if every move is
+        consistent with the deal, and the bitmask of matched positions the
+        moves leave."""
+    problems = []
+    matched = 0
+    first_attempt = None
+    for index, (attempt, first, second, card_one, card_two, result) in \
+            enumerate(moves):
+        if first_attempt is None:
+            first_attempt = attempt
+        if attempt != first_attempt + index:
+            problems.append((index, 'Attempt {} is out of order'.format(
+                attempt)))
+        if not (0 <= first < DECK_SIZE and 0 <= second < DECK_SIZE) or \
+                first == second:
+            problems.append((index, 'Invalid positions'))
+            continue
+        bits = (1 << first) | (1 << second)
+        if matched & bits:
+            problems.append((index, 'A matched position was played'))
+        if card_one != deck[first] or card_two != deck[second]:
+            problems.append((index, 'Cards differ from the deal'))
+        pair = pair_key(deck[first]) == pair_key(deck[second])
+        if bool(result) != pair:
+            problems.append((index, 'Result does not follow the rules'))
+        if pair:
+            matched |= bits
+    return problems, matched
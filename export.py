@@ -0,0 +1,234 @@
+"""export.py - This file contains the bulk export of scores, records and
+finished games to columnar files.
+
+Entities are streamed with cursor queries one batch at a time and every batch
+is written as one chunk of columns, so memory use is bounded by the batch
+size. Each export task writes one part file per table and queues the next
+part with its cursor. Parquet or Arrow IPC files are written when pyarrow is
+available, otherwise CSV."""
+
+import csv
+
+import movelog
+from board import CARD_LABELS
+from utils import get_user_names
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+BATCH_SIZE = 500
+BATCHES_PER_PART = 40
+
+# Columns and column types of every exported table.
+TABLES = {
+    'scores': (('score', 'string'), ('user', 'string'),
+               ('user_name', 'string'), ('date', 'date'),
+               ('successful_attempts', 'int'), ('failed_attempts', 'int'),
+               ('total_attempts', 'int'), ('won', 'bool'),
+               ('room', 'string')),
+    'records': (('user', 'string'), ('user_name', 'string'),
+                ('wins', 'int'), ('loses', 'int')),
+    'games': (('game', 'string'), ('user', 'string'),
+              ('user_name', 'string'), ('successful_attempts', 'int'),
+              ('failed_attempts', 'int'), ('total_attempts', 'int'),
+              ('deck_seed', 'int'), ('room', 'string')),
+    'moves': (('game', 'string'), ('attempt', 'int'),
+              ('first_choice', 'int'), ('second_choice', 'int'),
+              ('first_card', 'string'), ('second_card', 'string'),
+              ('match', 'bool')),
+}
+
+
+class CsvWriter(object):
+    """Writes chunks of columns as CSV rows"""
+    extension = 'csv'
+
+    def __init__(self, fileobj, table):
+        self.names = [name for name, _ in TABLES[table]]
+        self.writer = csv.writer(fileobj)
+        self.writer.writerow(self.names)
+
+    def write(self, columns):
+        self.writer.writerows(
+            [_csv_value(value) for value in row]
+            for row in zip(*[columns[name] for name in self.names]))
+
+    def close(self):
+        pass
+
+
+class ArrowWriter(object):
+    """Writes chunks of columns as record batches of an Arrow IPC file"""
+    extension = 'arrow'
+
+    def __init__(self, fileobj, table):
+        self.schema = _arrow_schema(table)
+        self.writer = pyarrow.ipc.new_file(fileobj, self.schema)
+
+    def write(self, columns):
+        self.writer.write_batch(pyarrow.RecordBatch.from_arrays(
+            [columns[field.name] for field in self.schema],
+            schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetWriter(object):
+    """Writes chunks of columns as row groups of a Parquet file"""
+    extension = 'parquet'
+
+    def __init__(self, fileobj, table):
+        self.schema = _arrow_schema(table)
+        self.writer = pyarrow.parquet.ParquetWriter(fileobj, self.schema)
+
+    def write(self, columns):
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [columns[field.name] for field in self.schema],
+            schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def _csv_value(value):
+    # The Python 2 csv module only writes byte strings.
+    if str is bytes and isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+
+WRITERS = {'csv': CsvWriter, 'arrow': ArrowWriter, 'parquet': ParquetWriter}
+
+
+def _arrow_schema(table):
+    types = {'string': pyarrow.string(), 'int': pyarrow.int64(),
+             'bool': pyarrow.bool_(), 'date': pyarrow.date32()}
+    return pyarrow.schema([(name, types[kind])
+                           for name, kind in TABLES[table]])
+
+
+def default_format():
+    """Returns parquet when pyarrow can be imported, otherwise csv"""
+    return 'parquet' if pyarrow is not None else 'csv'
+
+
+def _user_names(entities):
+    """Returns the user name of each entity, the names old entities do not
+       store are resolved in one batch"""
+    names = get_user_names([entity.user for entity in entities
+                            if not entity.user_name])
+    return [entity.user_name or names.get(entity.user)
+            for entity in entities]
+
+
+def score_columns(scores):
+    return {'score': [score.key.urlsafe() for score in scores],
+            'user': [score.user.urlsafe() for score in scores],
+            'user_name': _user_names(scores),
+            'date': [score.date for score in scores],
+            'successful_attempts': [score.successful_attempts
+                                    for score in scores],
+            'failed_attempts': [score.failed_attempts for score in scores],
+            'total_attempts': [score.total_attempts for score in scores],
+            'won': [score.won for score in scores],
+            'room': [score.room and score.room.id() for score in scores]}
+
+
+def record_columns(records):
+    return {'user': [record.user.urlsafe() for record in records],
+            'user_name': _user_names(records),
+            'wins': [record.wins for record in records],
+            'loses': [record.loses for record in records]}
+
+
+def game_columns(games):
+    return {'game': [game.key.urlsafe() for game in games],
+            'user': [game.user.urlsafe() for game in games],
+            'user_name': _user_names(games),
+            'successful_attempts': [game.successful_attempts
+                                    for game in games],
+            'failed_attempts': [game.failed_attempts for game in games],
+            'total_attempts': [game.total_attempts for game in games],
+            'deck_seed': [game.deck_seed for game in games],
+            'room': [game.room and game.room.id() for game in games]}
+
+
+def move_columns(games):
+    """Decodes the move logs and legacy move histories of games into one
+       row per move"""
+    columns = dict((name, []) for name, _ in TABLES['moves'])
+    # The sealed move chunks of every game are read in one batch.
+    logs = [future.get_result() for future in
+            [game.packed_log_async() for game in games]]
+    for game, log in zip(games, logs):
+        game_id = game.key.urlsafe()
+        for attempt, first, second, card_one, card_two, matched in \
+                movelog.iter_all_moves(log, game.move_history):
+            columns['game'].append(game_id)
+            columns['attempt'].append(attempt)
+            columns['first_choice'].append(first)
+            columns['second_choice'].append(second)
+            columns['first_card'].append(CARD_LABELS[card_one])
+            columns['second_card'].append(CARD_LABELS[card_two])
+            columns['match'].append(bool(matched))
+    return columns
+
+
+def _export_query(kind):
+    from models import Game, Record, Score
+    if kind == 'scores':
+        return Score.query(), {'scores': score_columns}
+    if kind == 'records':
+        return Record.query(), {'records': record_columns}
+    return (Game.query(Game.game_over == True),
+            {'games': game_columns, 'moves': move_columns})
+
+
+def export_part(kind, part, open_file, fmt=None, cursor=None):
+    """Exports one part of scores, records or finished games
+    Args:
+        kind: 'scores', 'records' or 'games', games also writes the moves
+            table
+        part: The number of the part, used in the file names
+        open_file: A function that is passed a file name and returns a
+            writable binary file object
+        fmt: 'parquet', 'arrow' or 'csv', the default_format if None
+        cursor: The datastore Cursor the part starts from
+    Returns:
+        The Cursor the next part starts from or None when the export of
+        the kind is complete."""
+    fmt = fmt or default_format()
+    query, tables = _export_query(kind)
+    files = {}
+    writers = {}
+    for table in tables:
+        files[table] = open_file('{}-{:05d}.{}'.format(
+            table, part, WRITERS[fmt].extension))
+        writers[table] = WRITERS[fmt](files[table], table)
+
+    more = False
+    try:
+        for _ in range(BATCHES_PER_PART):
+            entities, cursor, more = query.fetch_page(BATCH_SIZE,
+                                                      start_cursor=cursor)
+            if entities and kind == 'games':
+                # Archived games are stubs without their moves.
+                import archive
+                entities = archive.rehydrate_multi_async(
+                    entities).get_result()
+            if entities:
+                for table, columns in tables.items():
+                    writers[table].write(columns(entities))
+            if not (more and cursor):
+                more = False
+                break
+    finally:
+        for table in tables:
+            writers[table].close()
+            files[table].close()
+    return cursor if more else None
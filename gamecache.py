@@ -0,0 +1,327 @@
+"""gamecache.py - This file contains the read-through cache of game state.
+
+Games being played are kept in memcache and updated with compare-and-set, so
+a move costs a memcache gets and cas and one datastore put instead of a
+datastore read and write. Each update bumps Game.version and gives the game
+a new revision, the token that tells two states apart.
+
+The cache entry orders the datastore writes of a game. A move is only made
+on a game whose last write has finished, which the write records under
+MEMCACHE_SAVED, so no write can land after a later one and each put can be
+blind. A move is acknowledged once its write has finished, and a write that
+fails takes the move back out of the cache. If the cas keeps losing to
+concurrent moves, or the game is not cached, the update falls back to a
+datastore transaction. The transaction and the end of a game first claim the
+cache entry, which holds off moves until the claim is released with the new
+state.
+
+When DURABLE_MOVES is True every move is also written through to the
+datastore. Otherwise games are only written every WRITE_BEHIND_MOVES moves
+and when they end, so the moves made since the last write are lost if
+memcache evicts the game."""
+
+import uuid
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+import endpoints
+
+
+MEMCACHE_GAME = 'GAME:'
+MEMCACHE_SAVED = 'GAME_SAVED:'
+MEMCACHE_CLAIM = 'CLAIM:'
+CLAIM_EXPIRY = 10
+CAS_ATTEMPTS = 3
+DURABLE_MOVES = True
+WRITE_BEHIND_MOVES = 10
+# A write that takes longer than WRITE_DEADLINE seconds fails. Moves wait
+# up to WAIT_ATTEMPTS * WAIT_SECONDS for the previous write to finish.
+WRITE_DEADLINE = 1
+WAIT_SECONDS = 0.02
+WAIT_ATTEMPTS = 75
+
+_adapter = ndb.ModelAdapter()
+
+
+def _cache_key(key):
+    return MEMCACHE_GAME + key.urlsafe()
+
+
+def _saved_key(key):
+    return MEMCACHE_SAVED + key.urlsafe()
+
+
+def _claimed(value):
+    return isinstance(value, basestring)
+
+
+@ndb.tasklet
+def _add_loaded_async(game):
+    """Caches a game read from the datastore along with the revision of its
+       last write, unless either is cached already"""
+    context = ndb.get_context()
+    yield (context.memcache_add(_cache_key(game.key), game),
+           context.memcache_add(_saved_key(game.key), game.saved_revision))
+
+
+@ndb.tasklet
+def get_async(key):
+    """Returns a Future for the Game a key points to or None, reading it
+       from the datastore into the cache if it is not cached."""
+    game = yield ndb.get_context().memcache_get(_cache_key(key))
+    if game is None or _claimed(game):
+        cached = game is None
+        game = yield key.get_async()
+        if game and cached:
+            yield _add_loaded_async(game)
+    raise ndb.Return(game)
+
+
+def get(key):
+    """Returns the Game a key points to or None"""
+    return get_async(key).get_result()
+
+
+@ndb.tasklet
+def get_multi_async(keys):
+    """Returns a Future for the Games a list of keys point to, None for
+       missing games"""
+    context = ndb.get_context()
+    games = yield [context.memcache_get(_cache_key(key)) for key in keys]
+    missing = [index for index, game in enumerate(games)
+               if game is None or _claimed(game)]
+    if missing:
+        loaded = yield ndb.get_multi_async([keys[index]
+                                            for index in missing])
+        yield [_add_loaded_async(game)
+               for index, game in zip(missing, loaded)
+               if game and games[index] is None]
+        for index, game in zip(missing, loaded):
+            games[index] = game
+    raise ndb.Return(games)
+
+
+def get_multi(keys):
+    """Returns the Games a list of keys point to, None for missing games"""
+    return get_multi_async(keys).get_result()
+
+
+def store_async(game):
+    """Caches a game that was just created, returns a Future"""
+    return _add_loaded_async(game)
+
+
+def store(game):
+    """Caches a game that was just created"""
+    store_async(game).get_result()
+
+
+def evict(keys):
+    """Drops games from the cache"""
+    memcache.delete_multi([_cache_key(key) for key in keys])
+
+
+def _needs_write(game):
+    if DURABLE_MOVES or game.game_over:
+        return True
+    return game.version - (game.saved_version or 0) >= WRITE_BEHIND_MOVES
+
+
+def _advance(game, write=False):
+    """Gives a changed game its next version and a new revision
+    Returns:
+        True if the change must be written now."""
+    game.version = (game.version or 0) + 1
+    game.revision = uuid.uuid4().hex
+    write = write or _needs_write(game)
+    if write:
+        game.saved_version = game.version
+        game.saved_revision = game.revision
+    return write
+
+
+def _copy(game):
+    return _adapter.pb_to_entity(_adapter.entity_to_pb(game))
+
+
+@ndb.tasklet
+def _settled_async(key):
+    """Waits until a cached game is neither claimed nor being written
+    Returns:
+        The cached game or None, read for a cas, and whether it settled
+        before the wait ran out."""
+    context = ndb.get_context()
+    for attempt in range(WAIT_ATTEMPTS):
+        if attempt:
+            yield ndb.sleep(WAIT_SECONDS)
+        game, saved = yield (
+            context.memcache_get(_cache_key(key), for_cas=True),
+            context.memcache_get(_saved_key(key), for_cas=True))
+        if game is None:
+            raise ndb.Return(None, True)
+        if not _claimed(game) and saved == game.saved_revision:
+            raise ndb.Return(game, True)
+    raise ndb.Return(game, False)
+
+
+@ndb.tasklet
+def _write_async(game):
+    """Writes a game whose move is cached and records the write. A failed
+       write drops the game from the cache, so the move is read back from
+       the datastore only if the write happened after all."""
+    context = ndb.get_context()
+    try:
+        yield game.put_async(deadline=WRITE_DEADLINE)
+    except Exception as e:
+        yield (context.memcache_delete(_cache_key(game.key)),
+               context.memcache_delete(_saved_key(game.key)))
+        raise e
+    yield context.memcache_set(_saved_key(game.key), game.saved_revision)
+
+
+@ndb.tasklet
+def update_async(key, mutate):
+    """Applies a change to a game with optimistic concurrency
+    Args:
+        key: The key of the Game to change
+        mutate: A function that is passed the current Game, changes it in
+            place and returns a (result, changed) tuple. It may be called
+            more than once if concurrent updates conflict.
+    Returns:
+        A Future for the updated Game and the result of mutate, or for
+        (None, None) if the game does not exist."""
+    context = ndb.get_context()
+    loaded = False
+    settled = True
+    for _ in range(CAS_ATTEMPTS):
+        game, settled = yield _settled_async(key)
+        if game is None and not loaded:
+            # Reads an uncached game into the cache once, then retries.
+            loaded = True
+            if (yield get_async(key)) is None:
+                raise ndb.Return(None, None)
+            game, settled = yield _settled_async(key)
+        if game is None or not settled:
+            break
+        result, changed = mutate(game)
+        if not changed:
+            raise ndb.Return(game, result)
+        # Move chunks sealed by the change are written before the game
+        # refers to them, and dropped again if the change loses the cas.
+        chunks = yield game.put_sealed_chunks_async()
+        write = _advance(game)
+        if (yield context.memcache_cas(_cache_key(key), game)):
+            if write:
+                yield _write_async(game)
+            raise ndb.Return(game, result)
+        if chunks:
+            yield ndb.delete_multi_async(chunks)
+
+    result = yield _update_in_transaction_async(key, mutate, wait=settled)
+    raise ndb.Return(result)
+
+
+def update(key, mutate):
+    """Applies a change to a game, see update_async"""
+    return update_async(key, mutate).get_result()
+
+
+@ndb.tasklet
+def _claim_async(key, wait=True):
+    """Holds a game's cache entry for a transaction. Unless wait is False,
+       first waits for the game's write in flight, so it cannot land after
+       the transaction.
+    Returns:
+        The claim and the cached game, None if it was not cached.
+    Raises:
+        ConflictException: Another request keeps the game claimed."""
+    context = ndb.get_context()
+    cache_key = _cache_key(key)
+    claim = MEMCACHE_CLAIM + uuid.uuid4().hex
+    for attempt in range(WAIT_ATTEMPTS):
+        # Stops waiting for writes once a wait has run out.
+        if wait:
+            game, wait = yield _settled_async(key)
+        else:
+            if attempt:
+                yield ndb.sleep(WAIT_SECONDS)
+            game = yield context.memcache_get(cache_key, for_cas=True)
+        if game is None:
+            if (yield context.memcache_add(cache_key, claim,
+                                           time=CLAIM_EXPIRY)):
+                raise ndb.Return(claim, None)
+        elif not _claimed(game):
+            if (yield context.memcache_cas(cache_key, claim,
+                                           time=CLAIM_EXPIRY)):
+                raise ndb.Return(claim, game)
+    raise endpoints.ConflictException('Game is busy, try again!')
+
+
+@ndb.tasklet
+def _release_async(key, claim, game):
+    """Replaces a claim with a game's state, or drops the game from the
+       cache if the claim has expired"""
+    context = ndb.get_context()
+    cache_key = _cache_key(key)
+    if game is None:
+        yield context.memcache_delete(cache_key)
+        return
+    yield context.memcache_set(_saved_key(key), game.saved_revision)
+    held = yield context.memcache_get(cache_key, for_cas=True)
+    if held != claim or not (yield context.memcache_cas(cache_key, game)):
+        yield context.memcache_delete(cache_key)
+
+
+@ndb.tasklet
+def _update_in_transaction_async(key, mutate, wait=True):
+    claim, cached = yield _claim_async(key, wait)
+
+    @ndb.tasklet
+    def txn():
+        game = yield key.get_async()
+        if game is None:
+            raise ndb.Return(None, None)
+        # The cache may hold moves that have not been written yet.
+        if cached and (cached.version or 0) > (game.version or 0):
+            game = _copy(cached)
+        result, changed = mutate(game)
+        if changed:
+            yield game.put_sealed_chunks_async()
+            _advance(game, write=True)
+            yield game.put_async()
+        raise ndb.Return(game, result)
+
+    try:
+        game, result = yield ndb.transaction_async(txn)
+    except Exception as e:
+        yield _release_async(key, claim, cached)
+        raise e
+    yield _release_async(key, claim, game)
+    raise ndb.Return(game, result)
+
+
+@ndb.tasklet
+def end_game_async(game, won):
+    """Ends a game while its cache entry is claimed, so no move is made on
+       it meanwhile and no earlier write lands after the end. Moves made
+       since the game was read are kept.
+    Returns:
+        A Future for the result of Game.end_game_async."""
+    claim, cached = yield _claim_async(game.key)
+    try:
+        latest = cached
+        if latest is None:
+            latest = yield game.key.get_async()
+        if latest and (latest.version or 0) > (game.version or 0):
+            game.populate(**latest.to_dict())
+        _advance(game, write=True)
+        ended = yield game.end_game_async(won)
+    except Exception as e:
+        yield _release_async(game.key, claim, cached)
+        raise e
+    yield _release_async(game.key, claim, game)
+    raise ndb.Return(ended)
+
+
+def end_game(game, won):
+    """Ends a game, see end_game_async"""
+    return end_game_async(game, won).get_result()
@@ -0,0 +1,162 @@
+"""jobs.py - This file contains the background job scheduler.
+
+Jobs are task queue tasks queued through an executor. A job can be queued
+three ways:
+
+ - schedule queues a job, once per name when it is given a name, so a task
+   that is retried does not queue the next step of a chain twice.
+ - coalesce queues at most one job per key per time window, named after the
+   window, to run when the window closes. Every trigger within the window is
+   served by that one job.
+ - coalesce with transactional=True queues the job with the datastore
+   transaction that triggered it, so it only runs if the write commits.
+   Transactional tasks cannot be named, so the window is claimed in memcache
+   once the transaction commits instead. Transactions that race for the
+   same window may each queue a job, which is why jobs must be idempotent,
+   but a committed trigger never goes without one.
+
+TaskQueueExecutor queues on the App Engine task queue. LocalExecutor keeps
+jobs in memory on a settable clock so the scheduling can be exercised and
+its task volume measured offline."""
+
+import math
+import time
+
+
+DEFAULT_WINDOW = 60
+MEMCACHE_JOB = 'JOB:'
+
+
+def bucket_name(prefix, window, now):
+    """Returns the task name of the window that a time falls in"""
+    return '{}-{}-{}'.format(prefix, int(window), int(now // window))
+
+
+class TaskQueueExecutor(object):
+    """Queues jobs on the App Engine task queue"""
+    def now(self):
+        return time.time()
+
+    def add(self, url, params, name=None, countdown=None,
+            transactional=False):
+        # The SDK is imported here so that the scheduling itself and
+        # LocalExecutor can be used without it.
+        from google.appengine.api import taskqueue
+        try:
+            taskqueue.add(url=url, params=params, name=name,
+                          countdown=countdown, transactional=transactional)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            return False
+        return True
+
+    def is_claimed(self, key):
+        from google.appengine.api import memcache
+        return memcache.get(MEMCACHE_JOB + key) is not None
+
+    def claim_on_commit(self, key, seconds):
+        from google.appengine.api import memcache
+        from google.appengine.ext import ndb
+        ndb.get_context().call_on_commit(
+            lambda: memcache.add(MEMCACHE_JOB + key, 1,
+                                 time=max(int(math.ceil(seconds)), 1)))
+
+
+class LocalExecutor(object):
+    """Keeps jobs in memory and runs them on request, for tests and offline
+       measurement. The clock is a function returning the current time in
+       seconds, time.time by default."""
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.pending = []
+        self.names = set()
+        self.claims = {}
+        self.requested = 0
+        self.queued = 0
+
+    def now(self):
+        return self.clock()
+
+    def add(self, url, params, name=None, countdown=None,
+            transactional=False):
+        self.requested += 1
+        if name is not None:
+            if name in self.names:
+                return False
+            self.names.add(name)
+        self.queued += 1
+        self.pending.append((self.now() + (countdown or 0), url, params))
+        return True
+
+    def is_claimed(self, key):
+        return self.claims.get(key, 0) > self.now()
+
+    def claim_on_commit(self, key, seconds):
+        if not self.is_claimed(key):
+            self.claims[key] = self.now() + seconds
+
+    def run_due(self, dispatch):
+        """Runs the jobs that are due, passing the url and params of each
+           to dispatch. Returns the number of jobs run."""
+        now = self.now()
+        due = sorted(job for job in self.pending if job[0] <= now)
+        self.pending = [job for job in self.pending if job[0] > now]
+        for _, url, params in due:
+            dispatch(url, params)
+        return len(due)
+
+
+_executor = TaskQueueExecutor()
+
+
+def get_executor():
+    return _executor
+
+
+def set_executor(executor):
+    """Replaces the executor jobs are queued on and returns the previous
+       one"""
+    global _executor
+    previous, _executor = _executor, executor
+    return previous
+
+
+def schedule(url, params=None, name=None, countdown=None,
+             transactional=False):
+    """Queues a job
+    Args:
+        url: The task handler URL
+        params: A dict of task parameters
+        name: A unique name, a job is only queued once per name
+        countdown: Seconds to wait before running the job
+        transactional: Queue the job with the current datastore
+            transaction, transactional jobs cannot be named
+    Returns:
+        True if the job was queued, False if a job with the name was
+        already queued."""
+    return _executor.add(url, params or {}, name, countdown, transactional)
+
+
+def coalesce(key, url, params=None, window=DEFAULT_WINDOW,
+             transactional=False):
+    """Queues a job to run when the current window of a key closes, unless
+       one has been queued for the window already
+    Args:
+        key: Identifies the job, at most one job per key runs per window
+        url: The task handler URL
+        params: A dict of task parameters
+        window: The length of the window in seconds
+        transactional: Queue the job with the current datastore transaction
+    Returns:
+        True if a job was queued."""
+    now = _executor.now()
+    countdown = window - now % window
+    if not transactional:
+        return _executor.add(url, params or {},
+                             bucket_name(key, window, now), countdown)
+    if _executor.is_claimed(key):
+        return False
+    queued = _executor.add(url, params or {}, None, countdown,
+                           transactional=True)
+    _executor.claim_on_commit(key, countdown)
+    return queued
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""latency.py - This file contains the endpoint latency benchmark.
+
+Runs the endpoints in process against the App Engine SDK testbed stubs, with
+a fixed delay added to every datastore and memcache call so that requests
+which overlap their calls finish sooner, as they do in production. Needs
+the App Engine SDK on the PYTHONPATH.
+
+To compare two versions of the API, run the benchmark in a checkout of each
+and compare the results:
+
+    python latency.py --json > after.json
+    git worktree add ../before <commit> && cp latency.py ../before
+    (cd ../before && python latency.py --json) > before.json
+    python latency.py --compare before.json after.json"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from timeit import default_timer
+
+from benchmark import summarize
+
+
+DATASTORE_LATENCY_MS = 10
+MEMCACHE_LATENCY_MS = 1
+
+
+def _delayed_rpc(latency, stub):
+    """Returns an RPC that takes latency seconds from when it is made, so
+       that RPCs made together take that long together"""
+    from google.appengine.api import apiproxy_rpc
+
+    class DelayedRPC(apiproxy_rpc.RPC):
+        def _MakeCallImpl(self):
+            self.ready_at = default_timer() + latency
+            super(DelayedRPC, self)._MakeCallImpl()
+
+        def _WaitImpl(self):
+            delay = self.ready_at - default_timer()
+            if delay > 0:
+                time.sleep(delay)
+            return super(DelayedRPC, self)._WaitImpl()
+
+    return DelayedRPC(stub=stub)
+
+
+class LatencyStub(object):
+    """Wraps an API stub, adding latency to each of its calls"""
+    def __init__(self, stub, latency):
+        self.stub = stub
+        self.latency = latency
+
+    def CreateRPC(self):
+        return _delayed_rpc(self.latency, self.stub)
+
+    def MakeSyncCall(self, service, call, request, response):
+        time.sleep(self.latency)
+        self.stub.MakeSyncCall(service, call, request, response)
+
+    def __getattr__(self, name):
+        return getattr(self.stub, name)
+
+
+def setup_testbed(datastore_ms=DATASTORE_LATENCY_MS,
+                  memcache_ms=MEMCACHE_LATENCY_MS):
+    """Activates a testbed with datastore, memcache and taskqueue stubs that
+       take the given milliseconds per call, returns the testbed"""
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # The endpoints server reads the minor version from the version id.
+    bed.setup_env(current_version_id='testbed.1', overwrite=True)
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    for service, latency in (('datastore_v3', datastore_ms),
+                             ('memcache', memcache_ms)):
+        stub = apiproxy_stub_map.apiproxy.GetStub(service)
+        apiproxy_stub_map.apiproxy.ReplaceStub(
+            service, LatencyStub(stub, latency / 1000.0))
+    return bed
+
+
+def call(service, endpoint, container, **fields):
+    """Calls an endpoint method as a new request, container is the
+       endpoint's ResourceContainer or request message class
+    Returns:
+        The response and the milliseconds the call took."""
+    from google.appengine.ext import ndb
+    ndb.get_context().clear_cache()
+    request = getattr(container, 'combined_message_class',
+                      container)(**fields)
+    start = default_timer()
+    response = getattr(service, endpoint)(request)
+    return response, (default_timer() - start) * 1000
+
+
+def run_scenario(service, player, rng, latencies, moves=10):
+    """Plays through every endpoint once as a new player. Endpoints and
+       request containers the checked out version of the API does not have
+       are skipped, so the scenario runs against older versions too."""
+    import api
+    from protorpc import message_types
+
+    def container(*names):
+        for name in names:
+            if hasattr(api, name):
+                return getattr(api, name)
+        return None
+
+    def timed(endpoint, container, **fields):
+        if container is None or not hasattr(service, endpoint):
+            return None
+        response, elapsed = call(service, endpoint, container, **fields)
+        latencies.setdefault(endpoint, []).append(elapsed)
+        return response
+
+    name = 'player{}'.format(player)
+    timed('create_user', api.USER_REQUEST, user_name=name,
+          email=name + '@example.com')
+    game = timed('new_game', api.NEW_GAME_REQUEST, user_name=name)
+    key = game.urlsafe_key
+    timed('get_game', api.GET_GAME_REQUEST, urlsafe_game_key=key)
+    for _ in range(moves):
+        first, second = rng.sample(range(52), 2)
+        timed('make_move', api.MAKE_MOVE_REQUEST, urlsafe_game_key=key,
+              first_choice=first, second_choice=second)
+    timed('get_game_history', api.GAME_HISTORY_REQUEST, urlsafe_game_key=key)
+    timed('get_user_games', container('USER_PAGE_REQUEST'), user_name=name)
+    timed('cancel_game', api.GET_GAME_REQUEST, urlsafe_game_key=key)
+    timed('get_user_scores', container('USER_PAGE_REQUEST'), user_name=name)
+    timed('get_user_rank', container('USER_RANK_REQUEST', 'USER_NAME_REQUEST'),
+          user_name=name)
+    timed('get_scores', container('PAGE_REQUEST'))
+    timed('get_high_scores', api.NUMBER_OF_RESULTS_REQUEST)
+    timed('get_user_rankings', api.NUMBER_OF_RESULTS_REQUEST)
+    timed('get_average_attempts',
+          container('ROOM_REQUEST') or message_types.VoidMessage)
+
+
+def run(players, seed, datastore_ms, memcache_ms):
+    """Runs the scenario for a number of players and returns the latency
+       summary of each endpoint"""
+    bed = setup_testbed(datastore_ms, memcache_ms)
+    try:
+        import api
+        service = api.ConcentrationApi()
+        rng = random.Random(seed)
+        latencies = {}
+        for player in range(players):
+            run_scenario(service, player, rng, latencies)
+    finally:
+        bed.deactivate()
+    results = {}
+    for endpoint, values in latencies.items():
+        results[endpoint] = summarize(values)
+        results[endpoint]['unit'] = 'milliseconds'
+    return results
+
+
+def compare(before, after):
+    """Prints the p50 and p90 latencies of two runs side by side"""
+    print('{:<22}{:>12}{:>12}{:>12}{:>12}'.format(
+        'endpoint', 'p50 before', 'p50 after', 'p90 before', 'p90 after'))
+    for endpoint in sorted(set(before) & set(after)):
+        print('{:<22}{:>12.1f}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+            endpoint, before[endpoint]['p50'], after[endpoint]['p50'],
+            before[endpoint]['p90'], after[endpoint]['p90']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--datastore-ms', type=float,
+                        default=DATASTORE_LATENCY_MS)
+    parser.add_argument('--memcache-ms', type=float,
+                        default=MEMCACHE_LATENCY_MS)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare the JSON results of two runs')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            compare(json.load(before)['endpoints'],
+                    json.load(after)['endpoints'])
+        return
+
+    results = {'python': sys.version.split()[0],
+               'players': args.players,
+               'datastore_ms': args.datastore_ms,
+               'memcache_ms': args.memcache_ms,
+               'endpoints': run(args.players, args.seed, args.datastore_ms,
+                                args.memcache_ms)}
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    for endpoint, summary in sorted(results['endpoints'].items()):
+        print('{:<22} p50 {p50:7.1f}ms p90 {p90:7.1f}ms '
+              'max {max:7.1f}ms'.format(endpoint, **summary))
+
+
+if __name__ == '__main__':
+    main()
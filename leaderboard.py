@@ -0,0 +1,250 @@
+"""leaderboard.py - This file contains the materialized top scores and user
+rankings.
+
+Each leaderboard is a single Leaderboard entity holding its TOP_K best
+entries, best first, with a copy kept in memcache. Game.end_game offers each
+new Score and updated Record to the leaderboards, and only entries that make
+it into the top TOP_K are kept. Those are written as PendingEntry entities in
+the transaction that ends the game, along with a coalesced merge job, so
+each leaderboard is written at most once per MERGE_WINDOW seconds however
+many games end.
+
+Rooms have their own leaderboards, whose ids are the global ids scoped to
+the room by Room.scoped, e.g. 'high_scores:spring-ladder'."""
+
+import heapq
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+import jobs
+import models
+from utils import get_user_name, get_user_names_async, get_list_page
+
+
+TOP_K = 100
+HIGH_SCORES = 'high_scores'
+RANKINGS = 'rankings'
+MEMCACHE_LEADERBOARD = 'LEADERBOARD:'
+MEMCACHE_EXPIRY = 300
+MERGE_URL = '/tasks/merge_leaderboards'
+MERGE_WINDOW = 5
+MERGE_BATCH_SIZE = 500
+
+
+class Leaderboard(ndb.Model):
+    """The best TOP_K entries of a leaderboard in rank order"""
+    entries = ndb.JsonProperty()
+
+
+def _high_score_order(entry):
+    return entry['total_attempts'], entry['date']
+
+
+def _ranking_order(entry):
+    return -entry['wins'], entry['loses']
+
+
+class PendingEntry(ndb.Model):
+    """A leaderboard entry waiting to be merged, stored under the User whose
+       game produced it"""
+    board_id = ndb.StringProperty(required=True, indexed=False)
+    entry = ndb.JsonProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+_ORDERS = {HIGH_SCORES: _high_score_order, RANKINGS: _ranking_order}
+
+
+def _split(board_id):
+    """Returns the global id of a leaderboard and the key of its room, None
+       for global leaderboards"""
+    name, _, room_id = board_id.partition(':')
+    return name, ndb.Key(models.Room, room_id) if room_id else None
+
+
+def _order(board_id):
+    return _ORDERS[_split(board_id)[0]]
+
+
+def score_entry(score, user_name=None):
+    """Returns the leaderboard entry of a won Score"""
+    return {'id': score.key.urlsafe(),
+            'user_name': (user_name or score.user_name or
+                          get_user_name(score.user)),
+            'date': str(score.date),
+            'successful_attempts': score.successful_attempts,
+            'failed_attempts': score.failed_attempts,
+            'total_attempts': score.total_attempts}
+
+
+def record_entry(record, user_name=None):
+    """Returns the leaderboard entry of a user's Record"""
+    return {'id': record.user.urlsafe(),
+            'user_name': (user_name or record.user_name or
+                          get_user_name(record.user)),
+            'wins': record.wins,
+            'loses': record.loses}
+
+
+@ndb.tasklet
+def _rebuild_async(board_id):
+    """Returns a Future for the entries of a leaderboard that has not been
+       stored yet, built from queries that only read the room's entities
+       for a room's leaderboard"""
+    name, room = _split(board_id)
+    if name == HIGH_SCORES:
+        query = models.Score.query(models.Score.won == True)
+        if room:
+            query = query.filter(models.Score.room == room)
+        entities = yield query.order(models.Score.total_attempts)\
+            .fetch_async(TOP_K)
+        make_entry = score_entry
+    else:
+        if room:
+            query = models.RoomRecord.query(models.RoomRecord.room == room)
+        else:
+            query = models.Record.query()
+        entities = yield query.order(-models.Record.wins,
+                                     models.Record.loses).fetch_async(TOP_K)
+        make_entry = record_entry
+    names = yield get_user_names_async([entity.user for entity in entities
+                                        if not entity.user_name])
+    entries = [make_entry(entity, names.get(entity.user))
+               for entity in entities]
+    entries.sort(key=_order(board_id))
+    board = yield Leaderboard.get_or_insert_async(board_id, entries=entries)
+    raise ndb.Return(board.entries)
+
+
+@ndb.tasklet
+def get_entries_async(board_id):
+    """Returns a Future for the entries of a leaderboard, best first"""
+    context = ndb.get_context()
+    entries = yield context.memcache_get(MEMCACHE_LEADERBOARD + board_id)
+    if entries is None:
+        board = yield ndb.Key(Leaderboard, board_id).get_async()
+        entries = board.entries if board else \
+            (yield _rebuild_async(board_id))
+        # Added rather than set, so entries cached by a merge that
+        # committed meanwhile are not replaced with older ones.
+        yield context.memcache_add(MEMCACHE_LEADERBOARD + board_id, entries,
+                                   time=MEMCACHE_EXPIRY)
+    raise ndb.Return(entries)
+
+
+def get_entries(board_id):
+    """Returns the entries of a leaderboard, best first"""
+    return get_entries_async(board_id).get_result()
+
+
+def clear(board_id):
+    """Deletes a leaderboard so that it is rebuilt when next read"""
+    ndb.Key(Leaderboard, board_id).delete()
+    memcache.delete(MEMCACHE_LEADERBOARD + board_id)
+
+
+@ndb.tasklet
+def get_page_async(board_id, page_size, cursor=None):
+    """Returns a Future for a page of leaderboard entries and the cursor of
+       the next page, or None if the page reaches the end of the
+       leaderboard.
+    Raises:
+        endpoints.BadRequestException: The cursor is malformed"""
+    entries = yield get_entries_async(board_id)
+    raise ndb.Return(get_list_page(entries, page_size, cursor))
+
+
+def get_page(board_id, page_size, cursor=None):
+    """Returns a page of leaderboard entries and the cursor of the next
+       page, see get_page_async"""
+    return get_page_async(board_id, page_size, cursor).get_result()
+
+
+def _qualifies(entries, entry, order):
+    """Checks if an entry would change a leaderboard"""
+    if len(entries) < TOP_K:
+        return True
+    if any(existing['id'] == entry['id'] for existing in entries):
+        return True
+    return order(entry) < order(entries[-1])
+
+
+@ndb.tasklet
+def _merge_async(board_id, new_entries):
+    board = yield ndb.Key(Leaderboard, board_id).get_async()
+    board = board or Leaderboard(id=board_id, entries=[])
+    # Later entries replace earlier entries with the same id.
+    merged = dict((entry['id'], entry) for entry in board.entries)
+    merged.update((entry['id'], entry) for entry in new_entries)
+    board.entries = heapq.nsmallest(TOP_K, merged.values(),
+                                    key=_order(board_id))
+    yield board.put_async()
+    ndb.get_context().call_on_commit(
+        lambda: memcache.set(MEMCACHE_LEADERBOARD + board_id, board.entries,
+                             time=MEMCACHE_EXPIRY))
+
+
+def prepare_offers(offers, parent):
+    """Returns the PendingEntry entities of the entries that would change
+       their leaderboards, which must be put in the current transaction.
+       The merge job is queued with the transaction if there are any.
+    Args:
+        offers: A list of (board_id, entry, entries) tuples, entries being
+            the current entries of the leaderboard
+        parent: The key of the User the entries belong to"""
+    pending = [PendingEntry(parent=parent, board_id=board_id, entry=entry)
+               for board_id, entry, entries in offers
+               if _qualifies(entries, entry, _order(board_id))]
+    if pending:
+        jobs.coalesce('merge-leaderboards', MERGE_URL, window=MERGE_WINDOW,
+                      transactional=True)
+    return pending
+
+
+def merge_pending():
+    """Merges a batch of pending entries into their leaderboards with one
+       write per leaderboard. The job is queued again while entries are
+       found, which also picks up entries the query did not see yet.
+    Returns:
+        The number of entries merged."""
+    pending = PendingEntry.query().order(PendingEntry.created)\
+        .fetch(MERGE_BATCH_SIZE)
+    if not pending:
+        return 0
+    by_board = {}
+    for entity in pending:
+        by_board.setdefault(entity.board_id, []).append(entity.entry)
+    for board_id, entries in by_board.items():
+        ndb.transaction_async(
+            lambda: _merge_async(board_id, entries)).get_result()
+    ndb.delete_multi([entity.key for entity in pending])
+    jobs.coalesce('merge-leaderboards', MERGE_URL, window=MERGE_WINDOW)
+    return len(pending)
+
+
+@ndb.tasklet
+def get_rank_async(record, entries=None):
+    """Returns a Future for the 1 based win ranking of a user's Record, or
+       of a RoomRecord within its room. Users outside the leaderboard are
+       ranked by counting the users with more wins and those with as many
+       wins and fewer loses, which only reads the index entries ahead of
+       the user. The entries of the scope's rankings are read unless they
+       are given."""
+    user_id = record.user.urlsafe()
+    room = getattr(record, 'room', None)
+    if entries is None:
+        entries = yield get_entries_async(models.Room.scoped(RANKINGS, room))
+    for position, entry in enumerate(entries):
+        if entry['id'] == user_id:
+            raise ndb.Return(position + 1)
+    model = models.RoomRecord if room else models.Record
+    query = model.query(model.room == room) if room else model.query()
+    more_wins, fewer_loses = yield (
+        query.filter(model.wins > record.wins).count_async(keys_only=True),
+        query.filter(model.wins == record.wins,
+                     model.loses < record.loses).count_async(keys_only=True))
+    raise ndb.Return(more_wins + fewer_loses + 1)
+
+
+def get_rank(record):
+    """Returns the 1 based win ranking of a user's Record"""
+    return get_rank_async(record).get_result()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""loadtest.py - This file contains the in-process load test of the API.
+
+Simulated players create a user, play games through make_move until they
+win and read the leaderboards, on a number of threads at once, against the
+App Engine SDK testbed stubs with simulated RPC latency from latency.py.
+Each player plays with a strategy from simulator.py, the mix of strategies
+is configurable. Reports the throughput, the client side latency
+percentiles and the datastore calls of every endpoint, the last as counted
+by profiling.py. Needs the App Engine SDK on the PYTHONPATH.
+
+To catch regressions, save the JSON results of a run before and after a
+change and compare them:
+
+    python loadtest.py --json > before.json
+    python loadtest.py --json > after.json
+    python loadtest.py --compare before.json after.json
+
+The comparison exits with status 1 if an endpoint's p90 latency or mean
+datastore calls grew by more than --tolerance."""
+
+import argparse
+import json
+import random
+import sys
+import threading
+from timeit import default_timer
+
+from benchmark import summarize
+from board import CARD_CODES, DECK_SIZE
+from latency import DATASTORE_LATENCY_MS, MEMCACHE_LATENCY_MS, call,\
+    setup_testbed
+from simulator import STRATEGIES
+
+
+DEFAULT_MIX = 'perfect=6,limited=3,random=1'
+# Games still going after this many moves are cancelled, random play can
+# take thousands.
+MAX_MOVES = 500
+
+
+def parse_mix(text):
+    """Parses a player mix such as 'perfect=6,random=1' into a list of
+       (strategy, weight) tuples"""
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in STRATEGIES:
+            raise ValueError('Unknown strategy {}'.format(name))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def choose_strategy(mix, rng):
+    """Picks a strategy name from a mix by weight"""
+    point = rng.uniform(0, sum(weight for _, weight in mix))
+    for name, weight in mix:
+        point -= weight
+        if point <= 0:
+            return name
+    return mix[-1][0]
+
+
+def parse_move(message):
+    """Parses a make_move message such as '3:_AH ~ 17:10H | Match' into the
+       positions and card codes played and whether they matched, returns
+       None for messages of rejected moves"""
+    try:
+        cards, result = message.split(' | ')
+        first, second = cards.split(' ~ ')
+        first, card_one = first.split(':')
+        second, card_two = second.split(':')
+        return (int(first), CARD_CODES[card_one], int(second),
+                CARD_CODES[card_two], result == 'Match')
+    except (KeyError, ValueError):
+        return None
+
+
+class Recorder(object):
+    """Collects the latency of every call and the errors, from every
+       thread"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def failed(self, endpoint):
+        """Counts an error"""
+        with self.lock:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def timed(self, service, endpoint, container, **fields):
+        """Calls an endpoint, returns the response or None if it failed"""
+        try:
+            response, elapsed = call(service, endpoint, container, **fields)
+        except Exception:
+            self.failed(endpoint)
+            return None
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+        return response
+
+
+def play(service, recorder, name, strategy, rng, games):
+    """Plays a player's games"""
+    import api
+
+    recorder.timed(service, 'create_user', api.USER_REQUEST, user_name=name,
+                   email=name + '@example.com')
+    for _ in range(games):
+        game = recorder.timed(service, 'new_game', api.NEW_GAME_REQUEST,
+                              user_name=name)
+        if game is None:
+            continue
+        key = game.urlsafe_key
+        strategy.reset()
+        unmatched = list(range(DECK_SIZE))
+        for _ in range(MAX_MOVES):
+            if unmatched:
+                first, second = strategy.choose(unmatched)
+            else:
+                # Every pair is matched, the next move collects the win.
+                first, second = 0, 1
+            response = recorder.timed(service, 'make_move',
+                                      api.MAKE_MOVE_REQUEST,
+                                      urlsafe_game_key=key,
+                                      first_choice=first,
+                                      second_choice=second)
+            if response is None:
+                break
+            move = parse_move(response.message)
+            if move:
+                strategy.observe(*move)
+                if move[4]:
+                    unmatched.remove(first)
+                    unmatched.remove(second)
+            if response.game_over:
+                break
+        else:
+            recorder.timed(service, 'cancel_game', api.GET_GAME_REQUEST,
+                           urlsafe_game_key=key)
+        recorder.timed(service, 'get_high_scores',
+                       api.NUMBER_OF_RESULTS_REQUEST)
+        recorder.timed(service, 'get_user_rankings',
+                       api.NUMBER_OF_RESULTS_REQUEST)
+
+
+def run(players, threads, games, mix, seed, datastore_ms, memcache_ms):
+    """Plays a number of players on a number of threads
+    Returns:
+        The results of every endpoint and the seconds the run took."""
+    bed = setup_testbed(datastore_ms, memcache_ms)
+    try:
+        # The API is imported once the testbed is active so that the
+        # profiling hooks observe its stubs.
+        import api
+        import profiling
+        profiling.reset()
+        service = api.ConcentrationApi()
+        recorder = Recorder()
+        rng = random.Random(seed)
+        queue = [('load{}'.format(player), choose_strategy(mix, rng),
+                  rng.getrandbits(32)) for player in range(players)]
+        queue.reverse()
+        queue_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with queue_lock:
+                    if not queue:
+                        return
+                    name, strategy_name, player_seed = queue.pop()
+                player_rng = random.Random(player_seed)
+                # A player that fails is counted and the thread goes on to
+                # the next one.
+                try:
+                    play(service, recorder, name,
+                         STRATEGIES[strategy_name](player_rng), player_rng,
+                         games)
+                except Exception:
+                    recorder.failed('play')
+
+        start = default_timer()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        seconds = default_timer() - start
+        metrics = profiling.snapshot()['endpoints']
+    finally:
+        bed.deactivate()
+
+    results = {}
+    for endpoint in set(recorder.latencies) | set(recorder.errors):
+        values = recorder.latencies.get(endpoint, [])
+        calls = metrics.get(endpoint, {}).get('datastore_calls', {})
+        results[endpoint] = {
+            'calls': len(values),
+            'errors': recorder.errors.get(endpoint, 0),
+            'per_sec': len(values) / seconds,
+            'latency_ms': summarize(values),
+            'datastore_calls': {'mean': calls.get('mean'),
+                                'p90': calls.get('p90'),
+                                'max': calls.get('max')}}
+    return results, seconds
+
+
+def compare(before, after, tolerance):
+    """Prints two runs side by side
+    Returns:
+        The endpoints whose p90 latency or mean datastore calls grew by more
+        than the tolerance fraction."""
+    regressions = []
+    print('{:<20}{:>11}{:>11}{:>11}{:>11}'.format(
+        'endpoint', 'p90 before', 'p90 after', 'rpc before', 'rpc after'))
+    for endpoint in sorted(set(before) & set(after)):
+        old, new = before[endpoint], after[endpoint]
+        old_p90 = old['latency_ms']['p90'] or 0
+        new_p90 = new['latency_ms']['p90'] or 0
+        old_rpcs = old['datastore_calls']['mean'] or 0
+        new_rpcs = new['datastore_calls']['mean'] or 0
+        regressed = new_p90 > old_p90 * (1 + tolerance) or \
+            new_rpcs > old_rpcs * (1 + tolerance)
+        if regressed:
+            regressions.append(endpoint)
+        print('{:<20}{:>11.1f}{:>11.1f}{:>11.1f}{:>11.1f}{}'.format(
+            endpoint, old_p90, new_p90, old_rpcs, new_rpcs,
+            '  REGRESSED' if regressed else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--games', type=int, default=1,
+                        help='games each player plays')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weights of the player strategies, '
+                        'default ' + DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--datastore-ms', type=float,
+                        default=DATASTORE_LATENCY_MS)
+    parser.add_argument('--memcache-ms', type=float,
+                        default=MEMCACHE_LATENCY_MS)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare the JSON results of two runs')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='growth that --compare reports as a regression')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            regressions = compare(json.load(before)['endpoints'],
+                                  json.load(after)['endpoints'],
+                                  args.tolerance)
+        if regressions:
+            sys.exit(1)
+        return
+
+    endpoints, seconds = run(args.players, args.threads, args.games,
+                             parse_mix(args.mix), args.seed,
+                             args.datastore_ms, args.memcache_ms)
+    calls = sum(result['calls'] for result in endpoints.values())
+    results = {'python': sys.version.split()[0],
+               'players': args.players,
+               'threads': args.threads,
+               'games': args.games,
+               'mix': args.mix,
+               'datastore_ms': args.datastore_ms,
+               'memcache_ms': args.memcache_ms,
+               'seconds': seconds,
+               'calls_per_sec': calls / seconds,
+               'endpoints': endpoints}
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print('{} calls in {:.1f}s, {:.1f} calls/s'.format(
+        calls, seconds, results['calls_per_sec']))
+    for endpoint, result in sorted(endpoints.items()):
+        if not result['calls']:
+            print('{:<20} {:d} errors'.format(endpoint, result['errors']))
+            continue
+        print('{:<20} {:6.1f}/s p50 {p50:7.1f}ms p90 {p90:7.1f}ms '
+              'p99 {p99:7.1f}ms {:5.1f} datastore calls {:d} errors'.format(
+                  endpoint, result['per_sec'],
+                  result['datastore_calls']['mean'] or 0, result['errors'],
+                  **result['latency_ms']))
+
+
+if __name__ == '__main__':
+    main()
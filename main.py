@@ -2,51 +2,221 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
+import logging
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import ConcentrationApi
-from models import User, Game
+from datetime import date, datetime
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+import archive
+import counters
+import export
+import jobs
+import leaderboard
+import migrations
+import profiling
+import reminders
+from models import Game
+
+
+BACKFILL_BATCH_SIZE = 500
+
+
+def _run_id():
+    """Names a run of a task chain by the time it started"""
+    return datetime.now().strftime('%Y%m%d-%H%M%S')
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
         """Send a reminder email to each User with an email about games.
-        Called every 24 hours using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
-            subject = 'This is a reminder!'
-            active_games = Game.query(Game.user == user.key, 
-                                      Game.game_over == False).get()
-            if active_games:
-                body = 'Hello {}, you still have some active incomplete games,\
-                        why not give the Concentration another try!'.format(user.name)
-                       
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                            user.email,
-                            subject,
-                            body)
-            else:
-                body = 'Hello {}, try out Concentration!'.format(user.name)
-                       
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                            user.email,
-                            subject,
-                            body)
-
-
-class UpdateAverageMoves(webapp2.RequestHandler):
+        Called every 24 hours using a cron job, queues the first batch of
+        the day's reminders."""
+        reminders.queue_batch(date.today(), 0)
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send the reminders of one batch of users and queue the next."""
+        cursor = self.request.get('cursor')
+        reminders.send_batch(
+            datetime.strptime(self.request.get('date'), '%Y-%m-%d').date(),
+            int(self.request.get('batch')),
+            Cursor(urlsafe=cursor) if cursor else None)
+        self.response.set_status(204)
+
+
+class BackfillAverageAttempts(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild the average attempts aggregate from finished games.
+        The first request resets the aggregate, then each request adds one
+        batch of games and queues the next batch until every finished game
+        has been counted. Games that finish while the backfill is running
+        may be counted twice, so it should be run while the game is quiet.
+        Each batch is queued by name, once per run, so a retried batch does
+        not start a second chain."""
+        cursor = self.request.get('cursor')
+        run = self.request.get('run') or _run_id()
+        batch = int(self.request.get('batch') or 0)
+        if cursor:
+            cursor = Cursor(urlsafe=cursor)
+        else:
+            counters.reset(counters.GAME_ATTEMPTS)
+            cursor = None
+
+        games, next_cursor, more = Game.query(Game.game_over == True)\
+            .fetch_page(BACKFILL_BATCH_SIZE, start_cursor=cursor,
+                        projection=[Game.total_attempts])
+        if games:
+            counters.add(counters.GAME_ATTEMPTS,
+                         sum(game.total_attempts for game in games),
+                         count=len(games))
+        if more and next_cursor:
+            jobs.schedule('/tasks/backfill_average_attempts',
+                          {'cursor': next_cursor.urlsafe(), 'run': run,
+                           'batch': batch + 1},
+                          name='backfill-{}-{}'.format(run, batch + 1))
+        self.response.set_status(204)
+
+
+class MigrateUsers(webapp2.RequestHandler):
+    def post(self):
+        """Move Users keyed by automatic ids to their name keys one batch at
+        a time, queueing the next batch until every User has been visited."""
+        cursor = self.request.get('cursor')
+        run = self.request.get('run') or _run_id()
+        batch = int(self.request.get('batch') or 0)
+        next_cursor = migrations.migrate_users(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            jobs.schedule('/tasks/migrate_users',
+                          {'cursor': next_cursor.urlsafe(), 'run': run,
+                           'batch': batch + 1},
+                          name='migrate-users-{}-{}'.format(run, batch + 1))
+        self.response.set_status(204)
+
+
+class ExportData(webapp2.RequestHandler):
+    def post(self):
+        """Export one part of the scores, records or finished games to
+        Cloud Storage and queue the next part. A request without a kind
+        starts the export of every kind into a new folder of the default
+        bucket."""
+        kind = self.request.get('kind')
+        folder = self.request.get('folder')
+        fmt = self.request.get('format') or export.default_format()
+        if not kind:
+            folder = 'exports/' + _run_id()
+            for kind in ('scores', 'records', 'games'):
+                jobs.schedule('/tasks/export',
+                              {'kind': kind, 'part': 0, 'folder': folder,
+                               'format': fmt})
+            self.response.set_status(204)
+            return
+
+        try:
+            import cloudstorage
+        except ImportError:
+            # Fails the task, so it is retried once the library is deployed.
+            logging.error('The export needs the Cloud Storage client '
+                          'library, install it into lib/ with '
+                          '"pip install -t lib -r requirements.txt" and '
+                          'deploy again')
+            self.abort(500)
+        from google.appengine.api import app_identity
+        bucket = app_identity.get_default_gcs_bucket_name()
+
+        def open_file(name):
+            return cloudstorage.open(
+                '/{}/{}/{}'.format(bucket, folder, name), 'w')
+
+        part = int(self.request.get('part'))
+        cursor = self.request.get('cursor')
+        next_cursor = export.export_part(
+            kind, part, open_file, fmt,
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            jobs.schedule('/tasks/export',
+                          {'kind': kind, 'part': part + 1, 'folder': folder,
+                           'format': fmt, 'cursor': next_cursor.urlsafe()},
+                          name='export-{}-{}-{}'.format(
+                              folder.split('/')[-1], kind, part + 1))
+        self.response.set_status(204)
+
+
+class StartArchive(webapp2.RequestHandler):
+    def get(self):
+        """Start archiving the games that ended more than
+        archive.ARCHIVE_AFTER ago. Called daily using a cron job."""
+        jobs.schedule('/tasks/archive_games', {'run': _run_id()})
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    def post(self):
+        """Archive one batch of finished games and queue the next batch.
+        With legacy=1 every finished game is visited, to archive games that
+        ended before their end time was recorded."""
+        cursor = self.request.get('cursor')
+        run = self.request.get('run') or _run_id()
+        batch = int(self.request.get('batch') or 0)
+        legacy = self.request.get('legacy')
+        _, next_cursor = archive.archive_batch(
+            Cursor(urlsafe=cursor) if cursor else None, bool(legacy))
+        if next_cursor:
+            jobs.schedule('/tasks/archive_games',
+                          {'cursor': next_cursor.urlsafe(), 'run': run,
+                           'batch': batch + 1, 'legacy': legacy},
+                          name='archive-{}-{}'.format(run, batch + 1))
+        self.response.set_status(204)
+
+
+class MergeLeaderboards(webapp2.RequestHandler):
+    def post(self):
+        """Merge the pending leaderboard entries of recently ended games."""
+        leaderboard.merge_pending()
+        self.response.set_status(204)
+
+
+class AuditGame(webapp2.RequestHandler):
+    def get(self):
+        """Replay a game's moves on its deal and report any moves, board or
+        attempt counts that do not follow from it as JSON."""
+        game = ndb.Key(urlsafe=self.request.get('game')).get()
+        if not isinstance(game, Game):
+            self.abort(404)
+        game = archive.rehydrate(game)
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({'game': game.key.urlsafe(),
+                                        'deck_seed': game.deck_seed,
+                                        'problems': game.audit()},
+                                       indent=2))
+
+
+class Metrics(webapp2.RequestHandler):
+    def get(self):
+        """Report the endpoint metrics of the instance serving the request
+        as JSON, with the sampled request profiles if profiles=1."""
+        metrics = profiling.snapshot()
+        if self.request.get('profiles'):
+            metrics['profiles'] = profiling.profiles()
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(metrics, indent=2, sort_keys=True))
+
     def post(self):
-        """Update game listing announcement in memcache."""
-        ConcentrationApi._cache_average_attempts()
+        """Reset the endpoint metrics of the instance."""
+        profiling.reset()
         self.response.set_status(204)
 
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_attempts', UpdateAverageMoves),
+    ('/crons/archive_games', StartArchive),
+    ('/tasks/archive_games', ArchiveGames),
+    ('/tasks/send_reminders', SendReminderBatch),
+    ('/tasks/backfill_average_attempts', BackfillAverageAttempts),
+    ('/tasks/migrate_users', MigrateUsers),
+    ('/tasks/export', ExportData),
+    ('/tasks/merge_leaderboards', MergeLeaderboards),
+    ('/admin/metrics', Metrics),
+    ('/admin/audit_game', AuditGame),
 ], debug=True)
@@ -0,0 +1,109 @@
+"""migrations.py - This file contains one-off data migrations that are run
+in batches by the task handlers in main.py."""
+
+import logging
+from google.appengine.ext import ndb
+import gamecache
+import leaderboard
+import stats
+from models import User, Room, Game, Score, Record, RoomRecord
+
+
+USERS_PER_BATCH = 20
+
+
+def is_migrated(user):
+    """Checks if a User is already keyed by its normalized name"""
+    return user.key == User.key_for(user.name)
+
+
+def migrate_user(user):
+    """Moves a User keyed by an automatic id to its name key. Games are
+       pointed at the new key and the user's Records, RoomRecords, Scores
+       and pending leaderboard entries are moved under it, keeping their ids
+       and filling in their user_name along the way. The new User is only
+       written once everything that refers to it has moved, and moved
+       entities keep their ids, so a batch that fails part way can be run
+       again.
+    Args:
+        user: A User that is not keyed by its normalized name
+    Returns:
+        True if the user was migrated, False if another User already has
+        the name key."""
+    old_key = user.key
+    new_key = User.key_for(user.name)
+    if new_key.get():
+        logging.warning('User %s was not migrated, %s is already taken',
+                        old_key, new_key.id())
+        return False
+
+    puts = []
+    deletes = []
+    record = Record.get_for_user(old_key)
+    if record:
+        puts.append(Record(key=Record.key_for(new_key),
+                           **dict(record.to_dict(), user=new_key,
+                                  user_name=user.name)))
+        deletes.append(record.key)
+    user_stats = stats.UserStats.key_for(old_key).get()
+    if user_stats:
+        puts.append(stats.UserStats(key=stats.UserStats.key_for(new_key),
+                                    **user_stats.to_dict()))
+        deletes.append(user_stats.key)
+    for game in Game.query(Game.user == old_key):
+        game.user = new_key
+        game.user_name = user.name
+        puts.append(game)
+    for room_record in RoomRecord.query(ancestor=old_key):
+        puts.append(RoomRecord(
+            key=RoomRecord.key_for(new_key, room_record.room),
+            **dict(room_record.to_dict(), user=new_key,
+                   user_name=user.name)))
+        deletes.append(room_record.key)
+    # Pending leaderboard entries refer to the user and its scores by key.
+    moved_ids = {old_key.urlsafe(): new_key.urlsafe()}
+    for score in Score.query(Score.user == old_key):
+        moved = Score(id=score.key.id(), parent=new_key,
+                      **dict(score.to_dict(), user=new_key,
+                             user_name=user.name))
+        moved_ids[score.key.urlsafe()] = moved.key.urlsafe()
+        puts.append(moved)
+        deletes.append(score.key)
+    for pending in leaderboard.PendingEntry.query(ancestor=old_key):
+        entry = dict(pending.entry, user_name=user.name)
+        entry['id'] = moved_ids.get(entry['id'], entry['id'])
+        puts.append(leaderboard.PendingEntry(
+            id=pending.key.id(), parent=new_key,
+            **dict(pending.to_dict(), entry=entry)))
+        deletes.append(pending.key)
+    ndb.put_multi(puts)
+    ndb.delete_multi(deletes)
+    gamecache.evict([entity.key for entity in puts
+                     if isinstance(entity, Game)])
+
+    User(key=new_key, **user.to_dict()).put()
+    old_key.delete()
+    return True
+
+
+def migrate_users(cursor=None):
+    """Migrates one batch of users
+    Args:
+        cursor: The datastore Cursor the batch starts from or None to start
+            from the first User
+    Returns:
+        The Cursor of the next batch or None when every User has been
+        visited. The leaderboards, global and of every room, refer to users
+        and scores by key, so they are cleared to be rebuilt after the last
+        batch."""
+    users, next_cursor, more = User.query().fetch_page(USERS_PER_BATCH,
+                                                       start_cursor=cursor)
+    for user in users:
+        if not is_migrated(user):
+            migrate_user(user)
+    if more and next_cursor:
+        return next_cursor
+    for room in [None] + Room.query().fetch(keys_only=True):
+        leaderboard.clear(Room.scoped(leaderboard.HIGH_SCORES, room))
+        leaderboard.clear(Room.scoped(leaderboard.RANKINGS, room))
+    return None
@@ -1,21 +1,161 @@
 """models.py - This file contains the class definitions for the Datastore
 entities used by the Game."""
 
-import random
-from datetime import date
+from datetime import date, datetime
 from protorpc import messages
 from google.appengine.ext import ndb
+from board import Board, unpack_matched
+import counters
+import decks
+import leaderboard
+import movelog
+import stats
+from utils import get_user_name
 
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile, keyed by its normalized name"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
+    active_games = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+    active_games_indexed = ndb.BooleanProperty(default=False, indexed=False)
+
+    @staticmethod
+    def normalize_name(name):
+        """Returns the form of a user name that users are keyed by"""
+        return name.strip().lower()
+
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of the User with a name"""
+        return ndb.Key(cls, cls.normalize_name(name))
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Returns a Future for the User with a name or None. Users created
+           before users were keyed by name are found by querying until they
+           are migrated."""
+        if not name or not cls.normalize_name(name):
+            raise ndb.Return(None)
+        user = yield cls.key_for(name).get_async()
+        if user is None:
+            user = yield cls.query(cls.name == name).get_async()
+        raise ndb.Return(user)
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with a name or None"""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    def create_async(cls, name, email):
+        """Returns a Future for a new User, created along with its Record,
+           or for None if the name is already taken."""
+        key = cls.key_for(name)
+
+        @ndb.tasklet
+        def txn():
+            if (yield key.get_async()):
+                raise ndb.Return(None)
+            user = cls(key=key, name=name, email=email,
+                       active_games_indexed=True)
+            record = Record(key=Record.key_for(key),
+                            user=key,
+                            user_name=name,
+                            wins=0,
+                            loses=0)
+            yield ndb.put_multi_async([user, record])
+            raise ndb.Return(user)
+        return ndb.transaction_async(txn)
+
+    @classmethod
+    def create(cls, name, email):
+        """Creates and returns a new User and its Record, or returns None if
+           the name is already taken."""
+        return cls.create_async(name, email).get_result()
+
+    def active_game_keys(self):
+        """Returns the keys of the user's active games. Users created before
+           active games were tracked have theirs found by one query the
+           first time they are needed."""
+        return self.active_game_keys_async().get_result()
+
+    @ndb.tasklet
+    def active_game_keys_async(self):
+        """Returns a Future for the keys of the user's active games"""
+        if not self.active_games_indexed:
+            keys = yield Game.query(Game.user == self.key,
+                                    Game.game_over == False).fetch_async(
+                                        keys_only=True)
+            yield self._index_active_games_async(keys)
+        raise ndb.Return(self.active_games)
+
+    @ndb.tasklet
+    def _index_active_games_async(self, keys):
+        @ndb.tasklet
+        def txn():
+            user = yield self.key.get_async()
+            user.active_games = list(set(user.active_games) | set(keys))
+            user.active_games_indexed = True
+            yield user.put_async()
+            raise ndb.Return(user.active_games)
+
+        active_games = yield ndb.transaction_async(txn)
+        self.populate(active_games=active_games, active_games_indexed=True)
+
+
+class Room(ndb.Model):
+    """A room, such as a tournament or a regional ladder, that games can be
+       played in. Games in a room also count towards the room's own
+       leaderboards, records and average attempts. Keyed by its normalized
+       name."""
+    name = ndb.StringProperty(required=True)
+    description = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @staticmethod
+    def normalize_name(name):
+        """Returns the form of a room name that rooms are keyed by"""
+        return name.strip().lower()
+
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of the Room with a name"""
+        return ndb.Key(cls, cls.normalize_name(name))
+
+    @classmethod
+    def create_async(cls, name, description=None):
+        """Returns a Future for a new Room, or for None if the name is
+           already taken."""
+        key = cls.key_for(name)
+
+        @ndb.tasklet
+        def txn():
+            if (yield key.get_async()):
+                raise ndb.Return(None)
+            room = cls(key=key, name=name.strip(), description=description)
+            yield room.put_async()
+            raise ndb.Return(room)
+        return ndb.transaction_async(txn)
+
+    @staticmethod
+    def scoped(name, room):
+        """Returns the name of a leaderboard or aggregate within a room, the
+           global name if room is None"""
+        if room is None:
+            return name
+        return '{}:{}'.format(name, room.id())
 
 
 class Game(ndb.Model):
     """Game object"""
+    # Games being played are cached by gamecache instead of NDB's memcache.
+    _use_memcache = False
+
     user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(indexed=False)
+    room = ndb.KeyProperty(kind='Room')
     cards = ndb.StringProperty(required=True, default='')
     available_cards = ndb.StringProperty(required=True, default='')
     successful_attempts = ndb.IntegerProperty(required=True, default=0)
@@ -23,40 +163,185 @@ class Game(ndb.Model):
     total_attempts = ndb.IntegerProperty(required=True, default=0)
     game_over = ndb.BooleanProperty(required=True, default=False)
     move_history = ndb.StringProperty(required=True, default='')
+    board = ndb.BlobProperty()
+    deck_seed = ndb.IntegerProperty(indexed=False)
+    # The current chunk of the packed move log, the ids of the sealed
+    # MoveChunks before it in order.
+    move_log = ndb.BlobProperty()
+    move_chunks = ndb.IntegerProperty(repeated=True, indexed=False)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    saved_version = ndb.IntegerProperty(default=0, indexed=False)
+    # Tokens of the cached state and of the last state written, see
+    # gamecache.py.
+    revision = ndb.StringProperty(indexed=False)
+    saved_revision = ndb.StringProperty(indexed=False)
+    ended = ndb.DateTimeProperty()
+    # Archived games are stubs, see archive.py.
+    archived = ndb.BooleanProperty(default=False)
+    archive = ndb.KeyProperty(kind='GameArchive', indexed=False)
+    archive_index = ndb.IntegerProperty(indexed=False)
 
     @classmethod
-    def new_game(cls, user):
+    def new_game(cls, user, user_name=None, room=None):
         """Creates and returns a new game object instance"""
-        RANKS = ('_A','_2','_3','_4','_5','_6','_7',\
-                 '_8','_9','10','_J','_Q','_K')
-        SUITES = ('H','D','C','S')
-        card_list = []
-        card_string = ''
-        
-        for suite in SUITES:
-            for rank in RANKS:
-                card_list.append(rank + suite)
-        
-        random.shuffle(card_list)
-        card_string = ','.join(card_list)
-        
+        return cls.new_game_async(user, user_name, room).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def new_game_async(cls, user, user_name=None, room=None):
+        """Returns a Future for a new game object instance"""
+        # The deal comes from the pre-dealt pool and only its seed and the
+        # matched positions are stored.
+        seed, deck = decks.pool.take()
+        board = Board(deck)
+
         game = Game(user=user,
-                    cards=card_string,
-                    available_cards=card_string,
+                    user_name=user_name,
+                    room=room,
+                    deck_seed=seed,
+                    board=board.mask_bytes(),
                     successful_attempts=0,
                     failed_attempts=0,
                     total_attempts=0,
                     game_over=False,
                     move_history='')         
-        game.put()
-        
-        return game
 
-    def to_form(self, message):
+        # Adds the game to the user's active games as it is created, the
+        # owner is read while the game is written.
+        @ndb.tasklet
+        def txn():
+            _, owner = yield game.put_async(), user.get_async()
+            owner.active_games.append(game.key)
+            yield owner.put_async()
+        yield ndb.transaction_async(txn, xg=True)
+
+        raise ndb.Return(game)
+
+    def load_board(self):
+        """Returns the Board for this game. Seeded games are dealt again from
+           their seed, games created before that store their whole packed
+           board and older games are read from their comma separated card
+           strings."""
+        if self.deck_seed is not None:
+            return Board.from_mask(decks.cached_deal(self.deck_seed),
+                                   self.board)
+        if self.board:
+            return Board.from_bytes(self.board)
+        return Board.from_strings(self.cards, self.available_cards)
+
+    def matched_mask(self):
+        """Returns the bitmask of matched positions, without dealing the
+           deck when the board is packed"""
+        if self.board:
+            return unpack_matched(self.board)
+        return self.load_board().matched
+
+    def store_board(self, board):
+        """Packs a Board into the game, dropping any legacy card strings"""
+        if self.deck_seed is not None:
+            self.board = board.mask_bytes()
+        else:
+            self.board = board.to_bytes()
+        self.cards = ''
+        self.available_cards = ''
+
+    def dealt_deck(self):
+        """Returns the card codes the game was dealt"""
+        if self.deck_seed is not None:
+            return decks.cached_deal(self.deck_seed)
+        return self.load_board().deck
+
+    def audit(self):
+        """Replays the game's moves on its deal and checks them, along with
+           the game's board and attempt counts
+        Returns:
+            A list of problems, empty if the game is consistent."""
+        moves = list(movelog.iter_all_moves(self.packed_log(),
+                                            self.move_history))
+        problems, matched = decks.verify_moves(self.dealt_deck(), moves)
+        problems = ['Move {}: {}'.format(index, problem)
+                    for index, problem in problems]
+        successes = sum(1 for move in moves if move[5])
+        if matched != self.load_board().matched:
+            problems.append('The board does not match the moves')
+        if len(moves) != self.total_attempts or \
+                successes != self.successful_attempts or \
+                len(moves) - successes != self.failed_attempts:
+            problems.append('The attempt counts do not match the moves')
+        return problems
+
+    def append_move(self, first, second, board, matched):
+        """Appends a move record to the current chunk of the game's binary
+           move log, sealing the chunk once it is full. Sealed chunks are
+           written by put_sealed_chunks."""
+        self.move_log = (self.move_log or '') + movelog.pack_move(
+            self.total_attempts, first, second,
+            board.deck[first], board.deck[second], matched)
+        if movelog.move_count(self.move_log) >= movelog.CHUNK_MOVES:
+            self.__dict__.setdefault('_sealed_chunks', []).append(
+                MoveChunk(parent=self.key, moves=self.move_log))
+            self.move_log = ''
+
+    def put_sealed_chunks(self):
+        """Writes the move chunks sealed since the game was read and records
+           their ids, before the game is stored
+        Returns:
+            The keys of the chunks written."""
+        return self.put_sealed_chunks_async().get_result()
+
+    @ndb.tasklet
+    def put_sealed_chunks_async(self):
+        """Returns a Future for put_sealed_chunks"""
+        keys = yield ndb.put_multi_async(
+            self.__dict__.pop('_sealed_chunks', []))
+        self.move_chunks.extend(key.id() for key in keys)
+        raise ndb.Return(keys)
+
+    @ndb.tasklet
+    def packed_log_async(self, start=0, stop=None):
+        """Returns a Future for the packed records of moves start up to stop
+           of the move log, reading only the sealed chunks they are in"""
+        size = movelog.CHUNK_MOVES
+        sealed = len(self.move_chunks) * size
+        total = sealed + movelog.move_count(self.move_log)
+        stop = total if stop is None else min(stop, total)
+        if start >= stop:
+            raise ndb.Return('')
+        # Archived games keep their whole log in move_log.
+        first = min(start // size, len(self.move_chunks))
+        chunks = yield ndb.get_multi_async(
+            [ndb.Key(MoveChunk, chunk_id, parent=self.key) for chunk_id in
+             self.move_chunks[first:(stop - 1) // size + 1]])
+        log = ''.join(chunk.moves for chunk in chunks)
+        if stop > sealed:
+            log += self.move_log or ''
+        offset = (start - first * size) * movelog.RECORD.size
+        raise ndb.Return(
+            log[offset:offset + (stop - start) * movelog.RECORD.size])
+
+    def packed_log(self):
+        """Returns the whole packed move log"""
+        return self.packed_log_async().get_result()
+
+    @ndb.tasklet
+    def history_page_async(self, page, page_size):
+        """Returns a Future for one page of the move history in text
+           notation"""
+        moves, start, stop = movelog.page_bounds(self.move_history, page,
+                                                 page_size)
+        log = yield self.packed_log_async(start, stop)
+        moves.extend(movelog.format_move(move)
+                     for move in movelog.iter_moves(log))
+        raise ndb.Return(' '.join(moves))
+
+    def to_form(self, message, user_name=None):
         """Returns a GameForm representation of the Game"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        if not (user_name or self.user_name):
+            # Remembered on the game so it is only looked up once.
+            self.user_name = get_user_name(self.user)
+        form.user_name = user_name or self.user_name
         form.successful_attempts = self.successful_attempts
         form.failed_attempts = self.failed_attempts
         form.total_attempts = self.total_attempts
@@ -67,40 +352,135 @@ class Game(ndb.Model):
     def end_game(self, won):
         """Ends the game - if won is True, the player won. - if won is False,
            the player cancelled the game and player win lose record object is 
-           updated."""
-        self.game_over = True
-        self.put()
-        
-        # Creates a new game score object
-        score = Score(user=self.user, 
-                      date=date.today(),
-                      successful_attempts=self.successful_attempts,
-                      failed_attempts=self.failed_attempts,
-                      total_attempts=self.total_attempts,
-                      won=won)
-        score.put()
-        
-        # Update player win/lose record object
-        record = Record.query(Record.user==self.user).get()
-        if won:
-            record.wins += 1
-        else:
-            record.loses += 1
-         
-        record.put()
+           updated. Returns False if the game had already ended."""
+        return self.end_game_async(won).get_result()
+
+    @ndb.tasklet
+    def end_game_async(self, won):
+        """Asynchronous end_game. The Game, its new Score, the player's
+           Record, an average attempts shard, the user's and global
+           statistics and any leaderboard entries are written together with
+           one put_multi in a cross-group transaction. A game in a room also
+           updates the player's RoomRecord and the room's average attempts
+           and leaderboards.
+           Returns a Future for True, or for False if the stored game had
+           already ended, in which case nothing is written and the game is
+           left as stored."""
+        # The game counts globally, None, and in its room if it has one.
+        scopes = [None] + ([self.room] if self.room else [])
+
+        # Moves a legacy record under its user's key before the transaction,
+        # queries cannot run inside it. The score's id is allocated up
+        # front so that its leaderboard entries can be written with it.
+        board_ids = [(Room.scoped(leaderboard.HIGH_SCORES, scope),
+                      Room.scoped(leaderboard.RANKINGS, scope))
+                     for scope in scopes]
+        results = yield ([Record.get_for_user_async(self.user),
+                          Score.allocate_ids_async(size=1, parent=self.user)] +
+                         [leaderboard.get_entries_async(board_id)
+                          for pair in board_ids for board_id in pair])
+        score_id = results[1][0]
+        boards = dict(zip([board_id for pair in board_ids
+                           for board_id in pair], results[2:]))
+
+        @ndb.tasklet
+        def txn():
+            # Only one request ends a game, a cancel racing a win or a
+            # repeated winning move finds it over here.
+            stored = yield self.key.get_async()
+            if stored and stored.game_over:
+                self.populate(**stored.to_dict())
+                raise ndb.Return(False)
+            self.game_over = True
+            self.ended = datetime.now()
+
+            # Creates a new game score object
+            today = date.today()
+            score = Score(id=score_id,
+                          parent=self.user,
+                          user=self.user, 
+                          user_name=self.user_name,
+                          room=self.room,
+                          date=today,
+                          successful_attempts=self.successful_attempts,
+                          failed_attempts=self.failed_attempts,
+                          total_attempts=self.total_attempts,
+                          won=won)
+
+            # Update player win/lose record objects, active games, the
+            # average attempts and the statistics
+            record_keys = [Record.key_for(self.user)] + \
+                [RoomRecord.key_for(self.user, room) for room in scopes[1:]]
+            results = yield ([self.user.get_async(),
+                              stats.prepare_update_async(
+                                  self.user, won, self.total_attempts, today)] +
+                             [key.get_async() for key in record_keys] +
+                             [counters.prepare_add_async(
+                                 Room.scoped(counters.GAME_ATTEMPTS, scope),
+                                 self.total_attempts) for scope in scopes])
+            owner, rollups = results[:2]
+            records = results[2:2 + len(scopes)]
+            shards = results[2 + len(scopes):]
+
+            puts = [self, score] + shards + rollups
+            offers = []
+            for scope, (high_scores, rankings), key, record in \
+                    zip(scopes, board_ids, record_keys, records):
+                if record is None:
+                    if scope is None:
+                        record = Record(key=key)
+                    else:
+                        record = RoomRecord(key=key, room=scope)
+                    record.populate(user=self.user, user_name=self.user_name,
+                                    wins=0, loses=0)
+                if won:
+                    record.wins += 1
+                else:
+                    record.loses += 1
+                puts.append(record)
+
+                # Offers the new score and updated record to the scope's
+                # leaderboards.
+                offers.append((rankings, leaderboard.record_entry(record),
+                               boards[rankings]))
+                if won:
+                    offers.append((high_scores,
+                                   leaderboard.score_entry(score),
+                                   boards[high_scores]))
+
+            if owner and self.key in owner.active_games:
+                owner.active_games.remove(self.key)
+                puts.append(owner)
+            puts.extend(leaderboard.prepare_offers(offers, self.user))
+
+            self.saved_version = self.version
+            self.saved_revision = self.revision
+            yield ndb.put_multi_async(puts)
+            raise ndb.Return(True)
+
+        ended = yield ndb.transaction_async(txn, xg=True)
+        raise ndb.Return(ended)
+
+
+class MoveChunk(ndb.Model):
+    """A sealed chunk of a game's packed move log, stored under the Game"""
+    moves = ndb.BlobProperty(required=True)
 
 
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(indexed=False)
+    room = ndb.KeyProperty(kind='Room')
     date = ndb.DateProperty(required=True)
     successful_attempts = ndb.IntegerProperty(required=True)
     total_attempts = ndb.IntegerProperty(required=True)
     failed_attempts = ndb.IntegerProperty(required=True)
     won = ndb.BooleanProperty(required=True)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, 
+    def to_form(self, user_name=None):
+        return ScoreForm(user_name=(user_name or self.user_name or
+                                    get_user_name(self.user)),
                          date=str(self.date),
                          successful_attempts=self.successful_attempts,
                          total_attempts=self.total_attempts,
@@ -109,16 +489,59 @@ class Score(ndb.Model):
 
 class Record(ndb.Model):
     """Player win/loss record object"""
+    # Records are read right after the game ends that wrote them, when
+    # NDB's memcache only adds calls ahead of the datastore read.
+    _use_memcache = False
+
     user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(indexed=False)
     wins = ndb.IntegerProperty(required=True, default=0)
     loses = ndb.IntegerProperty(required=True, default=0)
 
-    def to_form(self):
-        return RecordForm(user_name=self.user.get().name,
+    @classmethod
+    def key_for(cls, user):
+        """Returns the key of a user's Record, stored under the User"""
+        return ndb.Key(cls, 'record', parent=user)
+
+    @classmethod
+    @ndb.tasklet
+    def get_for_user_async(cls, user):
+        """Returns a user's Record. A Record stored with an automatic id
+           before records were keyed by user is moved under its user's key."""
+        record = yield cls.key_for(user).get_async()
+        if record is None:
+            legacy = yield cls.query(cls.user == user).get_async()
+            if legacy is not None:
+                record = cls(key=cls.key_for(user),
+                             user=user,
+                             user_name=legacy.user_name,
+                             wins=legacy.wins,
+                             loses=legacy.loses)
+                yield record.put_async(), legacy.key.delete_async()
+        raise ndb.Return(record)
+
+    @classmethod
+    def get_for_user(cls, user):
+        """Returns a user's Record"""
+        return cls.get_for_user_async(user).get_result()
+
+    def to_form(self, user_name=None):
+        return RecordForm(user_name=(user_name or self.user_name or
+                                     get_user_name(self.user)),
                           wins=self.wins,
                           loses=self.loses)
 
 
+class RoomRecord(Record):
+    """Player win/loss record within a room, stored under the User"""
+    room = ndb.KeyProperty(required=True, kind='Room')
+
+    @classmethod
+    def key_for(cls, user, room):
+        """Returns the key of a user's RoomRecord in a room"""
+        return ndb.Key(cls, room.id(), parent=user)
+
+
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
     urlsafe_key = messages.StringField(1, required=True)
@@ -133,11 +556,13 @@ class GameForm(messages.Message):
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
+    room = messages.StringField(2)
 
 
 class MakeMoveForm(messages.Message):
@@ -146,6 +571,31 @@ class MakeMoveForm(messages.Message):
     second_choice =  messages.IntegerField(2, required=True)
 
 
+class MoveForm(messages.Message):
+    """A single pair of card choices"""
+    first_choice = messages.IntegerField(1, required=True)
+    second_choice = messages.IntegerField(2, required=True)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make several moves in an existing game at once"""
+    moves = messages.MessageField(MoveForm, 1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """The outcome of one move of a batch of moves"""
+    first_choice = messages.IntegerField(1)
+    second_choice = messages.IntegerField(2)
+    message = messages.StringField(3, required=True)
+    valid = messages.BooleanField(4, required=True)
+
+
+class MoveResultForms(messages.Message):
+    """Return the game state after a batch of moves and each move's outcome"""
+    game = messages.MessageField(GameForm, 1, required=True)
+    results = messages.MessageField(MoveResultForm, 2, repeated=True)
+
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_name = messages.StringField(1, required=True)
@@ -159,11 +609,14 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NumberOfResultsForm(messages.Message):
     """Used to input a number of results for score and rank return info"""
     number_of_results = messages.IntegerField(1, required=False)
+    cursor = messages.StringField(2, required=False)
+    room = messages.StringField(3, required=False)
 
 
 class RecordForm(messages.Message):
@@ -173,9 +626,31 @@ class RecordForm(messages.Message):
     loses = messages.IntegerField(3, required=True)
 
 
+class RankForm(messages.Message):
+    """A users win ranking"""
+    user_name = messages.StringField(1, required=True)
+    rank = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    loses = messages.IntegerField(4, required=True)
+
+
+class StatsForm(messages.Message):
+    """Statistics of a user's or every player's games, attempts are of won
+       games"""
+    user_name = messages.StringField(1)
+    games = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    win_rate = messages.FloatField(4, required=True)
+    best = messages.IntegerField(5)
+    median = messages.IntegerField(6)
+    p90 = messages.IntegerField(7)
+    games_per_day = messages.FloatField(8, required=True)
+
+
 class RecordForms(messages.Message):
     """Return multiple Record Form objects"""
     items = messages.MessageField(RecordForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,88 @@
+"""movelog.py - This file contains the binary move log kept by each Game.
+
+Every move is appended to the log as one fixed width record holding the
+attempt number, both card positions, both card codes and the pairing result.
+The log is only turned into the text history notation when a page of it is
+requested. Games keep the log in chunks of CHUNK_MOVES moves, a full chunk
+is sealed into a MoveChunk entity so each move only copies the current
+one."""
+
+import re
+import struct
+
+from board import CARD_CODES, CARD_LABELS
+
+
+RECORD = struct.Struct('>IBBBBB')
+RESULTS = ('No_Match', 'Match')
+CHUNK_MOVES = 64
+
+# Legacy move_history strings lost the spaces between moves, so moves are
+# split on the leading attempt number instead.
+_LEGACY_MOVE = re.compile(r'\[\d+\][^\[\s]*')
+_LEGACY_FIELDS = re.compile(
+    r'\[(\d+)\](\d+):([^~]+)~(\d+):([^|]+)\|(\w+)')
+
+
+def pack_move(attempt, first, second, card_one, card_two, matched):
+    """Returns a single packed move record"""
+    return RECORD.pack(attempt, first, second, card_one, card_two,
+                       int(matched))
+
+
+def move_count(log):
+    """Returns the number of moves in a packed log"""
+    return len(log or '') // RECORD.size
+
+
+def iter_moves(log, start=0, stop=None):
+    """Yields unpacked move records from start up to stop"""
+    if stop is None:
+        stop = move_count(log)
+    for offset in range(start * RECORD.size, stop * RECORD.size,
+                        RECORD.size):
+        yield RECORD.unpack_from(log, offset)
+
+
+def format_move(move):
+    """Returns the text notation of an unpacked move record"""
+    attempt, first, second, card_one, card_two, matched = move
+    return '[{}]{}:{}~{}:{}|{}'.format(attempt,
+                                       first, CARD_LABELS[card_one],
+                                       second, CARD_LABELS[card_two],
+                                       RESULTS[matched])
+
+
+def legacy_moves(move_history):
+    """Splits a legacy move_history string into its moves"""
+    return _LEGACY_MOVE.findall(move_history or '')
+
+
+def parse_legacy_move(text):
+    """Returns a legacy move notation as an unpacked move record"""
+    attempt, first, card_one, second, card_two, result = \
+        _LEGACY_FIELDS.match(text).groups()
+    return (int(attempt), int(first), int(second), CARD_CODES[card_one],
+            CARD_CODES[card_two], RESULTS.index(result))
+
+
+def iter_all_moves(log, move_history):
+    """Yields every move of a game as an unpacked move record, legacy
+       move_history moves first"""
+    for text in legacy_moves(move_history):
+        yield parse_legacy_move(text)
+    for move in iter_moves(log):
+        yield move
+
+
+def page_bounds(move_history, page, page_size):
+    """Splits one page of a game history between its legacy move_history
+       string, whose moves come first, and the packed log
+    Returns:
+        The text notation of the page's legacy moves and the start and
+        stop of its moves in the packed log."""
+    start = page * page_size
+    stop = start + page_size
+    legacy = legacy_moves(move_history)
+    return (legacy[start:stop], max(start - len(legacy), 0),
+            max(stop - len(legacy), 0))
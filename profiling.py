@@ -0,0 +1,215 @@
+"""profiling.py - This file contains the request profiling of the endpoints.
+
+Every endpoint method is wrapped with instrumented, which records the wall
+time of the request, the number and latency of its datastore calls, its
+memcache hits and misses and the time spent serializing its response.
+Datastore and memcache calls are observed through API proxy hooks, so NDB
+and direct memcache calls are both counted. Measurements are aggregated into
+in-process histograms, one set per instance, that the admin metrics handler
+in main.py reports.
+
+A sampled fraction of requests can also be run under cProfile, set
+PROFILE_SAMPLE_RATE in the environment of app.yaml to turn it on."""
+
+import bisect
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import random
+import threading
+from collections import deque
+from StringIO import StringIO
+from timeit import default_timer
+
+from google.appengine.api import apiproxy_stub_map
+from protorpc import protojson
+
+
+# Upper bounds of the histogram buckets, in milliseconds for latencies and
+# in calls for counts. The last bucket holds everything above them.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+SERIALIZATION_SAMPLE_RATE = 0.1
+SLOW_REQUEST_MS = 1000
+PROFILE_LINES = 40
+MAX_PROFILES = 20
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_profiles = deque(maxlen=MAX_PROFILES)
+_request = threading.local()
+_hooks_installed = False
+
+
+class Histogram(object):
+    """Fixed bucket histogram of a measurement"""
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket holding a percentile, no
+           more than the largest value seen"""
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                if index < len(BUCKETS):
+                    return min(BUCKETS[index], self.max)
+                return self.max
+        return None
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'max': self.max,
+                'buckets': self.buckets}
+
+
+def record(endpoint, name, value):
+    """Adds a measurement of an endpoint to its histogram"""
+    with _lock:
+        histogram = _histograms.get((endpoint, name))
+        if histogram is None:
+            histogram = _histograms[(endpoint, name)] = Histogram()
+        histogram.add(value)
+
+
+def increment(endpoint, name, delta=1):
+    """Adds to a named counter of an endpoint"""
+    with _lock:
+        _counters[(endpoint, name)] = _counters.get((endpoint, name), 0) + delta
+
+
+def snapshot():
+    """Returns the histograms and counters of this instance by endpoint"""
+    endpoints = {}
+    with _lock:
+        for (endpoint, name), histogram in _histograms.items():
+            endpoints.setdefault(endpoint, {})[name] = histogram.to_dict()
+        for (endpoint, name), count in _counters.items():
+            endpoints.setdefault(endpoint, {})[name] = count
+    return {'buckets': BUCKETS,
+            'profile_sample_rate': PROFILE_SAMPLE_RATE,
+            'endpoints': endpoints}
+
+
+def profiles():
+    """Returns the most recent sampled request profiles, newest first"""
+    with _lock:
+        return list(reversed(_profiles))
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _profiles.clear()
+
+
+def _pre_call(service, call, request, response, rpc):
+    stats = getattr(_request, 'stats', None)
+    if stats is not None:
+        stats['started'][id(rpc)] = default_timer()
+
+
+def _post_call(service, call, request, response, rpc, error):
+    stats = getattr(_request, 'stats', None)
+    if stats is None:
+        return
+    started = stats['started'].pop(id(rpc), None)
+    if service == 'datastore_v3':
+        stats['datastore_calls'] += 1
+        if started is not None:
+            stats['datastore_ms'] += (default_timer() - started) * 1000
+    elif service == 'memcache' and call == 'Get' and not error:
+        hits = response.item_size()
+        stats['memcache_hits'] += hits
+        stats['memcache_misses'] += request.key_size() - hits
+
+
+def install_hooks():
+    """Registers the API proxy hooks that observe datastore and memcache
+       calls, once per instance"""
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'profiling', _pre_call)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'profiling', _post_call)
+    _hooks_installed = True
+
+
+def _store_profile(endpoint, profile):
+    output = StringIO()
+    stats = pstats.Stats(profile, stream=output)
+    stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+    logging.info('Profile of %s:\n%s', endpoint, output.getvalue())
+    with _lock:
+        _profiles.append({'endpoint': endpoint,
+                          'profile': output.getvalue()})
+
+
+def instrumented(method):
+    """Decorator that records the metrics of an endpoint method, placed
+       below endpoints.method"""
+    endpoint = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(service, request):
+        stats = {'started': {}, 'datastore_calls': 0, 'datastore_ms': 0.0,
+                 'memcache_hits': 0, 'memcache_misses': 0}
+        _request.stats = stats
+        profile = None
+        if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            profile = cProfile.Profile()
+        start = default_timer()
+        try:
+            if profile:
+                result = profile.runcall(method, service, request)
+            else:
+                result = method(service, request)
+        except Exception:
+            increment(endpoint, 'errors')
+            raise
+        finally:
+            wall_ms = (default_timer() - start) * 1000
+            _request.stats = None
+            record(endpoint, 'wall_ms', wall_ms)
+            record(endpoint, 'datastore_calls', stats['datastore_calls'])
+            record(endpoint, 'datastore_ms', stats['datastore_ms'])
+            increment(endpoint, 'memcache_hits', stats['memcache_hits'])
+            increment(endpoint, 'memcache_misses', stats['memcache_misses'])
+            if profile:
+                _store_profile(endpoint, profile)
+            if wall_ms > SLOW_REQUEST_MS:
+                logging.warning('Slow request %s: %.0fms, %d datastore calls '
+                                'taking %.0fms', endpoint, wall_ms,
+                                stats['datastore_calls'],
+                                stats['datastore_ms'])
+
+        # The response is serialized again by the endpoints framework, only
+        # a sample of requests pays for measuring it.
+        if random.random() < SERIALIZATION_SAMPLE_RATE:
+            start = default_timer()
+            protojson.encode_message(result)
+            record(endpoint, 'serialize_ms',
+                   (default_timer() - start) * 1000)
+        return result
+    return wrapper
@@ -0,0 +1,153 @@
+"""reminders.py - This file contains the daily reminder email pipeline.
+
+The daily cron queues the first batch task of the day. Each batch task pages
+one batch of users with an email, queues the task for the next batch and
+then sends the batch's mails concurrently through a mail sink. A
+ReminderLog under each user records the day it was last reminded, written as
+soon as its mail is sent, so that a retried batch does not mail the same
+user twice."""
+
+import logging
+import threading
+import time
+from Queue import Empty, Queue
+from google.appengine.api import app_identity, mail
+from google.appengine.ext import ndb
+import jobs
+from models import User
+
+
+BATCH_SIZE = 100
+MAIL_WORKERS = 10
+BATCH_URL = '/tasks/send_reminders'
+SUBJECT = 'This is a reminder!'
+ACTIVE_GAMES_BODY = ('Hello {}, you still have some active incomplete games, '
+                     'why not give the Concentration another try!')
+NO_GAMES_BODY = 'Hello {}, try out Concentration!'
+
+
+class ReminderLog(ndb.Model):
+    """The day a user was last sent a reminder, stored under the User"""
+    sent = ndb.DateProperty(required=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, user):
+        return ndb.Key(cls, 'reminder', parent=user)
+
+
+class AppEngineMailSink(object):
+    """Sends mail with the App Engine mail service"""
+    def send(self, sender, to, subject, body):
+        mail.send_mail(sender, to, subject, body)
+
+
+class StubMailSink(object):
+    """Collects mail instead of sending it, waiting latency seconds per mail
+       to stand in for the mail service when measuring throughput"""
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, sender, to, subject, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.sent.append((sender, to, subject, body))
+
+
+def send_all(sink, mails, workers=MAIL_WORKERS, on_sent=None):
+    """Sends (sender, to, subject, body) mails on a pool of worker threads
+    Args:
+        sink: The mail sink to send through
+        mails: The list of mails
+        workers: The number of threads to send on
+        on_sent: Called on the sending thread with the index of each mail
+            once it has been sent
+    Returns:
+        A list of the indexes of the mails that were sent."""
+    work = Queue()
+    for index, message in enumerate(mails):
+        work.put((index, message))
+    sent = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                index, message = work.get_nowait()
+            except Empty:
+                return
+            try:
+                sink.send(*message)
+            except Exception:
+                logging.exception('Reminder to %s was not sent', message[1])
+                continue
+            if on_sent:
+                on_sent(index)
+            with lock:
+                sent.append(index)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(mails)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(sent)
+
+
+def _task_name(run_date, batch):
+    return 'reminders-{}-{}'.format(run_date.strftime('%Y%m%d'), batch)
+
+
+def queue_batch(run_date, batch, cursor=None):
+    """Queues a batch task. Tasks are named by day and batch number so a
+       repeated cron run or a retried batch does not queue a batch twice."""
+    params = {'date': run_date.isoformat(), 'batch': batch}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    if not jobs.schedule(BATCH_URL, params,
+                         name=_task_name(run_date, batch)):
+        logging.info('Reminder batch %s for %s is already queued',
+                     batch, run_date)
+
+
+def send_batch(run_date, batch, cursor=None, sink=None,
+               workers=MAIL_WORKERS):
+    """Sends the reminders of one batch of users and queues the next batch
+    Args:
+        run_date: The day the reminders are for
+        batch: The number of the batch, counting from 0
+        cursor: The datastore Cursor the batch starts from
+        sink: The mail sink to send through, the App Engine mail service
+            by default
+        workers: The number of threads to send on
+    Returns:
+        The number of reminders sent."""
+    # A != filter runs as two queries, which cannot be paged with cursors,
+    # every email sorts after None.
+    users, next_cursor, more = User.query(User.email > None)\
+        .fetch_page(BATCH_SIZE, start_cursor=cursor)
+    if more and next_cursor:
+        queue_batch(run_date, batch + 1, next_cursor)
+
+    logs = ndb.get_multi([ReminderLog.key_for(user.key) for user in users])
+    pending = [user for user, log in zip(users, logs)
+               if not log or log.sent != run_date]
+    sender = 'noreply@{}.appspotmail.com'.format(
+        app_identity.get_application_id())
+    mails = []
+    for user in pending:
+        body = ACTIVE_GAMES_BODY if user.active_game_keys() else NO_GAMES_BODY
+        mails.append((sender, user.email, SUBJECT, body.format(user.name)))
+
+    # Each user's log is written as soon as their mail is sent, a batch
+    # that fails part way is retried only for the users not yet mailed.
+    def record(index):
+        ReminderLog(key=ReminderLog.key_for(pending[index].key),
+                    sent=run_date).put()
+
+    sent = send_all(sink or AppEngineMailSink(), mails, workers, record)
+    return len(sent)
+
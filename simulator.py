@@ -0,0 +1,127 @@
+"""simulator.py - This file contains an offline Concentration game simulator.
+
+Games are dealt from a seed with decks.py and evaluated with board.py
+exactly as the API does, but without the datastore, so the game logic can
+be exercised and measured anywhere. A strategy picks each pair of positions
+and is shown both cards once the pair has been played, the same information
+a player gets from make_move."""
+
+import random
+from collections import OrderedDict
+from board import DECK_SIZE, Board, pair_key
+import decks
+
+
+MAX_MOVES = 10000
+
+
+class RandomStrategy(object):
+    """Plays two random unmatched positions every move"""
+    def __init__(self, rng=random):
+        self.rng = rng
+
+    def reset(self):
+        pass
+
+    def choose(self, unmatched):
+        return self.rng.sample(unmatched, 2)
+
+    def observe(self, first, card_one, second, card_two, matched):
+        pass
+
+
+class MemoryStrategy(object):
+    """Remembers the cards it has seen, up to capacity positions or every
+       position if capacity is None. Plays a remembered pair when it knows
+       one, otherwise turns over positions it does not remember."""
+    def __init__(self, rng=random, capacity=None):
+        self.rng = rng
+        self.capacity = capacity
+        self.reset()
+
+    def reset(self):
+        # Remembered position -> pair key, oldest first, and the remembered
+        # positions of every pair key.
+        self.memory = OrderedDict()
+        self.positions = {}
+        self.known_pairs = []
+
+    def _forget(self, position):
+        key = self.memory.pop(position)
+        self.positions[key].remove(position)
+
+    def _remember(self, position, card):
+        if position in self.memory:
+            self.memory.pop(position)
+            self.memory[position] = pair_key(card)
+            return
+        if self.capacity is not None and len(self.memory) >= self.capacity:
+            self._forget(next(iter(self.memory)))
+        key = pair_key(card)
+        self.memory[position] = key
+        seen = self.positions.setdefault(key, [])
+        seen.append(position)
+        if len(seen) == 2:
+            self.known_pairs.append(key)
+
+    def choose(self, unmatched):
+        while self.known_pairs:
+            seen = self.positions[self.known_pairs[-1]]
+            if len(seen) == 2:
+                return seen[0], seen[1]
+            self.known_pairs.pop()
+
+        unseen = [position for position in unmatched
+                  if position not in self.memory]
+        if len(unseen) >= 2:
+            return self.rng.sample(unseen, 2)
+        first = unseen[0] if unseen else self.rng.choice(unmatched)
+        second = self.rng.choice(unmatched)
+        while second == first:
+            second = self.rng.choice(unmatched)
+        return first, second
+
+    def observe(self, first, card_one, second, card_two, matched):
+        if matched:
+            for position in (first, second):
+                if position in self.memory:
+                    self._forget(position)
+        else:
+            self._remember(first, card_one)
+            self._remember(second, card_two)
+
+
+STRATEGIES = {
+    'random': RandomStrategy,
+    'perfect': MemoryStrategy,
+    'limited': lambda rng: MemoryStrategy(rng, capacity=8),
+}
+
+
+def play_game(strategy, rng=random, max_moves=MAX_MOVES):
+    """Deals and plays one game to the end
+    Returns:
+        The number of moves, the total_attempts the game would finish with."""
+    board = Board(decks.deal(rng.getrandbits(decks.SEED_BITS)))
+    unmatched = list(range(DECK_SIZE))
+    strategy.reset()
+    moves = 0
+    while unmatched and moves < max_moves:
+        first, second = strategy.choose(unmatched)
+        matched = board.flip(first, second)
+        moves += 1
+        strategy.observe(first, board.deck[first], second,
+                         board.deck[second], matched)
+        if matched:
+            unmatched.remove(first)
+            unmatched.remove(second)
+    return moves
+
+
+def simulate(strategy_name, games, seed=None):
+    """Plays a number of games with a named strategy
+    Returns:
+        A list of the moves each game took."""
+    rng = random.Random(seed)
+    strategy = STRATEGIES[strategy_name](rng)
+    return [play_game(strategy, rng) for _ in range(games)]
@@ -0,0 +1,158 @@
+"""stats.py - This file contains the per-user and global game statistics.
+
+Statistics are rolled up as games end instead of being computed from Scores.
+Each rollup counts games and wins, remembers the first and last day played
+and keeps a fixed-bucket histogram of the total_attempts of won games, from
+which the best, median and p90 are read. A user's rollup is a UserStats
+entity under the User. The global rollup is spread over NUM_SHARDS
+GlobalStatsShard entities, read together with one get_multi."""
+
+import random
+import struct
+from google.appengine.ext import ndb
+import models
+
+
+NUM_SHARDS = 20
+MEMCACHE_GLOBAL_STATS = 'STATS:global'
+MEMCACHE_EXPIRY = 60
+
+# Lower bounds of the histogram buckets. Attempts below 100 are counted
+# exactly, then in tens up to 1000, and the last bucket holds the rest.
+BUCKETS = tuple(range(100)) + tuple(range(100, 1001, 10))
+_HISTOGRAM = struct.Struct('>{}I'.format(len(BUCKETS)))
+
+
+def bucket_index(attempts):
+    """Returns the histogram bucket that a number of attempts falls in"""
+    if attempts < 100:
+        return max(attempts, 0)
+    return min(100 + (attempts - 100) // 10, len(BUCKETS) - 1)
+
+
+class Stats(ndb.Model):
+    """Games, wins, days played and a histogram of the total_attempts of
+       won games"""
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    best = ndb.IntegerProperty(indexed=False)
+    first_played = ndb.DateProperty(indexed=False)
+    last_played = ndb.DateProperty(indexed=False)
+    attempts = ndb.BlobProperty()
+
+    def histogram(self):
+        """Returns the histogram as a list of counts per bucket"""
+        if not self.attempts:
+            return [0] * len(BUCKETS)
+        return list(_HISTOGRAM.unpack(self.attempts))
+
+    def add_game(self, won, total_attempts, day):
+        """Counts an ended game"""
+        self.games = (self.games or 0) + 1
+        self.first_played = min(self.first_played or day, day)
+        self.last_played = max(self.last_played or day, day)
+        if won:
+            self.wins = (self.wins or 0) + 1
+            self.best = min(self.best or total_attempts, total_attempts)
+            counts = self.histogram()
+            counts[bucket_index(total_attempts)] += 1
+            self.attempts = _HISTOGRAM.pack(*counts)
+
+    def merge(self, other):
+        """Adds the counts of another rollup to this one"""
+        if not other.games:
+            return
+        self.games = (self.games or 0) + other.games
+        self.wins = (self.wins or 0) + (other.wins or 0)
+        if other.best is not None:
+            self.best = min(self.best or other.best, other.best)
+        self.first_played = min(self.first_played or other.first_played,
+                                other.first_played)
+        self.last_played = max(self.last_played or other.last_played,
+                               other.last_played)
+        self.attempts = _HISTOGRAM.pack(*[
+            mine + theirs for mine, theirs
+            in zip(self.histogram(), other.histogram())])
+
+    def percentile(self, fraction):
+        """Returns the lower bound of the bucket holding a percentile of the
+           won games' total_attempts, or None if no game was won"""
+        counts = self.histogram()
+        rank = fraction * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[index]
+        return None
+
+    def to_form(self, user_name=None):
+        days = 1
+        if self.first_played and self.last_played:
+            days = (self.last_played - self.first_played).days + 1
+        games = self.games or 0
+        return models.StatsForm(
+            user_name=user_name,
+            games=games,
+            wins=self.wins or 0,
+            win_rate=float(self.wins or 0) / games if games else 0.0,
+            best=self.best,
+            median=self.percentile(0.5),
+            p90=self.percentile(0.9),
+            games_per_day=float(games) / days)
+
+
+class UserStats(Stats):
+    """A user's statistics, stored under the User"""
+    @classmethod
+    def key_for(cls, user):
+        return ndb.Key(cls, 'stats', parent=user)
+
+
+class GlobalStatsShard(Stats):
+    """One shard of the statistics of every game"""
+    pass
+
+
+def _shard_keys():
+    return [ndb.Key(GlobalStatsShard, index)
+            for index in range(1, NUM_SHARDS + 1)]
+
+
+@ndb.tasklet
+def prepare_update_async(user, won, total_attempts, day):
+    """Counts an ended game in a user's statistics and a randomly chosen
+       global shard and returns both. Must be called inside a transaction
+       that puts them."""
+    shard_key = ndb.Key(GlobalStatsShard, random.randint(1, NUM_SHARDS))
+    user_stats, shard = yield (UserStats.key_for(user).get_async(),
+                               shard_key.get_async())
+    user_stats = user_stats or UserStats(key=UserStats.key_for(user))
+    shard = shard or GlobalStatsShard(key=shard_key)
+    for stats in (user_stats, shard):
+        stats.add_game(won, total_attempts, day)
+    raise ndb.Return([user_stats, shard])
+
+
+def get_user_stats_async(user):
+    """Returns a Future for a user's UserStats or None"""
+    return UserStats.key_for(user).get_async()
+
+
+@ndb.tasklet
+def get_global_stats_async():
+    """Returns a Future for the statistics of every game, merged from the
+       shards and cached briefly in memcache"""
+    context = ndb.get_context()
+    cached = yield context.memcache_get(MEMCACHE_GLOBAL_STATS)
+    if cached is not None:
+        raise ndb.Return(cached)
+
+    merged = Stats()
+    shards = yield ndb.get_multi_async(_shard_keys())
+    for shard in shards:
+        if shard:
+            merged.merge(shard)
+    yield context.memcache_set(MEMCACHE_GLOBAL_STATS, merged,
+                               time=MEMCACHE_EXPIRY)
+    raise ndb.Return(merged)
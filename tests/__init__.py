@@ -0,0 +1,21 @@
+"""Tests of the datastore, memcache and task queue paths, run against the
+App Engine SDK testbed stubs. Point GAE_SDK at the SDK's google_appengine
+directory unless it is on the PYTHONPATH already, and run from the project
+root:
+
+    GAE_SDK=~/google_appengine python -m unittest discover tests"""
+
+import os
+import sys
+
+if os.environ.get('GAE_SDK'):
+    sys.path.insert(0, os.path.expanduser(os.environ['GAE_SDK']))
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The libraries appengine_config.py adds in production.
+if os.path.isdir(os.path.join(ROOT, 'lib')):
+    sys.path.insert(0, os.path.join(ROOT, 'lib'))
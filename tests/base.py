@@ -0,0 +1,48 @@
+"""base.py - This file contains the test case the tests share."""
+
+import unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+class TestbedCase(unittest.TestCase):
+    """Activates fresh datastore, memcache, task queue and mail stubs for
+       every test. Queries see every write, as in a strongly consistent
+       datastore."""
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # The endpoints server reads the minor version from the version id.
+        self.testbed.setup_env(current_version_id='testbed.1',
+                               overwrite=True)
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def tasks(self, url=None):
+        """Returns the queued tasks, only those for url if given"""
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        return stub.get_filtered_tasks(url=url)
+
+    def new_user(self, name='alice'):
+        from models import User
+        return User.create(name, name + '@example.com')
+
+    def new_game(self, user):
+        from models import Game
+        return Game.new_game(user.key, user.name)
+
+    def reload(self, entity):
+        """Returns a fresh copy of an entity from the datastore"""
+        ndb.get_context().clear_cache()
+        return entity.key.get(use_cache=False)
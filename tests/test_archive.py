@@ -0,0 +1,74 @@
+"""test_archive.py - Tests of archiving finished games."""
+
+import random
+
+import tests
+from tests.base import TestbedCase
+
+import api
+import archive
+import gamecache
+import movelog
+from api import ConcentrationApi, GAME_HISTORY_REQUEST, GET_GAME_REQUEST
+from board import DECK_SIZE
+from archive import GameArchive
+from models import MoveChunk
+
+MOVES = movelog.CHUNK_MOVES * 2 + 10
+
+
+class ArchiveTest(TestbedCase):
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        self.game = self.new_game(self.new_user())
+        self.key = self.game.key
+        rng = random.Random(3)
+        for _ in range(MOVES):
+            board = gamecache.get(self.key).load_board()
+            unmatched = [position for position in range(DECK_SIZE)
+                         if not board.is_matched(position)]
+            if len(unmatched) < 2:
+                break
+            first, second = rng.sample(unmatched, 2)
+            gamecache.update(self.key, lambda game: api._with_changed(
+                api._play_move(game, first, second)))
+        gamecache.end_game(gamecache.get(self.key), won=False)
+
+    def _history(self, page, page_size=50):
+        return ConcentrationApi().get_game_history(
+            GAME_HISTORY_REQUEST.combined_message_class(
+                urlsafe_game_key=self.key.urlsafe(), page=page,
+                page_size=page_size))
+
+    def _get_game(self):
+        return ConcentrationApi().get_game(
+            GET_GAME_REQUEST.combined_message_class(
+                urlsafe_game_key=self.key.urlsafe()))
+
+    def test_archived_game_reads_as_before(self):
+        pages = [self._history(page) for page in range(MOVES // 50 + 1)]
+        game_form = self._get_game()
+        self.assertTrue(MoveChunk.query(ancestor=self.key).count())
+
+        self.assertEqual(archive.archive_batch(legacy=True), (1, None))
+        stub = self.reload(self.game)
+        self.assertTrue(stub.archived)
+        self.assertIsNone(stub.move_log)
+        self.assertEqual(MoveChunk.query(ancestor=self.key).count(), 0)
+        self.assertEqual(GameArchive.query().count(), 1)
+
+        self.assertEqual([self._history(page)
+                          for page in range(MOVES // 50 + 1)], pages)
+        self.assertEqual(self._get_game(), game_form)
+        self.assertEqual(archive.rehydrate(stub).audit(), [])
+
+    def test_archived_games_are_not_archived_again(self):
+        archive.archive_batch(legacy=True)
+        self.assertEqual(archive.archive_batch(legacy=True), (0, None))
+        self.assertEqual(GameArchive.query().count(), 1)
+
+    def test_pack_round_trip(self):
+        game = self.reload(self.game)
+        unpacked, = archive.unpack_games(archive.pack_games([game]))
+        self.assertEqual(unpacked.key, game.key)
+        self.assertEqual(unpacked.to_dict(), game.to_dict())
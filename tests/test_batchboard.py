@@ -0,0 +1,40 @@
+"""test_batchboard.py - Tests of the NumPy batch game engine."""
+
+import random
+import unittest
+
+import tests
+
+import decks
+from board import DECK_SIZE, Board
+
+try:
+    import numpy
+    import batchboard
+except ImportError:
+    numpy = None
+
+
+@unittest.skipUnless(numpy, 'NumPy is not installed')
+class BatchBoardTest(unittest.TestCase):
+    def test_seeded_batch_plays_like_boards(self):
+        rng = random.Random(7)
+        seeds = [decks.new_seed() for _ in range(8)]
+        batch = batchboard.BatchBoard.from_seeds(seeds)
+        boards = [Board(decks.deal(seed)) for seed in seeds]
+        self.assertEqual([board.deck for board in batch.to_boards()],
+                         [board.deck for board in boards])
+
+        for _ in range(200):
+            moves = [rng.sample(range(DECK_SIZE), 2) for _ in boards]
+            valid, pairs = batch.apply(moves)
+            for board, (first, second), played, paired in \
+                    zip(boards, moves, valid, pairs):
+                if board.complete or board.is_matched(first) or \
+                        board.is_matched(second):
+                    self.assertFalse(played)
+                    continue
+                self.assertTrue(played)
+                self.assertEqual(board.flip(first, second), paired)
+        self.assertEqual([board.matched for board in batch.to_boards()],
+                         [board.matched for board in boards])
@@ -0,0 +1,55 @@
+"""test_counters.py - Tests of the sharded aggregate counters."""
+
+import tests
+from tests.base import TestbedCase
+
+from google.appengine.api import memcache
+import counters
+
+NAME = 'test_aggregate'
+
+
+class CountersTest(TestbedCase):
+    def _cached(self):
+        shards = memcache.get(counters.MEMCACHE_SHARDS + NAME)
+        return tuple(map(sum, zip(*shards)))
+
+    def test_sums_follow_updates(self):
+        counters.add(NAME, 10)
+        self.assertEqual(counters.get(NAME), (1, 10))
+        counters.add(NAME, 5, count=2)
+        self.assertEqual(counters.get(NAME), (3, 15))
+
+    def test_update_while_shards_are_evicted(self):
+        counters.add(NAME, 10)
+        self.assertEqual(counters.get(NAME), (1, 10))
+        memcache.flush_all()
+        counters.add(NAME, 4)
+        self.assertEqual(counters.get(NAME), (2, 14))
+        self.assertEqual(self._cached(), (2, 14))
+
+    def test_updates_raise_cached_shards(self):
+        counters.add(NAME, 10)
+        self.assertEqual(counters.get(NAME), (1, 10))
+        counters.add(NAME, 4)
+        self.assertEqual(self._cached(), (2, 14))
+
+        # A commit whose cache update runs after a later one's is ignored.
+        shards = memcache.get(counters.MEMCACHE_SHARDS + NAME)
+        index = max(range(counters.NUM_SHARDS), key=lambda i: shards[i][0])
+        stale = counters.AggregateShard(count=shards[index][0] - 1, total=0)
+        counters._cache_shard(NAME, index, stale)
+        self.assertEqual(counters.get(NAME), (2, 14))
+
+    def test_read_claimed_before_an_update_is_not_cached(self):
+        counters.add(NAME, 10)
+        memcache.flush_all()
+        # A read claims the cache and fetches the shards, then an update
+        # commits before it caches them.
+        client = memcache.Client()
+        cache_key = counters.MEMCACHE_SHARDS + NAME
+        client.add(cache_key, counters.MEMCACHE_CLAIM)
+        client.gets(cache_key)
+        counters.add(NAME, 4)
+        self.assertFalse(client.cas(cache_key, [(1, 10)]))
+        self.assertEqual(counters.get(NAME), (2, 14))
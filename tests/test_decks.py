@@ -0,0 +1,68 @@
+"""test_decks.py - Tests of seeded deals and game audits."""
+
+import tests
+from tests.base import TestbedCase
+
+import decks
+import movelog
+from api import ConcentrationApi, MAKE_MOVE_REQUEST
+from board import DECK_SIZE, pair_key
+
+
+class DealTest(TestbedCase):
+    def test_seed_deals_the_same_deck(self):
+        seed = decks.new_seed()
+        self.assertLess(seed, 1 << decks.SEED_BITS)
+        deck = decks.deal(seed)
+        self.assertEqual(sorted(deck), list(range(DECK_SIZE)))
+        self.assertEqual(decks.deal(seed), deck)
+        self.assertEqual(decks.cached_deal(seed), deck)
+        self.assertNotEqual(decks.deal(seed + 1), deck)
+
+    def test_pool_remembers_its_deals(self):
+        seed, deck = decks.DeckPool(size=2).take()
+        self.assertEqual(decks.deal(seed), deck)
+        self.assertEqual(decks.cached_deal(seed), deck)
+
+
+class AuditTest(TestbedCase):
+    def setUp(self):
+        super(AuditTest, self).setUp()
+        self.game = self.new_game(self.new_user())
+
+    def _play(self, moves):
+        api = ConcentrationApi()
+        for first, second in moves:
+            api.make_move(MAKE_MOVE_REQUEST.combined_message_class(
+                urlsafe_game_key=self.game.key.urlsafe(),
+                first_choice=first, second_choice=second))
+
+    def test_played_game_replays_from_its_seed(self):
+        deck = decks.deal(self.game.deck_seed)
+        pairs = {}
+        for position in range(DECK_SIZE):
+            pairs.setdefault(pair_key(deck[position]), []).append(position)
+        pair = sorted(pairs.values())[0]
+        miss = next(position for position in range(DECK_SIZE)
+                    if pair_key(deck[position]) != pair_key(deck[pair[0]]))
+        self._play([(pair[0], miss), tuple(pair), (pair[0], miss)])
+
+        game = self.reload(self.game)
+        self.assertIsNotNone(game.deck_seed)
+        self.assertEqual(game.dealt_deck(), deck)
+        self.assertEqual(game.audit(), [])
+        moves = list(movelog.iter_all_moves(game.packed_log(),
+                                            game.move_history))
+        self.assertEqual([move[1:3] for move in moves],
+                         [(pair[0], miss), tuple(pair)])
+
+    def test_audit_finds_a_tampered_game(self):
+        self._play([(0, 1)])
+        game = self.reload(self.game)
+        game.deck_seed += 1
+        self.assertTrue(game.audit())
+
+        game = self.reload(self.game)
+        game.total_attempts += 1
+        self.assertIn('The attempt counts do not match the moves',
+                      game.audit())
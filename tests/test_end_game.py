@@ -0,0 +1,46 @@
+"""test_end_game.py - Tests of ending games."""
+
+import tests
+from tests.base import TestbedCase
+
+from models import Record, Score
+
+
+class EndGameTest(TestbedCase):
+    def setUp(self):
+        super(EndGameTest, self).setUp()
+        self.user = self.new_user()
+        self.game = self.new_game(self.user)
+
+    def test_end_game_writes_score_and_record(self):
+        self.assertTrue(self.game.end_game(won=False))
+        self.assertTrue(self.reload(self.game).game_over)
+        self.assertEqual(Score.query(ancestor=self.user.key).count(), 1)
+        self.assertEqual(Record.key_for(self.user.key).get().loses, 1)
+
+    def test_racing_ends_write_once(self):
+        # Two requests that both read the game before either ended it.
+        first = self.reload(self.game)
+        second = self.reload(self.game)
+        self.assertTrue(first.end_game(won=False))
+        self.assertFalse(second.end_game(won=True))
+
+        self.assertTrue(second.game_over)
+        self.assertEqual(Score.query(ancestor=self.user.key).count(), 1)
+        record = self.reload(Record(key=Record.key_for(self.user.key)))
+        self.assertEqual((record.wins, record.loses), (0, 1))
+
+    def test_cancel_racing_an_end_is_not_found(self):
+        import endpoints
+        import gamecache
+        from api import ConcentrationApi, GET_GAME_REQUEST
+        request = GET_GAME_REQUEST.combined_message_class(
+            urlsafe_game_key=self.game.key.urlsafe())
+        # The cache still holds the game as it was before it ended.
+        gamecache.store(self.game)
+        self.reload(self.game).end_game(won=False)
+
+        with self.assertRaises(endpoints.NotFoundException):
+            ConcentrationApi().cancel_game(request)
+        self.assertEqual(Score.query(ancestor=self.user.key).count(), 1)
+        self.assertTrue(gamecache.get(self.game.key).game_over)
@@ -0,0 +1,56 @@
+"""test_export.py - Tests of the export task."""
+
+import unittest
+
+import tests
+from tests.base import TestbedCase
+
+import webapp2
+
+try:
+    import cloudstorage
+except ImportError:
+    cloudstorage = None
+
+
+class ExportTaskTest(TestbedCase):
+    def setUp(self):
+        super(ExportTaskTest, self).setUp()
+        self.testbed.init_blobstore_stub()
+        self.testbed.init_urlfetch_stub()
+        game = self.new_game(self.new_user())
+        game.end_game(won=False)
+
+    def post(self, **params):
+        import main
+        request = webapp2.Request.blank('/tasks/export', POST=params)
+        return request.get_response(main.app)
+
+    @unittest.skipUnless(cloudstorage, 'the client library is not in lib/')
+    def test_exports_part_to_cloud_storage(self):
+        from google.appengine.api import app_identity
+        response = self.post(kind='scores', part='0', folder='exports/test',
+                             format='csv')
+        self.assertEqual(response.status_int, 204)
+        path = '/{}/exports/test/scores-00000.csv'.format(
+            app_identity.get_default_gcs_bucket_name())
+        with cloudstorage.open(path) as exported:
+            rows = exported.read().splitlines()
+        self.assertEqual(len(rows), 2)
+
+    @unittest.skipIf(cloudstorage, 'the client library is in lib/')
+    def test_fails_clearly_without_client_library(self):
+        response = self.post(kind='scores', part='0', folder='exports/test',
+                             format='csv')
+        self.assertEqual(response.status_int, 500)
+
+
+class ExportColumnsTest(TestbedCase):
+    def test_names_old_rows_do_not_store_are_resolved(self):
+        import export
+        from models import Record
+        user = self.new_user('bob')
+        record = Record.key_for(user.key).get()
+        record.user_name = None
+        self.assertEqual(export.record_columns([record])['user_name'],
+                         ['bob'])
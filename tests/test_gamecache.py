@@ -0,0 +1,141 @@
+"""test_gamecache.py - Tests of the game state cache."""
+
+import threading
+
+import tests
+from tests.base import TestbedCase
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+import endpoints
+import gamecache
+from models import Game
+
+
+def _append(token):
+    """Returns a mutate that records a move as a token in the history"""
+    def mutate(game):
+        game.move_history += token
+        return token, True
+    return mutate
+
+
+class GameCacheTest(TestbedCase):
+    def setUp(self):
+        super(GameCacheTest, self).setUp()
+        self.game = self.new_game(self.new_user())
+        self.key = self.game.key
+
+    def _patch(self, owner, name, value):
+        original = getattr(owner, name)
+        setattr(owner, name, value)
+        self.addCleanup(setattr, owner, name, original)
+
+    def _saved(self):
+        return memcache.get(gamecache._saved_key(self.key))
+
+    def test_update_applies_and_writes_move(self):
+        game, result = gamecache.update(self.key, _append('a'))
+        self.assertEqual(result, 'a')
+        stored = self.reload(self.game)
+        self.assertEqual((stored.move_history, stored.version), ('a', 1))
+        self.assertEqual(stored.saved_revision, game.revision)
+        self.assertEqual(self._saved(), game.revision)
+        self.assertEqual(gamecache.get(self.key).revision, game.revision)
+
+    def test_unchanged_update_writes_nothing(self):
+        gamecache.update(self.key, lambda game: ('rejected', False))
+        self.assertEqual(self.reload(self.game).version, 0)
+
+    def test_fallback_move_survives_later_cached_moves(self):
+        gamecache.store(self.game)
+        # Every cas loses for the first move, as if other requests kept
+        # updating the game, so it is made in the fallback transaction.
+        attempts = gamecache.CAS_ATTEMPTS
+        self._patch(gamecache, 'CAS_ATTEMPTS', 0)
+        gamecache.update(self.key, _append('a'))
+        gamecache.CAS_ATTEMPTS = attempts
+        gamecache.update(self.key, _append('b'))
+        gamecache.update(self.key, _append('c'))
+        self.assertEqual(self.reload(self.game).move_history, 'abc')
+        self.assertEqual(gamecache.get(self.key).move_history, 'abc')
+
+    def test_fallback_keeps_moves_not_yet_written(self):
+        self._patch(gamecache, 'DURABLE_MOVES', False)
+        gamecache.update(self.key, _append('a'))
+        self.assertEqual(self.reload(self.game).move_history, '')
+        self._patch(gamecache, 'CAS_ATTEMPTS', 0)
+        gamecache.update(self.key, _append('b'))
+        self.assertEqual(self.reload(self.game).move_history, 'ab')
+
+    def test_failed_write_takes_move_back_out_of_cache(self):
+        gamecache.update(self.key, _append('a'))
+
+        def fail(game, **ctx_options):
+            raise datastore_errors.Timeout()
+        self._patch(Game, 'put_async', fail)
+        with self.assertRaises(datastore_errors.Timeout):
+            gamecache.update(self.key, _append('b'))
+        del Game.put_async
+        self.assertEqual(gamecache.get(self.key).move_history, 'a')
+        gamecache.update(self.key, _append('c'))
+        self.assertEqual(self.reload(self.game).move_history, 'ac')
+
+    def test_move_waits_out_an_unconfirmed_write(self):
+        gamecache.update(self.key, _append('a'))
+        # A write that never confirmed, the move goes through the
+        # transaction, which confirms the state it writes.
+        memcache.set(gamecache._saved_key(self.key), 'lost')
+        self._patch(gamecache, 'WAIT_ATTEMPTS', 2)
+        game, _ = gamecache.update(self.key, _append('b'))
+        self.assertEqual(self.reload(self.game).move_history, 'ab')
+        self.assertEqual(self._saved(), game.saved_revision)
+        gamecache.update(self.key, _append('c'))
+        self.assertEqual(self.reload(self.game).move_history, 'abc')
+
+    def test_claimed_game_is_read_but_not_moved(self):
+        cache_key = gamecache._cache_key(self.key)
+        memcache.set(cache_key, gamecache.MEMCACHE_CLAIM + 'other')
+        self.assertEqual(gamecache.get(self.key).key, self.key)
+        self.assertEqual(gamecache.get_multi([self.key])[0].key, self.key)
+        self._patch(gamecache, 'WAIT_ATTEMPTS', 2)
+        with self.assertRaises(endpoints.ConflictException):
+            gamecache.update(self.key, _append('a'))
+        self.assertEqual(self.reload(self.game).move_history, '')
+
+    def test_end_game_keeps_cached_moves(self):
+        self._patch(gamecache, 'DURABLE_MOVES', False)
+        stale = self.reload(self.game)
+        gamecache.update(self.key, _append('a'))
+        self.assertTrue(gamecache.end_game(stale, won=False))
+        stored = self.reload(self.game)
+        self.assertEqual((stored.move_history, stored.game_over),
+                         ('a', True))
+        cached = gamecache.get(self.key)
+        self.assertEqual(cached.revision, stored.revision)
+        self.assertEqual(self._saved(), stored.saved_revision)
+
+    def test_concurrent_moves_are_all_written(self):
+        acknowledged = []
+        errors = []
+
+        def play(thread):
+            for move in range(8):
+                token = '{}{};'.format(thread, move)
+                try:
+                    gamecache.update(self.key, _append(token))
+                    acknowledged.append(token)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=play, args=(thread,))
+                   for thread in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stored = self.reload(self.game).move_history
+        self.assertEqual(sorted(stored.split(';')[:-1]),
+                         sorted(token[:-1] for token in acknowledged))
+        self.assertEqual(gamecache.get(self.key).move_history, stored)
+        self.assertEqual(len(acknowledged) + len(errors), 32)
@@ -0,0 +1,83 @@
+"""test_jobs.py - Tests of the background job scheduler."""
+
+import unittest
+
+import tests
+from tests.base import TestbedCase
+
+from google.appengine.ext import ndb
+import jobs
+
+URL = '/tasks/test'
+
+
+class Clock(object):
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class LocalSchedulingTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock(1000)
+        self.executor = jobs.LocalExecutor(self.clock)
+        self.addCleanup(jobs.set_executor, jobs.set_executor(self.executor))
+
+    def test_named_jobs_are_queued_once(self):
+        self.assertTrue(jobs.schedule(URL, name='step-1'))
+        self.assertFalse(jobs.schedule(URL, name='step-1'))
+        self.assertTrue(jobs.schedule(URL))
+        self.assertEqual((self.executor.requested, self.executor.queued),
+                         (3, 2))
+
+    def test_triggers_in_a_window_share_one_job(self):
+        for offset in range(0, 60, 5):
+            self.clock.now = 1000 + offset
+            jobs.coalesce('merge', URL, window=60)
+        self.assertEqual(self.executor.queued, 2)
+
+        runs = []
+        dispatch = lambda url, params: runs.append(url)
+        self.clock.now = 1019
+        self.assertEqual(self.executor.run_due(dispatch), 0)
+        self.clock.now = 1020
+        self.assertEqual(self.executor.run_due(dispatch), 1)
+        self.clock.now = 1080
+        self.assertEqual(self.executor.run_due(dispatch), 1)
+        self.assertEqual(runs, [URL, URL])
+
+    def test_transactional_triggers_claim_their_window(self):
+        self.assertTrue(jobs.coalesce('merge', URL, window=60,
+                                      transactional=True))
+        self.assertFalse(jobs.coalesce('merge', URL, window=60,
+                                       transactional=True))
+        self.clock.now = 1020
+        self.assertTrue(jobs.coalesce('merge', URL, window=60,
+                                      transactional=True))
+
+
+class TaskQueueSchedulingTest(TestbedCase):
+    def test_named_jobs_are_queued_once(self):
+        self.assertTrue(jobs.schedule(URL, {'batch': 1}, name='step-1'))
+        self.assertFalse(jobs.schedule(URL, {'batch': 1}, name='step-1'))
+        self.assertEqual(len(self.tasks(URL)), 1)
+
+    def test_transactional_job_is_claimed_once_committed(self):
+        @ndb.transactional
+        def trigger():
+            return jobs.coalesce('merge', URL, window=60,
+                                 transactional=True)
+        self.assertTrue(trigger())
+        self.assertFalse(trigger())
+        self.assertEqual(len(self.tasks(URL)), 1)
+
+    def test_rolled_back_trigger_queues_nothing(self):
+        @ndb.transactional
+        def trigger():
+            jobs.coalesce('merge', URL, window=60, transactional=True)
+            raise ndb.Rollback()
+        trigger()
+        self.assertEqual(self.tasks(URL), [])
+        self.assertFalse(jobs.get_executor().is_claimed('merge'))
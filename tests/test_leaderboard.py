@@ -0,0 +1,87 @@
+"""test_leaderboard.py - Tests of the materialized leaderboards."""
+
+import tests
+from tests.base import TestbedCase
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+import leaderboard
+from leaderboard import PendingEntry, RANKINGS
+from models import Record
+
+
+class LeaderboardTest(TestbedCase):
+    def setUp(self):
+        super(LeaderboardTest, self).setUp()
+        self.users = [self.new_user(name).key
+                      for name in ('alice', 'bob', 'carol', 'dave')]
+
+    def _record(self, user, wins, loses):
+        record = Record(key=Record.key_for(user), user=user,
+                        user_name=user.id(), wins=wins, loses=loses)
+        record.put()
+        return record
+
+    def _offer(self, record):
+        # As in Game.end_game, the entries are read before the transaction.
+        entries = leaderboard.get_entries(RANKINGS)
+
+        @ndb.transactional
+        def txn():
+            pending = leaderboard.prepare_offers(
+                [(RANKINGS, leaderboard.record_entry(record), entries)],
+                record.user)
+            ndb.put_multi(pending)
+            return len(pending)
+        return txn()
+
+    def test_merge_orders_entries_and_keeps_latest(self):
+        alice, bob, carol, _ = self.users
+        self._offer(self._record(alice, 2, 1))
+        self._offer(self._record(bob, 3, 0))
+        self._offer(self._record(alice, 3, 2))
+        self._offer(self._record(carol, 3, 1))
+        self.assertEqual(
+            len(self.tasks(leaderboard.MERGE_URL)), 1)
+
+        self.assertEqual(leaderboard.merge_pending(), 4)
+        self.assertEqual(PendingEntry.query().count(), 0)
+        entries = leaderboard.get_entries(RANKINGS)
+        self.assertEqual([(entry['user_name'], entry['wins'], entry['loses'])
+                          for entry in entries],
+                         [('bob', 3, 0), ('carol', 3, 1), ('alice', 3, 2),
+                          ('dave', 0, 0)])
+        self.assertEqual(leaderboard.merge_pending(), 0)
+
+    def test_rebuild_reads_records(self):
+        alice, bob, _, _ = self.users
+        self._record(alice, 1, 4)
+        self._record(bob, 1, 0)
+        entries = leaderboard.get_entries(RANKINGS)
+        self.assertEqual([entry['user_name'] for entry in entries],
+                         ['bob', 'alice', 'carol', 'dave'])
+        self.assertIsNotNone(ndb.Key(leaderboard.Leaderboard,
+                                     RANKINGS).get())
+
+    def test_rank_outside_leaderboard_counts_ties_with_fewer_loses(self):
+        alice, bob, carol, dave = self.users
+        records = [self._record(alice, 5, 0), self._record(bob, 2, 1),
+                   self._record(carol, 2, 3), self._record(dave, 2, 3)]
+        # An empty stored leaderboard, so every rank is counted.
+        leaderboard.Leaderboard(id=RANKINGS, entries=[]).put()
+        self.assertEqual([leaderboard.get_rank(record)
+                          for record in records], [1, 2, 3, 3])
+
+    def test_read_does_not_replace_entries_cached_by_a_merge(self):
+        leaderboard.Leaderboard(id=RANKINGS, entries=[]).put()
+        merged = [leaderboard.record_entry(self._record(self.users[0], 1, 0))]
+
+        # A merge commits and caches its entries after a read that missed
+        # the cache has read the stored entries.
+        def merge(cls, key, future):
+            memcache.set(leaderboard.MEMCACHE_LEADERBOARD + RANKINGS, merged)
+        leaderboard.Leaderboard._post_get_hook = classmethod(merge)
+        self.addCleanup(delattr, leaderboard.Leaderboard, '_post_get_hook')
+
+        self.assertEqual(leaderboard.get_entries(RANKINGS), [])
+        self.assertEqual(leaderboard.get_entries(RANKINGS), merged)
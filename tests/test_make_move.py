@@ -0,0 +1,90 @@
+"""test_make_move.py - Tests of the make_move endpoint."""
+
+import tests
+from tests.base import TestbedCase
+
+from api import ConcentrationApi, GAME_OVER_MESSAGE, MAKE_MOVE_REQUEST,\
+    MAKE_MOVES_REQUEST, SAME_CHOICE_MESSAGE
+from board import DECK_SIZE, pair_key
+from models import MoveForm, Score
+
+
+class MakeMoveTest(TestbedCase):
+    def setUp(self):
+        super(MakeMoveTest, self).setUp()
+        self.user = self.new_user()
+        self.game = self.new_game(self.user)
+
+    def _move(self, first_choice, second_choice):
+        request = MAKE_MOVE_REQUEST.combined_message_class(
+            urlsafe_game_key=self.game.key.urlsafe(),
+            first_choice=first_choice, second_choice=second_choice)
+        return ConcentrationApi().make_move(request)
+
+    def test_malformed_move_on_finished_game_is_game_over(self):
+        self.game.end_game(won=False)
+        form = self._move(3, 3)
+        self.assertEqual(form.message, GAME_OVER_MESSAGE)
+        self.assertTrue(form.game_over)
+
+    def test_malformed_move_on_open_game_is_rejected(self):
+        self.assertEqual(self._move(3, 3).message, SAME_CHOICE_MESSAGE)
+
+    def test_malformed_move_ends_fully_matched_game(self):
+        # Every pair was matched but the request that matched the last one
+        # never ended the game.
+        self.game.successful_attempts = 26
+        self.game.put()
+        form = self._move(3, 3)
+        self.assertEqual(form.message, 'You win!')
+        self.assertTrue(self.reload(self.game).game_over)
+        self.assertEqual(Score.query(ancestor=self.user.key).count(), 1)
+
+
+class MakeMovesTest(TestbedCase):
+    def setUp(self):
+        super(MakeMovesTest, self).setUp()
+        self.user = self.new_user()
+        self.game = self.new_game(self.user)
+
+    def _pairs(self):
+        """Returns the positions of every pair on the game's board"""
+        deck = self.game.load_board().deck
+        pairs = {}
+        for position in range(DECK_SIZE):
+            pairs.setdefault(pair_key(deck[position]), []).append(position)
+        return sorted(pairs.values())
+
+    def _moves(self, moves):
+        request = MAKE_MOVES_REQUEST.combined_message_class(
+            urlsafe_game_key=self.game.key.urlsafe(),
+            moves=[MoveForm(first_choice=first, second_choice=second)
+                   for first, second in moves])
+        return ConcentrationApi().make_moves(request)
+
+    def test_batch_stops_at_first_invalid_move(self):
+        first, second = self._pairs()[0]
+        forms = self._moves([(first, second), (first, second), (0, 1)])
+        self.assertEqual([result.valid for result in forms.results],
+                         [True, False])
+        game = self.reload(self.game)
+        self.assertEqual((game.total_attempts, game.successful_attempts),
+                         (1, 1))
+
+    def test_game_ending_part_way_through_batch(self):
+        pairs = self._pairs()
+        # The last pair is matched in the middle of the batch, the moves
+        # after it are not played.
+        forms = self._moves(pairs + [pairs[0], (0, 1)])
+        self.assertEqual(len(forms.results), 27)
+        self.assertTrue(all(result.valid for result in forms.results))
+        self.assertEqual(forms.results[-1].message, 'You win!')
+        self.assertTrue(forms.game.game_over)
+
+        game = self.reload(self.game)
+        self.assertTrue(game.game_over)
+        self.assertEqual((game.total_attempts, game.successful_attempts),
+                         (26, 26))
+        self.assertEqual(Score.query(ancestor=self.user.key).count(), 1)
+        self.assertEqual(self._moves([(0, 1)]).game.message,
+                         GAME_OVER_MESSAGE)
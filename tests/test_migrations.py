@@ -0,0 +1,76 @@
+"""test_migrations.py - Tests of the user key migration."""
+
+from datetime import date
+
+import tests
+from tests.base import TestbedCase
+
+from google.appengine.ext import ndb
+import leaderboard
+import migrations
+from models import User, Room, Record, RoomRecord, Score
+
+
+class MigrateUserTest(TestbedCase):
+    def setUp(self):
+        super(MigrateUserTest, self).setUp()
+        # A user keyed by an automatic id, as users were before.
+        self.user = User(name='Bob')
+        self.user.put()
+        Record(user=self.user.key, wins=1, loses=0).put()
+        Score(parent=self.user.key, user=self.user.key, date=date.today(),
+              successful_attempts=26, failed_attempts=4, total_attempts=30,
+              won=True).put()
+        self.new_key = User.key_for('Bob')
+
+    def test_moves_user_and_scores(self):
+        self.assertTrue(migrations.migrate_user(self.user))
+        self.assertEqual(self.new_key.get().name, 'Bob')
+        self.assertIsNone(self.user.key.get())
+        self.assertEqual(Record.key_for(self.new_key).get().wins, 1)
+        scores = Score.query(ancestor=self.new_key).fetch()
+        self.assertEqual([score.user_name for score in scores], ['Bob'])
+
+    def test_retry_after_failed_delete_does_not_duplicate_scores(self):
+        delete_multi = ndb.delete_multi
+
+        def fail(keys):
+            raise RuntimeError('deadline exceeded')
+        migrations.ndb.delete_multi = fail
+        try:
+            with self.assertRaises(RuntimeError):
+                migrations.migrate_user(self.user)
+        finally:
+            migrations.ndb.delete_multi = delete_multi
+
+        self.assertTrue(migrations.migrate_user(self.user))
+        self.assertEqual(Score.query(ancestor=self.new_key).count(), 1)
+        self.assertEqual(Score.query().count(), 1)
+
+    def test_moves_room_records_and_pending_entries(self):
+        room = Room.create_async('Spring Ladder').get_result().key
+        RoomRecord(key=RoomRecord.key_for(self.user.key, room),
+                   user=self.user.key, room=room, wins=2, loses=1).put()
+        record_id = self.user.key.urlsafe()
+        leaderboard.PendingEntry(
+            parent=self.user.key, board_id=Room.scoped(leaderboard.RANKINGS,
+                                                       room),
+            entry={'id': record_id, 'user_name': None, 'wins': 2,
+                   'loses': 1}).put()
+
+        self.assertTrue(migrations.migrate_user(self.user))
+        moved = RoomRecord.key_for(self.new_key, room).get()
+        self.assertEqual((moved.wins, moved.loses, moved.user_name),
+                         (2, 1, 'Bob'))
+        self.assertEqual(RoomRecord.query(ancestor=self.user.key).count(), 0)
+        pending = leaderboard.PendingEntry.query().fetch()
+        self.assertEqual([entry.key.parent() for entry in pending],
+                         [self.new_key])
+        self.assertEqual(pending[0].entry['id'], self.new_key.urlsafe())
+
+    def test_last_batch_clears_room_leaderboards(self):
+        room = Room.create_async('Spring Ladder').get_result().key
+        board_id = Room.scoped(leaderboard.RANKINGS, room)
+        leaderboard.Leaderboard(id=board_id, entries=[]).put()
+        self.assertIsNone(migrations.migrate_users())
+        self.assertIsNone(leaderboard.Leaderboard.get_by_id(board_id))
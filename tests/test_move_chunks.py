@@ -0,0 +1,93 @@
+"""test_move_chunks.py - Tests of the chunked move log."""
+
+import tests
+from tests.base import TestbedCase
+
+from google.appengine.ext import ndb
+import archive
+import gamecache
+import movelog
+from models import Game, MoveChunk
+
+MOVES = movelog.CHUNK_MOVES * 2 + 10
+
+
+class MoveChunkTest(TestbedCase):
+    def setUp(self):
+        super(MoveChunkTest, self).setUp()
+        self.game = self.new_game(self.new_user())
+        self.records = []
+
+    def _move(self, game):
+        board = game.load_board()
+        first = game.total_attempts % 52
+        second = (first + 1) % 52
+        self.records.append(movelog.pack_move(
+            game.total_attempts, first, second,
+            board.deck[first], board.deck[second], False))
+        game.append_move(first, second, board, False)
+        game.total_attempts += 1
+        return None, True
+
+    def _play(self, moves=MOVES):
+        for _ in range(moves):
+            gamecache.update(self.game.key, self._move)
+
+    def test_full_chunks_are_sealed(self):
+        self._play()
+        game = self.reload(self.game)
+        self.assertEqual(len(game.move_chunks), 2)
+        self.assertEqual(movelog.move_count(game.move_log), 10)
+        self.assertEqual(game.packed_log(), ''.join(self.records))
+        self.assertEqual(gamecache.get(self.game.key).packed_log(),
+                         ''.join(self.records))
+
+    def test_history_pages_span_chunks(self):
+        self._play()
+        game = self.reload(self.game)
+        moves = [movelog.format_move(move) for move in
+                 movelog.iter_moves(''.join(self.records))]
+        for page in range(MOVES // 25 + 1):
+            self.assertEqual(
+                game.history_page_async(page, 25).get_result(),
+                ' '.join(moves[page * 25:page * 25 + 25]))
+
+    def test_chunks_of_a_lost_cas_are_deleted(self):
+        self._play(movelog.CHUNK_MOVES - 1)
+        # Every cas of a moved game loses, claims still go through.
+        cas = ndb.Context.memcache_cas
+
+        def lose(context, key, value, **options):
+            if isinstance(value, Game):
+                future = ndb.Future()
+                future.set_result(False)
+                return future
+            return cas(context, key, value, **options)
+        ndb.Context.memcache_cas = lose
+        try:
+            self._play(1)
+        finally:
+            ndb.Context.memcache_cas = cas
+        # Only the chunk written by the fallback transaction is left.
+        game = self.reload(self.game)
+        self.assertEqual(MoveChunk.query(ancestor=self.game.key)
+                         .fetch(keys_only=True),
+                         [MoveChunk(parent=self.game.key,
+                                    id=game.move_chunks[0]).key])
+        # Every attempt at the last move packed the same record.
+        self.assertEqual(game.packed_log(), ''.join(self.records[:64]))
+
+    def test_archive_folds_chunks(self):
+        self._play()
+        game = self.reload(self.game)
+        game.game_over = True
+        self.assertEqual(archive.archive_games([game]), 1)
+
+        self.assertEqual(MoveChunk.query(ancestor=self.game.key).count(), 0)
+        full = archive.rehydrate(self.reload(self.game))
+        self.assertEqual(full.move_chunks, [])
+        self.assertEqual(full.packed_log(), ''.join(self.records))
+        moves = [movelog.format_move(move) for move in
+                 movelog.iter_moves(''.join(self.records))]
+        self.assertEqual(full.history_page_async(3, 25).get_result(),
+                         ' '.join(moves[75:100]))
@@ -0,0 +1,57 @@
+"""test_reminders.py - Tests of the daily reminder emails."""
+
+from datetime import date
+
+import tests
+from tests.base import TestbedCase
+
+from google.appengine.ext import ndb
+import reminders
+from reminders import ReminderLog, StubMailSink
+
+
+class FailingSink(StubMailSink):
+    """Fails to send to some addresses and checks, as each mail is sent,
+       that every mail sent before it was logged"""
+    def __init__(self, users, failing=()):
+        super(FailingSink, self).__init__()
+        self.users = users
+        self.failing = failing
+        self.unlogged = []
+
+    def send(self, sender, to, subject, body):
+        for _, address, _, _ in self.sent:
+            if not ReminderLog.key_for(self.users[address]).get():
+                self.unlogged.append(address)
+        if to in self.failing:
+            raise RuntimeError('Mail service unavailable')
+        super(FailingSink, self).send(sender, to, subject, body)
+
+
+class RemindersTest(TestbedCase):
+    def setUp(self):
+        super(RemindersTest, self).setUp()
+        self.today = date(2016, 5, 1)
+        self.users = dict((user.email, user.key) for user in
+                          [self.new_user(name)
+                           for name in ('alice', 'bob', 'carol')])
+
+    def _send(self, sink):
+        # Every batch task runs in a request of its own.
+        ndb.get_context().clear_cache()
+        return reminders.send_batch(self.today, 0, sink=sink, workers=1)
+
+    def test_each_recipient_is_logged_as_it_is_sent(self):
+        sink = FailingSink(self.users)
+        self.assertEqual(self._send(sink), 3)
+        self.assertEqual(sink.unlogged, [])
+
+    def test_retry_sends_only_to_users_not_yet_mailed(self):
+        self.assertEqual(
+            self._send(FailingSink(self.users, ['bob@example.com'])), 2)
+
+        retry = FailingSink(self.users)
+        self.assertEqual(self._send(retry), 1)
+        self.assertEqual([to for _, to, _, _ in retry.sent],
+                         ['bob@example.com'])
+        self.assertEqual(self._send(FailingSink(self.users)), 0)
@@ -0,0 +1,84 @@
+"""test_rooms.py - Tests of rooms and their leaderboards."""
+
+import tests
+from tests.base import TestbedCase
+
+import endpoints
+from google.appengine.ext import ndb
+import leaderboard
+from api import (ConcentrationApi, CREATE_ROOM_REQUEST, NEW_GAME_REQUEST,
+                 NUMBER_OF_RESULTS_REQUEST, ROOM_REQUEST, USER_RANK_REQUEST)
+from models import Room
+
+ROOM = 'Spring Open'
+
+
+class RoomTest(TestbedCase):
+    def setUp(self):
+        super(RoomTest, self).setUp()
+        self.api = ConcentrationApi()
+        self.api.create_room(CREATE_ROOM_REQUEST.combined_message_class(
+            room=ROOM, description='A tournament'))
+        for name in ('alice', 'bob', 'carol'):
+            self.new_user(name)
+
+    def _end(self, user_name, won, attempts, room=None):
+        form = self.api.new_game(NEW_GAME_REQUEST.combined_message_class(
+            user_name=user_name, room=room))
+        game = ndb.Key(urlsafe=form.urlsafe_key).get()
+        game.total_attempts = attempts
+        game.end_game(won=won)
+
+    def _rankings(self, room=None):
+        forms = self.api.get_user_rankings(
+            NUMBER_OF_RESULTS_REQUEST.combined_message_class(room=room))
+        return [(form.user_name, form.wins, form.loses)
+                for form in forms.items]
+
+    def _high_scores(self, room=None):
+        forms = self.api.get_high_scores(
+            NUMBER_OF_RESULTS_REQUEST.combined_message_class(room=room))
+        return [(form.user_name, form.total_attempts) for form in forms.items]
+
+    def _average(self, room=None):
+        return self.api.get_average_attempts(
+            ROOM_REQUEST.combined_message_class(room=room)).message
+
+    def _rank(self, user_name, room=None):
+        form = self.api.get_user_rank(USER_RANK_REQUEST.combined_message_class(
+            user_name=user_name, room=room))
+        return form.rank, form.wins, form.loses
+
+    def test_room_names_are_unique(self):
+        self.assertIsNotNone(Room.key_for(' spring open ').get())
+        with self.assertRaises(endpoints.ConflictException):
+            self.api.create_room(CREATE_ROOM_REQUEST.combined_message_class(
+                room='SPRING OPEN'))
+        with self.assertRaises(endpoints.NotFoundException):
+            self._rankings('Autumn Open')
+
+    def test_room_games_count_in_the_room_and_globally(self):
+        self._end('alice', True, 40, ROOM)
+        self._end('bob', False, 50, ROOM)
+        self._end('carol', True, 30)
+        leaderboard.merge_pending()
+
+        self.assertEqual(self._rankings(ROOM),
+                         [('alice', 1, 0), ('bob', 0, 1)])
+        self.assertEqual(sorted(self._rankings()),
+                         [('alice', 1, 0), ('bob', 0, 1), ('carol', 1, 0)])
+        self.assertEqual(self._high_scores(ROOM), [('alice', 40)])
+        self.assertEqual(self._high_scores(), [('carol', 30), ('alice', 40)])
+        self.assertEqual(self._average(ROOM),
+                         'The average amount of moves per game is 45.00')
+        self.assertEqual(self._average(),
+                         'The average amount of moves per game is 40.00')
+
+        self.assertEqual(self._rank('bob', ROOM), (2, 0, 1))
+        self.assertEqual(self._rank('alice', ROOM), (1, 1, 0))
+        with self.assertRaises(endpoints.NotFoundException):
+            self._rank('carol', ROOM)
+
+    def test_empty_room_has_no_average(self):
+        self._end('carol', True, 30)
+        self.assertEqual(self._average(ROOM), '')
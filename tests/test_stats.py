@@ -0,0 +1,60 @@
+"""test_stats.py - Tests of the statistics rollups."""
+
+from datetime import date
+
+import tests
+from tests.base import TestbedCase
+
+from protorpc import message_types
+import stats
+from api import ConcentrationApi, USER_NAME_REQUEST
+
+
+class RollupTest(TestbedCase):
+    def test_histogram_percentiles_and_merge(self):
+        first = stats.Stats()
+        for attempts in (30, 40, 50, 60, 1500):
+            first.add_game(True, attempts, date(2016, 5, 1))
+        first.add_game(False, 10, date(2016, 5, 3))
+        self.assertEqual((first.games, first.wins, first.best), (6, 5, 30))
+        self.assertEqual(first.percentile(0.5), 50)
+        self.assertEqual(first.percentile(0.9), stats.BUCKETS[-1])
+
+        second = stats.Stats()
+        second.add_game(True, 255, date(2016, 4, 30))
+        first.merge(second)
+        self.assertEqual((first.games, first.wins, first.best), (7, 6, 30))
+        self.assertEqual(first.histogram()[stats.bucket_index(255)], 1)
+        self.assertEqual((first.first_played, first.last_played),
+                         (date(2016, 4, 30), date(2016, 5, 3)))
+
+        form = first.to_form()
+        self.assertEqual(form.games_per_day, 7 / 4.0)
+        self.assertEqual(form.win_rate, 6 / 7.0)
+
+
+class StatsEndpointsTest(TestbedCase):
+    def _end(self, user, won, attempts):
+        game = self.new_game(user)
+        game.total_attempts = attempts
+        game.end_game(won=won)
+
+    def test_ended_games_roll_up_per_user_and_globally(self):
+        alice, bob = self.new_user('alice'), self.new_user('bob')
+        self._end(alice, True, 40)
+        self._end(alice, False, 12)
+        self._end(bob, True, 30)
+
+        api = ConcentrationApi()
+        form = api.get_user_stats(
+            USER_NAME_REQUEST.combined_message_class(user_name='alice'))
+        self.assertEqual((form.user_name, form.games, form.wins, form.best),
+                         ('alice', 2, 1, 40))
+        form = api.get_global_stats(message_types.VoidMessage())
+        self.assertEqual((form.games, form.wins, form.best), (3, 2, 30))
+
+    def test_user_without_games_has_empty_stats(self):
+        self.new_user('carol')
+        form = ConcentrationApi().get_user_stats(
+            USER_NAME_REQUEST.combined_message_class(user_name='carol'))
+        self.assertEqual((form.games, form.wins, form.best), (0, 0, None))
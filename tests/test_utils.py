@@ -0,0 +1,29 @@
+"""test_utils.py - Tests of the shared helpers."""
+
+import unittest
+
+import tests
+
+import endpoints
+from utils import get_list_page, get_page_size
+
+
+class ListPageTest(unittest.TestCase):
+    def test_pages_follow_cursors(self):
+        items = range(5)
+        self.assertEqual(get_list_page(items, 2), ([0, 1], '2'))
+        self.assertEqual(get_list_page(items, 2, '4'), ([4], None))
+
+    def test_malformed_cursors_are_rejected(self):
+        for cursor in ('abc', '-2'):
+            with self.assertRaises(endpoints.BadRequestException):
+                get_list_page(range(5), 2, cursor)
+
+
+class PageSizeTest(unittest.TestCase):
+    def test_page_sizes_are_clamped(self):
+        self.assertEqual(get_page_size(None), 20)
+        self.assertEqual(get_page_size(-5), 1)
+        self.assertEqual(get_page_size(1000), 100)
+        self.assertEqual(get_page_size(-5, 100, 500), 1)
+        self.assertEqual(get_page_size(1000, 100, 500), 500)
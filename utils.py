@@ -1,20 +1,33 @@
 """utils.py - File for collecting general utility functions."""
 
-import logging
+import threading
+from collections import OrderedDict
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+
+MEMCACHE_USER_NAME = 'USER_NAME:'
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+USER_NAME_CACHE_SIZE = 1000
+
+# Bounded in-process LRU of user key -> user name. User names never change
+# once a User is created so cached names do not need to be invalidated.
+_user_names = OrderedDict()
+_user_names_lock = threading.Lock()
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key a urlsafe key string encodes without fetching the
+        entity. Raises an error if the key String is malformed or points to
+        an entity of the incorrect kind
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The Key the urlsafe Key string encodes.
     Raises:
         ValueError:"""
     try:
@@ -27,9 +40,184 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
+    if key.kind() != model._get_kind():
+        raise ValueError('Incorrect Kind')
+    return key
+
+
+def get_by_urlsafe(urlsafe, model):
+    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+        that the type of entity returned is of the correct kind. Raises an
+        error if the key String is malformed or the entity is of the incorrect
+        kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    entity = get_key_by_urlsafe(urlsafe, model).get()
     if not entity:
         return None
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+@ndb.tasklet
+def get_user_names_async(keys):
+    """Returns a dict of user key -> user name for a list of User keys. Names
+        are looked up in the in-process cache, then memcache, and any that are
+        left are fetched with a single ndb.get_multi.
+    Args:
+        keys: A list of User keys, duplicates are allowed
+    Returns:
+        A Future for a dict mapping each key to the User's name, or to None
+        if the User does not exist."""
+    names = {}
+    missing = []
+    with _user_names_lock:
+        for key in keys:
+            if key in names:
+                continue
+            if key in _user_names:
+                names[key] = _user_names.pop(key)
+                _user_names[key] = names[key]
+            else:
+                names[key] = None
+                missing.append(key)
+    if not missing:
+        raise ndb.Return(names)
+
+    context = ndb.get_context()
+    cached = yield [context.memcache_get(MEMCACHE_USER_NAME + key.urlsafe())
+                    for key in missing]
+    found = dict((key, name) for key, name in zip(missing, cached)
+                 if name is not None)
+    fetch = [key for key in missing if key not in found]
+    if fetch:
+        users = yield ndb.get_multi_async(fetch)
+        fetched = dict((key, user.name) for key, user
+                       in zip(fetch, users) if user)
+        yield [context.memcache_set(MEMCACHE_USER_NAME + key.urlsafe(), name)
+               for key, name in fetched.iteritems()]
+        found.update(fetched)
+
+    with _user_names_lock:
+        for key, name in found.iteritems():
+            _user_names[key] = name
+            names[key] = name
+        while len(_user_names) > USER_NAME_CACHE_SIZE:
+            _user_names.popitem(last=False)
+    raise ndb.Return(names)
+
+
+def get_user_names(keys):
+    """Returns a dict of user key -> user name for a list of User keys"""
+    return get_user_names_async(keys).get_result()
+
+
+def get_user_name(key):
+    """Returns the name of the User a key points to"""
+    return get_user_names([key])[key]
+
+
+@ndb.tasklet
+def to_forms_async(entities, *args):
+    """Returns the forms of a list of Game, Score or Record entities. The
+        names of users that are not stored on the entities are resolved in
+        one batch before the forms are built.
+    Args:
+        entities: An iterable of entities with a user key and user_name
+        args: Arguments passed on to each entity's to_form
+    Returns:
+        A Future for a list of forms in the same order as the entities."""
+    entities = list(entities)
+    names = yield get_user_names_async([entity.user for entity in entities
+                                        if not entity.user_name])
+    raise ndb.Return([entity.to_form(*args, user_name=names.get(entity.user))
+                      for entity in entities])
+
+
+def to_forms(entities, *args):
+    """Returns the forms of a list of Game, Score or Record entities"""
+    return to_forms_async(entities, *args).get_result()
+
+
+@ndb.tasklet
+def to_form_async(entity, *args):
+    """Returns the form of a single Game, Score or Record entity"""
+    forms = yield to_forms_async([entity], *args)
+    raise ndb.Return(forms[0])
+
+
+def get_page_size(requested, default=DEFAULT_PAGE_SIZE,
+                  maximum=MAX_PAGE_SIZE):
+    """Returns a requested page size clamped to 1 - maximum, or the default
+        page size if none was requested"""
+    if not requested:
+        return default
+    return max(1, min(requested, maximum))
+
+
+def _parse_cursor(urlsafe_cursor):
+    if not urlsafe_cursor:
+        return None
+    try:
+        return Cursor(urlsafe=urlsafe_cursor)
+    except (datastore_errors.BadValueError, TypeError):
+        raise endpoints.BadRequestException('Invalid Cursor')
+
+
+@ndb.tasklet
+def fetch_page_async(query, page_size, urlsafe_cursor=None, **options):
+    """Fetches one page of a query starting from an opaque cursor
+    Args:
+        query: The ndb.Query to page through
+        page_size: The number of results in the page
+        urlsafe_cursor: A urlsafe cursor from a previous page or None to
+            start at the beginning of the query
+        options: Extra query options passed on to fetch_page
+    Returns:
+        A Future for a list of results and the urlsafe cursor of the next
+        page, or None if there are no more results.
+    Raises:
+        endpoints.BadRequestException: The cursor is malformed"""
+    cursor = _parse_cursor(urlsafe_cursor)
+    results, next_cursor, more = yield query.fetch_page_async(
+        page_size, start_cursor=cursor, **options)
+    if more and next_cursor:
+        raise ndb.Return(results, next_cursor.urlsafe())
+    raise ndb.Return(results, None)
+
+
+def fetch_page(query, page_size, urlsafe_cursor=None, **options):
+    """Fetches one page of a query starting from an opaque cursor, see
+        fetch_page_async"""
+    return fetch_page_async(query, page_size, urlsafe_cursor,
+                            **options).get_result()
+
+
+def get_list_page(items, page_size, cursor=None):
+    """Returns one page of an in-memory list and the cursor of the next page
+    Args:
+        items: The list to page through
+        page_size: The number of items in the page
+        cursor: A cursor from a previous page or None for the first page
+    Returns:
+        A list of items and the cursor of the next page, or None if the page
+        reaches the end of the list.
+    Raises:
+        endpoints.BadRequestException: The cursor is malformed"""
+    offset = 0
+    if cursor:
+        try:
+            offset = int(cursor)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid Cursor')
+        if offset < 0:
+            raise endpoints.BadRequestException('Invalid Cursor')
+    end = offset + page_size
+    return items[offset:end], (str(end) if end < len(items) else None)